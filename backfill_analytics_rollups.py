@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Rebuild the analytics rollups from usage_logs for RomaLume.
+
+The admin analytics endpoints read usage_daily_rollups (one doc per day)
+and usage_model_rollups (one doc per model), which the usage writer keeps
+up to date as messages are logged. Run this once after deploying the
+rollups, or any time they need rebuilding. It streams every usage_logs
+document, aggregates it the same way the usage writer does, and replaces
+the rollup documents: every day and model found is overwritten, and rollup
+documents for days or models that no longer appear in usage_logs are
+deleted.
+
+Usage:
+    python backfill_analytics_rollups.py            # rebuild
+    python backfill_analytics_rollups.py --dry-run  # just print the totals
+
+Live traffic keeps incrementing the rollups while this runs, so run it
+during a quiet period.
+"""
+import json
+import os
+import sys
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+from usage_writer import UsageEvent, merge_events
+
+BATCH_SIZE = 400
+
+
+def init_firebase():
+    """Initialize Firebase with the same credentials main.py uses."""
+    if not firebase_admin._apps:
+        firebase_creds = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+        if firebase_creds:
+            cred = credentials.Certificate(json.loads(firebase_creds))
+        else:
+            cred = credentials.Certificate("firebase_service_account.json")
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
+def _fields(totals: dict) -> dict:
+    return {
+        "total_requests": totals["requests"],
+        "input_tokens": totals["input_tokens"],
+        "output_tokens": totals["output_tokens"],
+        "cost_cents": totals["cost_cents"],
+        "users": {user_id: count for user_id, count in totals["users"].items() if user_id},
+    }
+
+
+def rebuild_rollups(dry_run: bool = False):
+    db = init_firebase()
+
+    print("📥 Reading usage_logs...")
+    events = []
+    for doc in db.collection("usage_logs").stream():
+        log = doc.to_dict()
+        events.append(UsageEvent(
+            log=log,
+            user_id=log.get("user_id", ""),
+            month_key=log.get("month_key", ""),
+            cost_cents=log.get("cost_cents", 0) or 0,
+            input_tokens=log.get("input_tokens", 0) or 0,
+            output_tokens=log.get("output_tokens", 0) or 0,
+        ))
+    deltas = merge_events(events)
+    print(f"📊 {len(events)} logs -> {len(deltas.daily)} days, {len(deltas.models)} models")
+
+    if dry_run:
+        for model, totals in sorted(deltas.models.items(), key=lambda kv: kv[1]["requests"], reverse=True):
+            print(f"  {model}: {totals['requests']} requests, {totals['cost_cents']}¢")
+        return
+
+    writes = []
+    for date_key, day in deltas.daily.items():
+        if not date_key:
+            continue
+        writes.append((db.collection("usage_daily_rollups").document(date_key), {
+            "date": date_key,
+            **_fields(day),
+            "by_model": {model: _fields(totals) for model, totals in day["by_model"].items()},
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }))
+    for model, totals in deltas.models.items():
+        writes.append((db.collection("usage_model_rollups").document(model), {
+            "model": model,
+            **_fields(totals),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }))
+
+    for start in range(0, len(writes), BATCH_SIZE):
+        batch = db.batch()
+        for ref, data in writes[start:start + BATCH_SIZE]:
+            batch.set(ref, data)
+        batch.commit()
+    print(f"✅ Wrote {len(writes)} rollup documents")
+
+    # Rollups for days/models that no longer have any usage_logs
+    kept = {ref.path for ref, _ in writes}
+    stale = [
+        doc.reference
+        for collection in ("usage_daily_rollups", "usage_model_rollups")
+        for doc in db.collection(collection).stream()
+        if doc.reference.path not in kept
+    ]
+    for start in range(0, len(stale), BATCH_SIZE):
+        batch = db.batch()
+        for ref in stale[start:start + BATCH_SIZE]:
+            batch.delete(ref)
+        batch.commit()
+    print(f"🗑️ Deleted {len(stale)} stale rollup documents")
+
+
+if __name__ == "__main__":
+    rebuild_rollups(dry_run="--dry-run" in sys.argv)
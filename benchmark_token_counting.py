@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark token counting in cost_tracker.
+
+Compares, on prompt sizes typical of chat (short message, long history,
+history plus RAG/URL context):
+
+- before: resolving the encoding on every call, as cost_tracker used to
+- exact: the memoized encoding registry (estimate_tokens)
+- approximate: estimate_tokens(..., approximate=True)
+- event-loop block: time estimate_tokens_async holds the loop per call
+
+Usage:
+    python benchmark_token_counting.py [--runs N]
+"""
+import asyncio
+import sys
+import time
+
+import tiktoken
+
+import cost_tracker
+
+SIZES = [500, 5000, 20000, 50000]
+MODELS = ["gpt-5-mini", "claude-sonnet-4-6"]
+
+SAMPLE = (
+    "The quarterly report shows revenue grew 12% while operating costs fell. "
+    "def summarize(rows):\n    return {r['id']: r['total'] for r in rows}\n"
+    "Source: https://example.com/reports/q3?ref=newsletter — see table 4.\n"
+)
+
+
+def make_text(chars: int) -> str:
+    return (SAMPLE * (chars // len(SAMPLE) + 1))[:chars]
+
+
+def uncached_estimate(text: str, model: str) -> int:
+    """The old per-call path: look the encoding up by model every time."""
+    if model.startswith("gpt-"):
+        encoding = tiktoken.encoding_for_model("gpt-4o")
+    else:
+        encoding = tiktoken.get_encoding(cost_tracker.DEFAULT_ENCODING)
+    return len(encoding.encode(text))
+
+
+def time_per_call(fn, runs: int) -> float:
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs * 1000
+
+
+async def loop_block_ms(text: str, model: str, runs: int) -> float:
+    """Longest gap between event-loop ticks while counting."""
+    worst = 0.0
+    for _ in range(runs):
+        done = asyncio.Event()
+        gaps = []
+
+        async def ticker():
+            last = time.perf_counter()
+            while not done.is_set():
+                await asyncio.sleep(0)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        await cost_tracker.estimate_tokens_async(text, model)
+        done.set()
+        await task
+        worst = max(worst, max(gaps, default=0.0) * 1000)
+    return worst
+
+
+def main():
+    runs = int(sys.argv[sys.argv.index("--runs") + 1]) if "--runs" in sys.argv else 20
+
+    start = time.perf_counter()
+    cost_tracker.warm_encodings()
+    print(f"warm_encodings: {(time.perf_counter() - start) * 1000:.1f} ms\n")
+
+    print(f"{'model':<20}{'chars':>8}{'tokens':>8}{'before ms':>11}{'exact ms':>10}{'approx ms':>11}{'loop block ms':>15}")
+    for model in MODELS:
+        for size in SIZES:
+            text = make_text(size)
+            tokens = cost_tracker.estimate_tokens(text, model)
+            before = time_per_call(lambda: uncached_estimate(text, model), runs)
+            exact = time_per_call(lambda: cost_tracker.estimate_tokens(text, model), runs)
+            approx = time_per_call(lambda: cost_tracker.estimate_tokens(text, model, approximate=True), runs)
+            block = asyncio.run(loop_block_ms(text, model, min(runs, 5)))
+            print(f"{model:<20}{size:>8}{tokens:>8}{before:>11.3f}{exact:>10.3f}{approx:>11.4f}{block:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
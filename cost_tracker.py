@@ -3,8 +3,10 @@ Cost tracking module for RomaLume.
 Estimates token counts and calculates actual AI costs for transparent billing.
 """
 
+import asyncio
+import threading
 import tiktoken
-from typing import Optional
+from typing import Dict, Optional
 
 # Pricing per 1 MILLION tokens (as of April 2026)
 # Format: {"input": price_per_1M_input, "output": price_per_1M_output}
@@ -23,6 +25,9 @@ MODEL_PRICING = {
     "claude-opus-4-5": {"input": 5.00, "output": 25.00},
     "claude-sonnet-4-6": {"input": 3.00, "output": 15.00},
     "claude-haiku-4-5": {"input": 1.00, "output": 5.00},
+    # Family fallbacks for older versions (longer prefixes above win)
+    "claude-sonnet": {"input": 3.00, "output": 15.00},
+    "claude-haiku": {"input": 1.00, "output": 5.00},
 
     # Google Gemini
     "gemini-3.1-pro": {"input": 2.00, "output": 12.00},
@@ -258,46 +263,95 @@ def get_models_catalog():
 
 # Default encoding for token estimation
 DEFAULT_ENCODING = "cl100k_base"  # Works for most modern models
+# GPT models use the gpt-4o tokenizer
+GPT_ENCODING = "o200k_base"
+
+# Texts longer than this are counted in a worker thread by estimate_tokens_async
+# (tiktoken releases the GIL while encoding)
+OFFLOAD_MIN_CHARS = 8000
+
+# Rough ratio used by approximate counts
+CHARS_PER_TOKEN = 4
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_encodings_lock = threading.Lock()
+
+
+def encoding_name_for_model(model: str) -> str:
+    """Name of the tiktoken encoding used to estimate tokens for a model."""
+    if model.startswith("gpt-"):
+        return GPT_ENCODING
+    # Claude and Gemini tokenize differently, but cl100k is a reasonable approximation
+    return DEFAULT_ENCODING
+
+
+def _load_encoding(name: str) -> tiktoken.Encoding:
+    encoding = _encodings.get(name)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(name)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.get_encoding(name)
+                except Exception:
+                    encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+                _encodings[name] = encoding
+    return encoding
 
 
 def get_encoding_for_model(model: str) -> tiktoken.Encoding:
-    """Get the appropriate tiktoken encoding for a model."""
-    try:
-        # Try to get model-specific encoding
-        if model.startswith("gpt-"):
-            return tiktoken.encoding_for_model("gpt-4o")
-        elif model.startswith("claude-"):
-            # Claude uses similar tokenization to GPT-4
-            return tiktoken.get_encoding(DEFAULT_ENCODING)
-        elif model.startswith("gemini-"):
-            # Gemini tokenization is different but cl100k is a reasonable approximation
-            return tiktoken.get_encoding(DEFAULT_ENCODING)
-        else:
-            return tiktoken.get_encoding(DEFAULT_ENCODING)
-    except Exception:
-        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    """Get the appropriate tiktoken encoding for a model (memoized)."""
+    return _load_encoding(encoding_name_for_model(model))
+
+
+def warm_encodings():
+    """Load every encoding up front so the first request doesn't pay for it."""
+    for name in (GPT_ENCODING, DEFAULT_ENCODING):
+        try:
+            _load_encoding(name)
+        except Exception as e:
+            print(f"Token counting: could not load {name} encoding: {e}")
+
 
+def approximate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token) for display-only numbers."""
+    if not text:
+        return 0
+    return max(1, len(text) // CHARS_PER_TOKEN)
 
-def estimate_tokens(text: str, model: str = "gpt-4o") -> int:
+
+def estimate_tokens(text: str, model: str = "gpt-4o", approximate: bool = False) -> int:
     """
     Estimate token count for a given text.
 
     Args:
         text: The text to tokenize
         model: Model name to use for tokenization rules
+        approximate: Skip tokenizing and use the chars-per-token ratio
 
     Returns:
         Estimated token count
     """
     if not text:
         return 0
+    if approximate:
+        return approximate_tokens(text)
 
     try:
         encoding = get_encoding_for_model(model)
-        return len(encoding.encode(text))
+        # encode_ordinary skips the special-token scan (and never raises on
+        # user text that happens to contain "<|endoftext|>")
+        return len(encoding.encode_ordinary(text))
     except Exception:
         # Fallback: rough estimate of ~4 chars per token
-        return len(text) // 4
+        return approximate_tokens(text)
+
+
+async def estimate_tokens_async(text: str, model: str = "gpt-4o") -> int:
+    """estimate_tokens for use on the event loop; large texts are counted in a thread."""
+    if not text or len(text) < OFFLOAD_MIN_CHARS:
+        return estimate_tokens(text, model)
+    return await asyncio.to_thread(estimate_tokens, text, model)
 
 
 def estimate_conversation_tokens(messages: list, model: str = "gpt-4o") -> int:
@@ -321,6 +375,66 @@ def estimate_conversation_tokens(messages: list, model: str = "gpt-4o") -> int:
     return total
 
 
+# Used for models with no pricing entry, mid-tier to avoid undercharging
+DEFAULT_PRICING = {"input": 1.00, "output": 5.00}
+
+# Resolved lookups kept (model names can come from requests, so bound it)
+PRICING_MEMO_SIZE = 4096
+
+_END = object()
+
+
+class PricingIndex:
+    """
+    Longest-prefix pricing lookup over a character trie.
+
+    A model matches the longest known prefix, whatever order the entries were
+    defined in, so "gpt-5.2-pro-2025-12-11" resolves to "gpt-5.2-pro" and
+    never to "gpt-5.2". Lookups cost O(len(model)) and are memoized.
+    """
+
+    def __init__(self, entries: Dict[str, dict]):
+        self.entries = dict(entries)
+        self._root: dict = {}
+        for prefix, pricing in self.entries.items():
+            node = self._root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[_END] = pricing
+        self._resolved: Dict[str, Optional[dict]] = {}
+
+    def lookup(self, model: str) -> Optional[dict]:
+        """Pricing for the longest matching prefix, or None for unknown models."""
+        if model in self._resolved:
+            return self._resolved[model]
+        match = None
+        node = self._root
+        for ch in model:
+            node = node.get(ch)
+            if node is None:
+                break
+            match = node.get(_END, match)
+        else:
+            match = node.get(_END, match)
+        if len(self._resolved) >= PRICING_MEMO_SIZE:
+            self._resolved.clear()
+        self._resolved[model] = match
+        return match
+
+
+def _pricing_entries() -> Dict[str, dict]:
+    """MODEL_PRICING prefixes plus the exact catalog ids."""
+    entries = {
+        model["id"]: {"input": model["input_price"], "output": model["output_price"]}
+        for model in MODELS_CATALOG
+    }
+    entries.update(MODEL_PRICING)
+    return entries
+
+
+PRICING_INDEX = PricingIndex(_pricing_entries())
+
+
 def get_model_pricing(model: str) -> dict:
     """
     Get pricing for a model, with fallback for unknown models.
@@ -331,17 +445,8 @@ def get_model_pricing(model: str) -> dict:
     Returns:
         Dict with 'input' and 'output' prices per 1M tokens
     """
-    # Check for exact match
-    if model in MODEL_PRICING:
-        return MODEL_PRICING[model]
-
-    # Check for prefix match (e.g., "gpt-5-nano-2025-08-07" matches "gpt-5-nano")
-    for prefix, pricing in MODEL_PRICING.items():
-        if model.startswith(prefix):
-            return pricing
-
-    # Default fallback: use mid-tier pricing to avoid undercharging
-    return {"input": 1.00, "output": 5.00}
+    # Longest prefix match (e.g., "gpt-5-nano-2025-08-07" matches "gpt-5-nano")
+    return PRICING_INDEX.lookup(model) or DEFAULT_PRICING
 
 
 def calculate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
@@ -0,0 +1,202 @@
+"""
+Per-worker access cache for chat credits.
+
+Checking access used to run a Firestore transaction for every chat message,
+even for subscribers who are never charged. CreditCache keeps, per user:
+
+- subscription status, trusted for SUBSCRIPTION_CACHE_TTL seconds and
+  dropped early by the Stripe webhook / admin handlers, and
+- for free users, a lease of up to CREDIT_LEASE_SIZE credits that was
+  debited from Firestore in one transaction. Messages are served from the
+  lease in memory; unused credits are handed back when the lease sits idle
+  for CREDIT_LEASE_IDLE_SECONDS, when the user's status changes, and on
+  shutdown.
+
+Because credits are debited before they are served, a user can never spend
+more than their balance. The cost of a worker crash is at most
+CREDIT_LEASE_SIZE unspent credits per active user, and the staleness bound
+for a canceled subscription on other workers is SUBSCRIPTION_CACHE_TTL.
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, Optional
+
+import datastore
+
+CREDIT_LEASE_SIZE = int(os.getenv("CREDIT_LEASE_SIZE", "5"))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "60"))
+CREDIT_LEASE_IDLE_SECONDS = float(os.getenv("CREDIT_LEASE_IDLE_SECONDS", "300"))
+SWEEP_INTERVAL = 30
+
+
+class _Access:
+    __slots__ = ("is_subscriber", "checked_at", "leased", "balance", "last_used")
+
+    def __init__(self, is_subscriber: bool, leased: int = 0, balance: int = 0):
+        now = time.monotonic()
+        self.is_subscriber = is_subscriber
+        self.checked_at = now
+        self.leased = leased      # credits debited in Firestore but not yet spent
+        self.balance = balance    # credits left in Firestore after the lease
+        self.last_used = now
+
+
+class CreditCache:
+    """Subscription-status cache and free-credit leases for this worker."""
+
+    def __init__(self, lease_size: int = CREDIT_LEASE_SIZE):
+        self.lease_size = lease_size
+        self._entries: Dict[str, _Access] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.subscriber_hits = 0
+        self.lease_hits = 0
+        self.transactions = 0
+        self.credits_returned = 0
+
+    def _serve(self, entry: Optional[_Access]) -> Optional[dict]:
+        """Answer from memory if the entry allows it, spending one leased credit."""
+        if entry is None:
+            return None
+        if entry.is_subscriber:
+            if time.monotonic() - entry.checked_at < SUBSCRIPTION_CACHE_TTL:
+                self.subscriber_hits += 1
+                return {"is_subscriber": True, "credits_remaining": None}
+            return None
+        if entry.leased > 0:
+            entry.leased -= 1
+            entry.last_used = time.monotonic()
+            self.lease_hits += 1
+            return {"is_subscriber": False, "credits_remaining": entry.balance + entry.leased}
+        return None
+
+    async def consume(self, user_id: str) -> dict:
+        """
+        Check access for one chat message and charge it if needed.
+
+        Returns:
+            Dict with 'is_subscriber' and 'credits_remaining'
+
+        Raises:
+            datastore.InsufficientCreditsError: if a free user has no credits left
+        """
+        self.start()
+        served = self._serve(self._entries.get(user_id))
+        if served:
+            return served
+
+        # The caller may be cancelled (access timeout, client disconnect) while
+        # the lease transaction runs. Shielding lets a committed lease still be
+        # recorded, so idle release and shutdown can hand the credits back.
+        lease = asyncio.ensure_future(self._lease(user_id))
+        try:
+            return await asyncio.shield(lease)
+        except asyncio.CancelledError:
+            lease.add_done_callback(lambda task: self._unspend(user_id, task))
+            raise
+
+    def _unspend(self, user_id: str, lease: asyncio.Task):
+        """Put back the credit charged to a message whose caller went away."""
+        if lease.cancelled() or lease.exception() is not None:
+            return
+        entry = self._entries.get(user_id)
+        if entry and not lease.result()["is_subscriber"]:
+            entry.leased += 1
+
+    async def _lease(self, user_id: str) -> dict:
+        """Serve from the lease, or take a new one in a Firestore transaction."""
+        # One transaction per user at a time, so concurrent messages share a lease
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            served = self._serve(self._entries.get(user_id))
+            if served:
+                return served
+
+            self.transactions += 1
+            try:
+                result = await datastore.lease_message_credits(user_id, self.lease_size)
+            except datastore.InsufficientCreditsError:
+                self._entries.pop(user_id, None)
+                raise
+
+            if result["is_subscriber"]:
+                self._entries[user_id] = _Access(is_subscriber=True)
+                return {"is_subscriber": True, "credits_remaining": None}
+
+            # This message spends the first leased credit
+            entry = _Access(is_subscriber=False, leased=result["leased"] - 1, balance=result["balance"])
+            self._entries[user_id] = entry
+            return {"is_subscriber": False, "credits_remaining": entry.balance + entry.leased}
+
+    def unspent_credits(self, user_id: str) -> int:
+        """Credits this worker has leased for the user but not yet spent (for display)."""
+        entry = self._entries.get(user_id)
+        return entry.leased if entry and not entry.is_subscriber else 0
+
+    async def _release(self, user_id: str, entry: _Access):
+        if entry.leased > 0:
+            unused, entry.leased = entry.leased, 0
+            try:
+                await datastore.return_leased_credits(user_id, unused)
+                self.credits_returned += unused
+            except Exception as e:
+                print(f"Credit cache: could not return {unused} credits to {user_id}: {e}")
+
+    async def invalidate(self, user_id: str, return_unused: bool = True):
+        """
+        Forget a user's cached access (subscription or credits changed).
+
+        Pass return_unused=False when the balance was overwritten or the user
+        deleted, so leased credits are not added on top of the new value.
+        """
+        entry = self._entries.pop(user_id, None)
+        if entry and return_unused:
+            await self._release(user_id, entry)
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            now = time.monotonic()
+            for user_id, entry in list(self._entries.items()):
+                if entry.is_subscriber:
+                    if now - entry.checked_at >= SUBSCRIPTION_CACHE_TTL:
+                        self._entries.pop(user_id, None)
+                elif now - entry.last_used >= CREDIT_LEASE_IDLE_SECONDS or entry.leased == 0:
+                    if self._entries.get(user_id) is entry:
+                        del self._entries[user_id]
+                        await self._release(user_id, entry)
+            for user_id in [uid for uid, lock in self._locks.items() if not lock.locked() and uid not in self._entries]:
+                self._locks.pop(user_id, None)
+
+    def start(self):
+        """Start the idle-lease sweeper on the running loop (idempotent)."""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        """Stop sweeping and hand every unspent lease back."""
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        entries, self._entries = self._entries, {}
+        await asyncio.gather(*(self._release(uid, e) for uid, e in entries.items()))
+
+    def stats(self) -> dict:
+        served = self.subscriber_hits + self.lease_hits + self.transactions
+        return {
+            "lease_size": self.lease_size,
+            "subscription_ttl_seconds": SUBSCRIPTION_CACHE_TTL,
+            "cached_users": len(self._entries),
+            "unspent_leased_credits": sum(e.leased for e in self._entries.values() if not e.is_subscriber),
+            "subscriber_hits": self.subscriber_hits,
+            "lease_hits": self.lease_hits,
+            "transactions": self.transactions,
+            "transactions_per_message": round(self.transactions / served, 3) if served else None,
+            "credits_returned": self.credits_returned,
+        }
+
+
+credit_cache = CreditCache()
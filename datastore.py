@@ -0,0 +1,409 @@
+"""
+Async Firestore data layer for RomaLume.
+
+Every request handler reads and writes Firestore through these helpers so
+that no handler blocks the event loop on a Firestore round-trip. The
+helpers wrap ``google.cloud.firestore.AsyncClient`` (via firebase_admin's
+``firestore_async``) and return plain dicts rather than snapshots.
+
+Collections covered:
+- users/{user_id} (credits, subscription, preferences, settings)
+- users/{user_id}/archives, documents, conversations, therapy_notes, settings/profile
+- usage_logs, user_monthly_usage, feedback, signup_rate_limits
+- usage_daily_rollups, usage_model_rollups (analytics aggregates)
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore_async
+from google.cloud import firestore
+from google.cloud.firestore import async_transactional
+
+# Documents returned from list helpers as (document_id, data) pairs
+DocList = List[Tuple[str, dict]]
+
+INITIAL_FREE_CREDITS = 100
+
+_client = None
+
+
+def get_client() -> firestore.AsyncClient:
+    """Get or create the shared AsyncClient (lazy, so it binds to the running loop)."""
+    global _client
+    if _client is None:
+        _client = firestore_async.client()
+    return _client
+
+
+class InsufficientCreditsError(Exception):
+    """Raised when a free-tier user has no credits left to spend."""
+
+
+def _user_ref(user_id: str):
+    return get_client().collection("users").document(user_id)
+
+
+async def _get_dict(ref) -> Optional[dict]:
+    snapshot = await ref.get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+async def _list(query) -> DocList:
+    return [(doc.id, doc.to_dict()) async for doc in query.stream()]
+
+
+# --- Users ---
+
+async def get_user(user_id: str) -> Optional[dict]:
+    """Return the user's document, or None if it doesn't exist."""
+    return await _get_dict(_user_ref(user_id))
+
+
+async def get_users(user_ids: List[str]) -> Dict[str, dict]:
+    """Batch-read user documents in one round-trip. Missing users are omitted."""
+    if not user_ids:
+        return {}
+    refs = [_user_ref(uid) for uid in user_ids]
+    return {snap.id: snap.to_dict() async for snap in get_client().get_all(refs) if snap.exists}
+
+
+async def set_user(user_id: str, data: Dict[str, Any], merge: bool = True):
+    """Write fields on the user's document (merged by default)."""
+    await _user_ref(user_id).set(data, merge=merge)
+
+
+async def update_user(user_id: str, data: Dict[str, Any]):
+    """Update fields on an existing user document."""
+    await _user_ref(user_id).update(data)
+
+
+async def find_user_by_stripe_customer(customer_id: str) -> Optional[Tuple[str, dict]]:
+    """Find the (user_id, data) pair for a Stripe customer ID."""
+    query = get_client().collection("users").where("stripe_customer_id", "==", customer_id).limit(1)
+    users = await _list(query)
+    return users[0] if users else None
+
+
+async def lease_message_credits(user_id: str, lease_size: int) -> dict:
+    """
+    Check access for a chat message and, for free users, lease a block of credits.
+
+    Active subscribers are never charged. Free users have up to ``lease_size``
+    credits (at least one, at most their balance) debited inside a
+    transaction; the caller serves messages from the lease and hands unused
+    credits back with return_leased_credits. New users are created with the
+    initial free allowance.
+
+    Returns:
+        Dict with 'is_subscriber', 'leased' (credits debited) and 'balance'
+        (credits left in Firestore after the lease)
+
+    Raises:
+        InsufficientCreditsError: if a free user has no credits left
+    """
+    user_ref = _user_ref(user_id)
+    transaction = get_client().transaction()
+
+    @async_transactional
+    async def lease_in_transaction(transaction, user_ref):
+        user_snapshot = await user_ref.get(transaction=transaction)
+
+        if not user_snapshot.exists:
+            # New user - give them the free allowance, minus the lease
+            leased = min(lease_size, INITIAL_FREE_CREDITS)
+            transaction.set(user_ref, {
+                "credits": INITIAL_FREE_CREDITS - leased,
+                "credits_used": leased,
+                "subscription_status": "none"
+            })
+            return {"is_subscriber": False, "leased": leased, "balance": INITIAL_FREE_CREDITS - leased}
+
+        user_data = user_snapshot.to_dict()
+
+        # Active subscribers get unlimited access
+        if user_data.get("subscription_status", "none") == "active":
+            return {"is_subscriber": True, "leased": 0, "balance": user_data.get("credits", 0)}
+
+        credits = user_data.get("credits", 0)
+        if credits <= 0:
+            raise InsufficientCreditsError()
+
+        leased = min(lease_size, credits)
+        transaction.update(user_ref, {
+            "credits": firestore.Increment(-leased),
+            "credits_used": firestore.Increment(leased)
+        })
+        return {"is_subscriber": False, "leased": leased, "balance": credits - leased}
+
+    return await lease_in_transaction(transaction, user_ref)
+
+
+async def return_leased_credits(user_id: str, unused: int):
+    """Give back credits that were leased but not spent."""
+    if unused > 0:
+        await _user_ref(user_id).update({
+            "credits": firestore.Increment(unused),
+            "credits_used": firestore.Increment(-unused)
+        })
+
+
+async def delete_user_data(user_id: str, subcollections=("archives", "conversations", "documents")):
+    """Delete a user's document and the given subcollections."""
+    user_ref = _user_ref(user_id)
+    for name in subcollections:
+        try:
+            async for doc in user_ref.collection(name).stream():
+                await doc.reference.delete()
+        except Exception as e:
+            print(f"Error deleting {name} for {user_id}: {e}")
+    await user_ref.delete()
+
+
+# --- Conversations ---
+
+async def get_conversation(user_id: str) -> List[dict]:
+    """Load the current conversation history."""
+    data = await _get_dict(_user_ref(user_id).collection("conversations").document("current_chat"))
+    return data.get("messages", []) if data else []
+
+
+async def save_conversation(user_id: str, messages: List[dict]):
+    """Save the entire current conversation history."""
+    await _user_ref(user_id).collection("conversations").document("current_chat").set({
+        "messages": messages,
+        "updatedAt": firestore.SERVER_TIMESTAMP
+    })
+
+
+# --- Archives ---
+
+def _archives(user_id: str):
+    return _user_ref(user_id).collection("archives")
+
+
+async def list_archives(user_id: str) -> DocList:
+    """Return all of a user's archives."""
+    return await _list(_archives(user_id))
+
+
+async def list_recent_archives(user_id: str, limit: int) -> DocList:
+    """Return the user's most recent archives, newest first."""
+    query = _archives(user_id).order_by("archivedAt", direction=firestore.Query.DESCENDING).limit(limit)
+    return await _list(query)
+
+
+async def count_archives(user_id: str) -> int:
+    """Count a user's archives with an aggregation query (no document reads)."""
+    result = await _archives(user_id).count().get()
+    return int(result[0][0].value)
+
+
+async def get_archive(user_id: str, archive_id: str) -> Optional[dict]:
+    return await _get_dict(_archives(user_id).document(archive_id))
+
+
+async def set_archive(user_id: str, archive_id: str, data: Dict[str, Any]):
+    await _archives(user_id).document(archive_id).set(data)
+
+
+async def delete_archive(user_id: str, archive_id: str) -> bool:
+    """Delete an archive. Returns False if it didn't exist."""
+    ref = _archives(user_id).document(archive_id)
+    if not (await ref.get()).exists:
+        return False
+    await ref.delete()
+    return True
+
+
+# --- Documents (upload metadata) ---
+
+def _documents(user_id: str):
+    return _user_ref(user_id).collection("documents")
+
+
+async def list_documents(user_id: str, newest_first: bool = False) -> DocList:
+    """Return metadata for all of a user's uploaded documents."""
+    query = _documents(user_id)
+    if newest_first:
+        query = query.order_by("uploadedAt", direction=firestore.Query.DESCENDING)
+    return await _list(query)
+
+
+async def get_document(user_id: str, filename: str) -> Optional[dict]:
+    return await _get_dict(_documents(user_id).document(filename))
+
+
+async def set_document(user_id: str, filename: str, data: Dict[str, Any]):
+    await _documents(user_id).document(filename).set(data)
+
+
+async def delete_document(user_id: str, filename: str) -> bool:
+    """Delete a document's metadata. Returns False if it didn't exist."""
+    ref = _documents(user_id).document(filename)
+    if not (await ref.get()).exists:
+        return False
+    await ref.delete()
+    return True
+
+
+# --- Profiles ---
+
+def _profile_ref(user_id: str):
+    return _user_ref(user_id).collection("settings").document("profile")
+
+
+async def get_profile(user_id: str) -> Optional[dict]:
+    return await _get_dict(_profile_ref(user_id))
+
+
+async def set_profile(user_id: str, data: Dict[str, Any]):
+    await _profile_ref(user_id).set(data)
+
+
+# --- Therapy notes ---
+
+def _therapy_notes(user_id: str):
+    return _user_ref(user_id).collection("therapy_notes")
+
+
+async def list_therapy_notes(user_id: str, limit: Optional[int] = None) -> DocList:
+    """Return therapy session notes, newest first."""
+    query = _therapy_notes(user_id).order_by("created_at", direction=firestore.Query.DESCENDING)
+    if limit:
+        query = query.limit(limit)
+    return await _list(query)
+
+
+async def add_therapy_note(user_id: str, data: Dict[str, Any]):
+    await _therapy_notes(user_id).add(data)
+
+
+# --- Usage logs & billing aggregates ---
+
+def _monthly_ref(user_id: str, month_key: str):
+    return get_client().collection("user_monthly_usage").document(f"{user_id}_{month_key}")
+
+
+async def get_monthly_usage(user_id: str, month_key: str) -> dict:
+    """Return the user's usage aggregate for a YYYY-MM month (empty if none)."""
+    return await _get_dict(_monthly_ref(user_id, month_key)) or {}
+
+
+# Firestore caps a WriteBatch at 500 operations
+MAX_BATCH_WRITES = 500
+
+
+def _increments(totals: Dict[str, int]) -> Dict[str, Any]:
+    return {
+        "total_requests": firestore.Increment(totals["requests"]),
+        "input_tokens": firestore.Increment(totals["input_tokens"]),
+        "output_tokens": firestore.Increment(totals["output_tokens"]),
+        "cost_cents": firestore.Increment(totals["cost_cents"]),
+    }
+
+
+def _rollup_increments(totals: Dict[str, Any]) -> Dict[str, Any]:
+    """Increments for a rollup entry, including its per-user request counts."""
+    return {
+        **_increments(totals),
+        "users": {user_id: firestore.Increment(count) for user_id, count in totals["users"].items()},
+    }
+
+
+def daily_rollup_ref(date_key: str):
+    return get_client().collection("usage_daily_rollups").document(date_key)
+
+
+def model_rollup_ref(model: str):
+    return get_client().collection("usage_model_rollups").document(model)
+
+
+async def commit_usage_batch(deltas):
+    """
+    Write a flush of usage events (a usage_writer.UsageDeltas) in one atomic batch commit.
+
+    Writes the usage_logs documents and applies the merged increments to
+    user_monthly_usage, the users' all-time fields and the analytics rollups.
+    Either everything is written or nothing is, so a failed flush can be
+    retried as a whole. The usage writer keeps flushes within MAX_BATCH_WRITES.
+    """
+    client = get_client()
+    ops = []
+    for log_id, data in deltas.logs.items():
+        ops.append((client.collection("usage_logs").document(log_id), data))
+    for (user_id, month_key), totals in deltas.monthly.items():
+        ops.append((_monthly_ref(user_id, month_key), {
+            "user_id": user_id,
+            "month": month_key,
+            "total_ai_cost_cents": firestore.Increment(totals["cost_cents"]),
+            "total_requests": firestore.Increment(totals["requests"]),
+            "total_input_tokens": firestore.Increment(totals["input_tokens"]),
+            "total_output_tokens": firestore.Increment(totals["output_tokens"]),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }))
+    for user_id, totals in deltas.all_time.items():
+        ops.append((_user_ref(user_id), {
+            "all_time_ai_cost_cents": firestore.Increment(totals["cost_cents"]),
+            "all_time_requests": firestore.Increment(totals["requests"]),
+        }))
+    for date_key, day in deltas.daily.items():
+        ops.append((daily_rollup_ref(date_key), {
+            "date": date_key,
+            **_rollup_increments(day),
+            "by_model": {model: _rollup_increments(totals) for model, totals in day["by_model"].items()},
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }))
+    for model, totals in deltas.models.items():
+        ops.append((model_rollup_ref(model), {
+            "model": model,
+            **_rollup_increments(totals),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }))
+
+    if len(ops) > MAX_BATCH_WRITES:
+        raise ValueError(f"Usage flush of {len(ops)} writes exceeds one batch ({MAX_BATCH_WRITES})")
+    batch = client.batch()
+    for ref, data in ops:
+        # New usage_logs documents don't exist yet, so merging is harmless there too
+        batch.set(ref, data, merge=True)
+    await batch.commit()
+
+
+async def list_daily_rollups(since_date_key: Optional[str] = None) -> List[dict]:
+    """Return daily usage rollups (oldest first), optionally only those on/after a date key."""
+    query = get_client().collection("usage_daily_rollups")
+    if since_date_key:
+        query = query.where("date", ">=", since_date_key)
+    return sorted((data for _, data in await _list(query)), key=lambda d: d.get("date", ""))
+
+
+async def list_model_rollups() -> List[dict]:
+    """Return all-time usage rollups, one per model."""
+    return [data for _, data in await _list(get_client().collection("usage_model_rollups"))]
+
+
+# --- Feedback ---
+
+async def add_feedback(data: Dict[str, Any]):
+    await get_client().collection("feedback").add(data)
+
+
+async def list_feedback(since_date_key: Optional[str] = None) -> List[dict]:
+    query = get_client().collection("feedback")
+    if since_date_key:
+        query = query.where("date_key", ">=", since_date_key)
+    return [data for _, data in await _list(query)]
+
+
+# --- Signup rate limits ---
+
+def _signup_ref(client_ip: str):
+    return get_client().collection("signup_rate_limits").document(client_ip)
+
+
+async def get_signup_attempts(client_ip: str) -> Optional[dict]:
+    return await _get_dict(_signup_ref(client_ip))
+
+
+async def set_signup_attempts(client_ip: str, attempts: list, last_attempt):
+    await _signup_ref(client_ip).set({"attempts": attempts, "last_attempt": last_attempt})
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compare dense-only and hybrid (dense + sparse, RRF-fused) document search.
+
+Indexes the documents in rag_eval_set.json into an in-memory Qdrant
+collection (real OpenAI embeddings, cached in the chunk embedding store)
+and runs every query both ways, reporting hit@1, hit@3 and MRR overall and
+per query kind ("semantic" paraphrases vs "exact" names, identifiers and
+error codes).
+
+Usage:
+    python eval_rag_retrieval.py [--set rag_eval_set.json] [--verbose]
+
+Needs OPENAI_API_KEY; nothing is written to the real Qdrant cluster.
+"""
+import json
+import os
+import sys
+
+# The eval collection always carries sparse vectors
+os.environ["RAG_SPARSE_VECTORS"] = "true"
+
+from qdrant_client import QdrantClient
+
+from rag_service import RAGService, ensure_collection_layout
+
+EVAL_USER_ID = "eval-user"
+TOP_K = 5
+
+
+def rank_of(results: list, expected: list):
+    """1-based rank of the first expected file in the results, or None."""
+    for rank, r in enumerate(results, start=1):
+        if r["filename"] in expected:
+            return rank
+    return None
+
+
+def summarize(ranks: list) -> dict:
+    n = len(ranks)
+    return {
+        "hit@1": sum(1 for r in ranks if r == 1) / n,
+        "hit@3": sum(1 for r in ranks if r and r <= 3) / n,
+        "mrr": sum(1 / r for r in ranks if r) / n,
+    }
+
+
+def main():
+    args = sys.argv[1:]
+    path = args[args.index("--set") + 1] if "--set" in args else "rag_eval_set.json"
+    verbose = "--verbose" in args
+    with open(path, "r", encoding="utf-8") as f:
+        eval_set = json.load(f)
+
+    rag = RAGService(qdrant=QdrantClient(":memory:"))
+    ensure_collection_layout(rag.qdrant)
+    for doc in eval_set["documents"]:
+        rag.index_document(EVAL_USER_ID, doc["filename"], doc["text"])
+
+    ranks = {"dense": {}, "hybrid": {}}
+    for q in eval_set["queries"]:
+        for mode in ranks:
+            results = rag.search(EVAL_USER_ID, q["query"], top_k=TOP_K, hybrid=mode == "hybrid")
+            ranks[mode].setdefault(q.get("kind", "all"), []).append(rank_of(results, q["expected"]))
+        if verbose:
+            print(f"  {q['query'][:50]:<52} dense={ranks['dense'][q.get('kind', 'all')][-1]} "
+                  f"hybrid={ranks['hybrid'][q.get('kind', 'all')][-1]}")
+
+    kinds = sorted(ranks["dense"])
+    print(f"\n{len(eval_set['documents'])} documents, {len(eval_set['queries'])} queries\n")
+    print(f"{'mode':<8}{'kind':<10}{'n':>4}{'hit@1':>8}{'hit@3':>8}{'MRR':>8}")
+    for mode, by_kind in ranks.items():
+        for kind in kinds + ["all"]:
+            kind_ranks = by_kind[kind] if kind != "all" else [r for k in kinds for r in by_kind[k]]
+            s = summarize(kind_ranks)
+            print(f"{mode:<8}{kind:<10}{len(kind_ranks):>4}{s['hit@1']:>8.2f}{s['hit@3']:>8.2f}{s['mrr']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Process-wide LLM client registry for RomaLume.
+
+Provider clients are expensive to build: each one owns an HTTP connection
+pool, so constructing a fresh client per chat message means a new TLS
+handshake per message. This module builds each client once, keyed by
+(provider, base URL, API key), and shares a single keep-alive (and
+HTTP/2 when ``h2`` is installed) httpx pool across the OpenAI-compatible
+and Anthropic SDK clients.
+
+Per-request parameters such as model, temperature and max_tokens are
+applied with LangChain's ``.bind()`` so they never require a new client.
+
+Streams also report the provider's own token counts: OpenAI-compatible
+models request ``stream_options.include_usage``, and the Anthropic and
+Gemini wrappers below emit a final empty chunk carrying ``usage_metadata``
+(the installed LangChain integrations drop it when streaming).
+"""
+
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
+from langchain_anthropic import ChatAnthropic
+from langchain_cohere import ChatCohere
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.pydantic_v1 import root_validator
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai.chat_models import _achat_with_retry, _response_to_result
+from langchain_openai import ChatOpenAI
+import google.generativeai as genai
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2 support)
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+# Connection pool shared by every SDK client
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=120)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+# Model prefix -> (provider, API key env var, base URL)
+PROVIDERS = [
+    ("claude-", ("anthropic", "ANTHROPIC_API_KEY", None)),
+    ("gpt-", ("openai", "OPENAI_API_KEY", None)),
+    ("o3-", ("openai", "OPENAI_API_KEY", None)),
+    ("chatgpt-", ("openai", "OPENAI_API_KEY", None)),
+    ("grok-", ("openai", "XAI_API_KEY", "https://api.x.ai/v1")),
+    ("deepseek-", ("openai", "DEEPSEEK_API_KEY", "https://api.deepseek.com")),
+    ("sonar-", ("openai", "PERPLEXITY_API_KEY", "https://api.perplexity.ai")),
+    ("command-", ("cohere", "COHERE_API_KEY", None)),
+    ("gemini-", ("google", "GOOGLE_API_KEY", None)),
+]
+
+# Providers whose LangChain wrapper accepts the model per call; the others
+# bake the model into the client, so it becomes part of the registry key.
+MODEL_PER_CALL_PROVIDERS = {"openai", "anthropic"}
+
+# OpenAI-compatible endpoints that reject stream_options (Perplexity
+# reports usage on its stream without being asked)
+NO_STREAM_OPTIONS_BASE_URLS = {"https://api.perplexity.ai"}
+
+_http_client: Optional[httpx.AsyncClient] = None
+_openai_clients: Dict[Tuple[Optional[str], Optional[str]], AsyncOpenAI] = {}
+_anthropic_clients: Dict[Optional[str], AsyncAnthropic] = {}
+_chat_models: Dict[tuple, object] = {}
+_gemini_models: Dict[Tuple[str, Optional[str]], genai.GenerativeModel] = {}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared keep-alive httpx pool used by all SDK clients."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED,
+            limits=HTTP_POOL_LIMITS,
+            timeout=HTTP_TIMEOUT,
+        )
+        print(f"LLM HTTP pool initialized (http2={HTTP2_ENABLED})")
+    return _http_client
+
+
+def resolve_provider(model_name: str) -> Tuple[str, str, Optional[str]]:
+    """Return (provider, api_key_env, base_url) for a model name."""
+    for prefix, provider in PROVIDERS:
+        if model_name.startswith(prefix):
+            return provider
+    raise ValueError(f"Unknown model provider for {model_name}")
+
+
+def get_openai_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> AsyncOpenAI:
+    """Get a shared AsyncOpenAI client for an OpenAI-compatible endpoint."""
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    key = (base_url, api_key)
+    client = _openai_clients.get(key)
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=get_http_client())
+        _openai_clients[key] = client
+    return client
+
+
+def get_anthropic_client(api_key: Optional[str] = None) -> AsyncAnthropic:
+    """Get a shared AsyncAnthropic client."""
+    api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
+    client = _anthropic_clients.get(api_key)
+    if client is None:
+        client = AsyncAnthropic(api_key=api_key, http_client=get_http_client())
+        _anthropic_clients[api_key] = client
+    return client
+
+
+def get_gemini_model(model_name: str, api_key: Optional[str] = None) -> genai.GenerativeModel:
+    """Get a cached google.generativeai model handle (used by the router)."""
+    api_key = api_key or os.getenv("GOOGLE_API_KEY")
+    key = (model_name, api_key)
+    model = _gemini_models.get(key)
+    if model is None:
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(model_name)
+        _gemini_models[key] = model
+    return model
+
+
+def _usage_chunk(input_tokens: int, output_tokens: int) -> ChatGenerationChunk:
+    """An empty chunk carrying provider-reported token counts."""
+    return ChatGenerationChunk(message=AIMessageChunk(
+        content="",
+        usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        },
+    ))
+
+
+class UsageReportingChatAnthropic(ChatAnthropic):
+    """ChatAnthropic on the shared client whose stream ends with the message's usage."""
+
+    @root_validator()
+    def use_shared_client(cls, values: Dict) -> Dict:
+        # ChatAnthropic builds its own AsyncAnthropic (and connection pool);
+        # stream through the shared one instead
+        values["_async_client"] = get_anthropic_client(values["anthropic_api_key"].get_secret_value())
+        return values
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        params = self._format_params(messages=messages, stop=stop, **kwargs)
+        if params.get("tools"):
+            # Tool calls fall back to the library's non-streaming path
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+        async with self._async_client.messages.stream(**params) as stream:
+            async for text in stream.text_stream:
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                if run_manager:
+                    await run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
+            message = await stream.get_final_message()
+        yield _usage_chunk(message.usage.input_tokens, message.usage.output_tokens)
+
+
+class UsageReportingChatGoogleGenerativeAI(ChatGoogleGenerativeAI):
+    """ChatGoogleGenerativeAI whose stream ends with the response's usage_metadata."""
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        *,
+        tools=None,
+        functions=None,
+        safety_settings=None,
+        tool_config=None,
+        generation_config: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        request = self._prepare_request(
+            messages,
+            stop=stop,
+            tools=tools,
+            functions=functions,
+            safety_settings=safety_settings,
+            tool_config=tool_config,
+            generation_config=generation_config,
+        )
+        usage = None
+        async for response in await _achat_with_retry(
+            request=request,
+            generation_method=self.async_client.stream_generate_content,
+            **kwargs,
+            metadata=self.default_metadata,
+        ):
+            # Every chunk carries the running totals; the last one is final
+            if response.usage_metadata and response.usage_metadata.total_token_count:
+                usage = response.usage_metadata
+            gen = _response_to_result(response, stream=True).generations[0]
+            if run_manager:
+                await run_manager.on_llm_new_token(gen.text)
+            yield gen
+        if usage is not None:
+            yield _usage_chunk(usage.prompt_token_count, usage.candidates_token_count)
+
+
+def _build_chat_model(provider: str, model_name: str, api_key: Optional[str], base_url: Optional[str]):
+    if provider == "anthropic":
+        return UsageReportingChatAnthropic(model_name=model_name, anthropic_api_key=api_key, max_tokens=4096)
+    if provider == "openai":
+        client = get_openai_client(api_key, base_url)
+        return ChatOpenAI(
+            model_name=model_name,
+            openai_api_key=api_key,
+            openai_api_base=base_url,
+            async_client=client.chat.completions,
+            root_async_client=client,
+            stream_usage=base_url not in NO_STREAM_OPTIONS_BASE_URLS,
+        )
+    if provider == "cohere":
+        return ChatCohere(model=model_name, cohere_api_key=api_key)
+    if provider == "google":
+        return UsageReportingChatGoogleGenerativeAI(model=model_name, google_api_key=api_key)
+    raise ValueError(f"Unknown provider {provider}")
+
+
+def get_chat_model(model_name: str, temperature: float, max_tokens: int = 4096):
+    """
+    Get a streaming-capable chat model bound to per-request parameters.
+
+    Args:
+        model_name: Provider model identifier
+        temperature: Already-clamped sampling temperature
+        max_tokens: Maximum output tokens
+
+    Returns:
+        A LangChain runnable sharing the provider's pooled client
+    """
+    provider, key_env, base_url = resolve_provider(model_name)
+    api_key = os.getenv(key_env)
+    model_key = None if provider in MODEL_PER_CALL_PROVIDERS else model_name
+    registry_key = (provider, base_url, api_key, model_key)
+
+    base = _chat_models.get(registry_key)
+    if base is None:
+        base = _build_chat_model(provider, model_name, api_key, base_url)
+        _chat_models[registry_key] = base
+        print(f"LLM registry: created {provider} client ({base_url or 'default'}, model={model_key or '*'})")
+
+    if provider == "google":
+        return base.bind(generation_config={"temperature": temperature, "max_output_tokens": max_tokens})
+    if provider == "cohere":
+        return base.bind(temperature=temperature, max_tokens=max_tokens)
+    return base.bind(model=model_name, temperature=temperature, max_tokens=max_tokens)
+
+
+async def close_clients():
+    """Close the shared HTTP pool (called on app shutdown)."""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+    _openai_clients.clear()
+    _anthropic_clients.clear()
+    _chat_models.clear()
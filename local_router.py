@@ -0,0 +1,432 @@
+"""
+Local auto-mode router for RomaLume.
+
+Classifies a message into one of the ROUTING_MODELS categories in-process
+using weighted keyword lookup tables plus a few structural regexes, so the common cases don't pay
+for a remote Gemini classification round-trip before generation starts.
+Each classification returns a confidence; the caller only falls back to
+the remote LLM router when confidence is below LOCAL_ROUTER_CONFIDENCE.
+
+LLM routing decisions are remembered in a bounded LRU+TTL cache keyed by
+the normalized message, so repeated low-confidence messages ("continue",
+"make it shorter") skip the remote router entirely. Set ROUTER_CACHE_PATH
+to persist the cache across restarts.
+
+Hit/miss counters are kept per process and exposed through
+get_router_stats() for the admin analytics endpoint.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Minimum confidence for the local decision to be used without the remote router
+LOCAL_ROUTER_CONFIDENCE = float(os.getenv("LOCAL_ROUTER_CONFIDENCE", "0.6"))
+
+# The router only ever sees the start of the message
+ROUTER_MAX_CHARS = 500
+
+# Routing decision cache
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", "5000"))
+ROUTER_CACHE_TTL = int(os.getenv("ROUTER_CACHE_TTL", str(7 * 24 * 3600)))
+ROUTER_CACHE_PATH = os.getenv("ROUTER_CACHE_PATH")  # unset = memory only
+
+CATEGORIES = ("simple", "general", "coding", "writing", "analysis", "science", "realtime")
+
+REALTIME_PATTERNS = re.compile(
+    r'\b('
+    # Time-sensitive queries
+    r'today|tonight|yesterday|this (?:week|month|year)|last (?:week|month|year|night)'
+    r'|latest|current(?:ly)?|recent(?:ly)?|right now|just now'
+    # News, weather, sports, markets
+    r'|news|headline|weather|forecast|temperature outside'
+    r'|stock (?:price|market)|price of|how much (?:is|are|does)'
+    r'|score|who (?:won|lost|is winning)|game (?:tonight|today|yesterday)'
+    r'|election|poll|results'
+    r'|trending|viral'
+    r'|what (?:time|day) is it'
+    # Explicit search requests
+    r'|search (?:for|the web|online|google)'
+    r'|look up|google'
+    # People, places, and topic lookups
+    r'|who is|who are|who was|tell me about|what is .{0,20} known for'
+    r'|what (?:happened|is happening)'
+    r'|where is|what country|what state|what city'
+    r')\b',
+    re.IGNORECASE
+)
+
+# Lookup tables: category -> {term: weight}. Terms are lowercase words or
+# 2-3 word phrases matched against the message's n-grams, so classification
+# is a handful of dict lookups rather than a regex scan per rule. Weights are
+# summed per category; the margin between the best and runner-up category
+# becomes the confidence.
+_TERM_WEIGHTS = {
+    "simple": {
+        "define": 2.5, "definition": 2.5, "meaning of": 2.5, "synonym": 2.5, "antonym": 2.5,
+        "translate": 3.0, "how do you say": 3.0, "how to say": 3.0, "in spanish": 2.0, "in french": 2.0,
+        "in german": 2.0, "in italian": 2.0, "in japanese": 2.0, "in chinese": 2.0,
+        "convert": 2.0, "how many": 1.5, "spell": 2.0, "capital of": 2.5,
+    },
+    "general": {
+        "summarize": 3.0, "summarise": 3.0, "summary": 2.5, "tldr": 3.0, "rephrase": 3.0, "reword": 3.0,
+        "paraphrase": 3.0, "shorten": 3.0, "shorter": 2.0, "simpler": 2.0, "clearer": 2.0,
+        "brainstorm": 3.0, "ideas": 2.0, "suggest": 2.0, "suggestions": 2.0, "recommend": 2.5,
+        "recommendations": 2.5, "advice": 2.5, "tips": 2.0, "should i": 2.0,
+        "explain": 2.0, "eli5": 3.0, "in simple terms": 2.5, "how does this work": 2.0,
+        "what does this code do": 3.0, "list": 1.5, "help me decide": 2.0, "help me choose": 2.0,
+        "opinion": 2.0, "what do you think": 2.0,
+    },
+    "coding": {
+        "python": 2.5, "javascript": 2.5, "typescript": 2.5, "java": 2.0, "rust": 2.0, "golang": 2.5,
+        "c++": 2.5, "c#": 2.5, "sql": 2.5, "react": 2.0, "django": 2.5, "fastapi": 2.5, "node.js": 2.5,
+        "kotlin": 2.5, "swift": 1.5, "bash": 2.0, "html": 2.0, "css": 2.0,
+        "function": 2.0, "script": 2.0, "endpoint": 2.5, "api": 1.5, "regex": 3.0, "algorithm": 2.0,
+        "refactor": 3.5, "debug": 3.5, "bug": 3.0, "compile": 2.0, "stack trace": 3.5, "traceback": 4.0,
+        "typeerror": 4.0, "valueerror": 4.0, "keyerror": 4.0, "syntaxerror": 4.0, "exception": 2.0,
+        "segmentation fault": 4.0, "null pointer": 3.0, "race condition": 3.0, "memory leak": 3.0,
+        "unit test": 3.0, "unit tests": 3.0, "pull request": 2.5, "dockerfile": 3.0, "kubernetes": 2.5,
+        "implement": 2.5, "code": 2.0, "codebase": 3.0, "class": 1.0, "method": 1.0,
+    },
+    "writing": {
+        "poem": 4.0, "haiku": 4.0, "sonnet": 4.0, "limerick": 4.0, "lyrics": 4.0, "short story": 4.0,
+        "story": 3.0, "fiction": 3.5, "novel": 3.0, "screenplay": 4.0, "monologue": 4.0, "fairy tale": 4.0,
+        "essay": 3.0, "speech": 3.0, "eulogy": 4.0, "toast": 2.5, "blog post": 3.0, "article": 2.5,
+        "cover letter": 3.5, "letter": 2.0, "wedding vows": 4.0, "apology": 2.0, "bio": 2.5,
+        "in the style of": 3.0, "in the voice of": 3.0, "tone": 2.0, "persuasive": 2.5,
+        "heartfelt": 2.5, "emotional": 2.0, "creative writing": 3.5, "character": 2.0, "plot": 2.0,
+        "draft": 1.5, "compose": 2.0,
+    },
+    "analysis": {
+        "analyze": 3.0, "analyse": 3.0, "analysis": 3.0, "evaluate": 3.0, "assess": 2.5, "critique": 3.0,
+        "in-depth": 2.5, "deep dive": 3.0, "compare": 3.0, "contrast": 3.0, "versus": 2.5, "vs": 2.5,
+        "pros and cons": 3.0, "tradeoffs": 3.0, "trade-offs": 3.0, "swot": 3.5, "strategy": 2.5,
+        "strategic": 2.5, "business plan": 3.0, "market research": 3.0, "competitive": 2.0,
+        "competitors": 2.0, "roadmap": 2.0, "implications": 2.5, "research": 1.5, "synthesize": 2.0,
+        "framework": 1.5, "root cause": 2.0,
+    },
+    "science": {
+        "prove": 4.0, "proof": 4.0, "theorem": 4.0, "lemma": 4.0, "derive": 3.5, "derivation": 3.5,
+        "integral": 3.0, "derivative": 3.0, "differential equation": 3.5, "eigenvalue": 3.5,
+        "eigenvalues": 3.5, "matrix": 2.5, "probability": 2.5, "calculus": 3.0, "algebra": 2.5,
+        "quantum": 3.0, "relativity": 3.0, "thermodynamics": 3.5, "entropy": 3.0, "photosynthesis": 3.0,
+        "molecule": 3.0, "chemical reaction": 3.0, "genetics": 3.0, "evolution": 2.0,
+        "physics": 2.0, "chemistry": 2.0, "biology": 2.0, "mathematics": 2.0, "equation": 2.0,
+        "formula": 1.5, "solve for": 2.5,
+    },
+    # Strong realtime signals; the broad REALTIME_PATTERNS check adds a little on top
+    "realtime": {
+        "today": 3.0, "tonight": 3.0, "yesterday": 2.5, "this week": 3.0, "latest": 3.0, "right now": 2.5,
+        "news": 3.5, "headlines": 3.5, "weather": 4.0, "forecast": 2.5, "stock price": 4.0,
+        "stock market": 3.5, "who won": 4.0, "election": 3.0, "trending": 3.0, "score": 2.0,
+        "search the web": 4.0, "look up": 2.5, "current events": 4.0,
+    },
+}
+
+_TERM_INDEX: Dict[str, List[Tuple[str, float]]] = {}
+for _category, _terms in _TERM_WEIGHTS.items():
+    for _term, _weight in _terms.items():
+        _TERM_INDEX.setdefault(_term, []).append((_category, _weight))
+MAX_NGRAM = max(len(term.split()) for term in _TERM_INDEX)
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9+#.'-]*")
+
+# Anchored/structural checks that don't fit a term table
+_GREETING_RE = re.compile(
+    r"\s*(?:hi|hello|hey|yo|thanks?|thank you|thx|ty|ok(?:ay)?|cool|great|nice|yes|no|yep|nope|sure|got it|perfect|awesome)\b[\s!.?]*$"
+)
+_WHAT_IS_RE = re.compile(r"\s*(?:what is|what's|what are|who is|define)\b")
+_YES_NO_RE = re.compile(r"\s*(?:is|are|can|does|do|did|was|were)\b[^.?!]{0,80}\?\s*$")
+_FOLLOW_UP_RE = re.compile(r"\s*(?:continue|go on|keep going|more|again|rewrite (?:this|it)|try again)\b")
+_CODE_MARKERS = ("```", "def ", "function(", "=>", "const ", "import ", "#include", "public static", "select * from")
+_WRITE_VERBS = {"write", "draft", "compose", "create", "build", "implement", "fix"}
+
+REALTIME_WEIGHT = 1.5
+SHORT_MESSAGE_WORDS = 20
+# Below this top score only weak priors fired - not enough to decide locally
+MIN_LOCAL_SCORE = 2.0
+
+
+def _ngrams(tokens: List[str]):
+    for n in range(1, MAX_NGRAM + 1):
+        for i in range(len(tokens) - n + 1):
+            yield " ".join(tokens[i:i + n]) if n > 1 else tokens[i]
+
+
+def classify_message(message: str) -> Tuple[str, float]:
+    """
+    Classify a message into a routing category without any network calls.
+
+    Args:
+        message: The user's message (only the first ROUTER_MAX_CHARS are used)
+
+    Returns:
+        (category, confidence) where confidence is in [0, 1]
+    """
+    text = (message or "")[:ROUTER_MAX_CHARS].lower()
+    if not text.strip():
+        return "general", 0.0
+
+    scores: Dict[str, float] = dict.fromkeys(CATEGORIES, 0.0)
+    tokens = [t.rstrip(".'-") for t in _TOKEN_RE.findall(text)]
+
+    for gram in set(_ngrams(tokens)):
+        for category, weight in _TERM_INDEX.get(gram, ()):
+            scores[category] += weight
+
+    if _GREETING_RE.match(text):
+        scores["simple"] += 4.0
+    elif _WHAT_IS_RE.match(text):
+        scores["simple"] += 2.0
+    elif _YES_NO_RE.match(text):
+        scores["simple"] += 1.5
+    if _FOLLOW_UP_RE.match(text):
+        scores["general"] += 2.0
+    if any(marker in text for marker in _CODE_MARKERS):
+        scores["coding"] += 3.0
+    # "write/fix ..." tips a code request (router rule 5) or a creative one (rule 6)
+    # away from general explanations
+    if _WRITE_VERBS.intersection(tokens[:6]):
+        if scores["coding"] > 0:
+            scores["coding"] += 2.0
+        elif scores["writing"] > 0:
+            scores["writing"] += 1.0
+    if REALTIME_PATTERNS.search(text):
+        scores["realtime"] += REALTIME_WEIGHT
+
+    # Short factual messages lean simple (router rule 1); long ones lean away from it
+    if len(tokens) < SHORT_MESSAGE_WORDS:
+        scores["simple"] += 1.0
+    elif len(tokens) > 80:
+        scores["simple"] = max(0.0, scores["simple"] - 2.0)
+
+    ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    (best, top), (_, second) = ranked[0], ranked[1]
+    if top < MIN_LOCAL_SCORE:
+        return best if top > 0 else "general", 0.0
+
+    confidence = (top - second) / (top + 1.0)
+    return best, round(confidence, 3)
+
+
+_NORMALIZE_STRIP = " \t\n.!?,;:'\"`~*_-"
+
+
+def normalize_message(message: str) -> str:
+    """Normalize the text the router sees: lowercase, collapsed whitespace, no edge punctuation."""
+    text = " ".join((message or "")[:ROUTER_MAX_CHARS].lower().split())
+    return text.strip(_NORMALIZE_STRIP)
+
+
+class RouterCache:
+    """
+    Bounded LRU cache of routing decisions with a per-entry TTL.
+
+    Keys are SHA-256 digests of the normalized message so the cache (and
+    its persisted file) never holds user text.
+    """
+
+    def __init__(self, maxsize: int = ROUTER_CACHE_SIZE, ttl: int = ROUTER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(message: str) -> str:
+        return hashlib.sha256(normalize_message(message).encode("utf-8")).hexdigest()
+
+    def get(self, message: str) -> Optional[str]:
+        """Return the cached category for a message, or None."""
+        key = self.key_for(message)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            category, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return category
+
+    def put(self, message: str, category: str):
+        key = self.key_for(message)
+        with self._lock:
+            self._entries[key] = (category, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def load(self, path: str) -> int:
+        """Load unexpired entries from a JSON file. Returns the number loaded."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Router cache: could not load {path}: {e}")
+            return 0
+
+        now = time.time()
+        # Stored oldest-first, so replaying keeps the LRU order
+        entries = [(k, (cat, exp)) for k, (cat, exp) in data.get("entries", []) if exp > now and cat in CATEGORIES]
+        with self._lock:
+            for key, entry in entries[-self.maxsize:]:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+        return len(entries)
+
+    def save(self, path: str):
+        """Write unexpired entries to a JSON file (atomically)."""
+        now = time.time()
+        with self._lock:
+            entries = [[k, [cat, exp]] for k, (cat, exp) in self._entries.items() if exp > now]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries}, f)
+        os.replace(tmp_path, path)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "persistent": bool(ROUTER_CACHE_PATH),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+router_cache = RouterCache()
+
+
+def load_router_cache():
+    """Load the persisted routing cache, if ROUTER_CACHE_PATH is set."""
+    if ROUTER_CACHE_PATH:
+        loaded = router_cache.load(ROUTER_CACHE_PATH)
+        print(f"Router cache: loaded {loaded} decisions from {ROUTER_CACHE_PATH}")
+
+
+def save_router_cache():
+    """Persist the routing cache, if ROUTER_CACHE_PATH is set."""
+    if ROUTER_CACHE_PATH:
+        try:
+            router_cache.save(ROUTER_CACHE_PATH)
+        except OSError as e:
+            print(f"Router cache: could not save {ROUTER_CACHE_PATH}: {e}")
+
+
+class RouterStats:
+    """Thread-safe counters for local vs. remote routing decisions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.local_hits = 0
+            self.cache_hits = 0
+            self.remote_calls = 0
+            self.remote_failures = 0
+            self.remote_agreed = 0
+            self.local_time_ms = 0.0
+            self.speculation_hits = 0
+            self.speculation_misses = 0
+            self.speculation_wasted_tokens = 0
+            self.speculation_wasted_cost_cents = 0
+            self.local_by_category = dict.fromkeys(CATEGORIES, 0)
+            self.remote_by_category = dict.fromkeys(CATEGORIES, 0)
+
+    def record_local(self, category: str, elapsed_ms: float):
+        with self._lock:
+            self.local_hits += 1
+            self.local_time_ms += elapsed_ms
+            self.local_by_category[category] = self.local_by_category.get(category, 0) + 1
+
+    def record_cache_hit(self, category: str, elapsed_ms: float):
+        with self._lock:
+            self.cache_hits += 1
+            self.local_time_ms += elapsed_ms
+            self.local_by_category[category] = self.local_by_category.get(category, 0) + 1
+
+    def record_remote(self, category: str, local_guess: str, elapsed_ms: float, failed: bool = False):
+        with self._lock:
+            self.remote_calls += 1
+            self.local_time_ms += elapsed_ms
+            if failed:
+                self.remote_failures += 1
+            self.remote_by_category[category] = self.remote_by_category.get(category, 0) + 1
+            if category == local_guess:
+                self.remote_agreed += 1
+
+    def record_speculation(self, hit: bool, wasted_tokens: int = 0, wasted_cost_cents: int = 0):
+        """Record whether a speculative generation matched the router's choice."""
+        with self._lock:
+            if hit:
+                self.speculation_hits += 1
+            else:
+                self.speculation_misses += 1
+                self.speculation_wasted_tokens += wasted_tokens
+                self.speculation_wasted_cost_cents += wasted_cost_cents
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            speculations = self.speculation_hits + self.speculation_misses
+            total = self.local_hits + self.cache_hits + self.remote_calls
+            return {
+                "confidence_threshold": LOCAL_ROUTER_CONFIDENCE,
+                "total_decisions": total,
+                "local_hits": self.local_hits,
+                "cache_hits": self.cache_hits,
+                "remote_calls": self.remote_calls,
+                "remote_failures": self.remote_failures,
+                "local_hit_rate": round(self.local_hits / total, 3) if total else 0.0,
+                "cache_hit_rate": round(self.cache_hits / total, 3) if total else 0.0,
+                "remote_hit_rate": round(self.remote_calls / total, 3) if total else 0.0,
+                # How often the low-confidence local guess matched the remote answer
+                "low_confidence_agreement": round(self.remote_agreed / self.remote_calls, 3) if self.remote_calls else None,
+                "avg_local_classify_ms": round(self.local_time_ms / total, 4) if total else 0.0,
+                "local_by_category": dict(self.local_by_category),
+                "remote_by_category": dict(self.remote_by_category),
+                "cache": router_cache.snapshot(),
+                "speculation": {
+                    "hits": self.speculation_hits,
+                    "misses": self.speculation_misses,
+                    "hit_rate": round(self.speculation_hits / speculations, 3) if speculations else 0.0,
+                    "wasted_output_tokens": self.speculation_wasted_tokens,
+                    "wasted_cost_cents": self.speculation_wasted_cost_cents,
+                },
+                "since": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            }
+
+
+router_stats = RouterStats()
+
+
+def get_router_stats() -> dict:
+    """Return local/remote routing counters for this process."""
+    return router_stats.snapshot()
@@ -7,6 +7,7 @@ import io
 import sys
 import json
 import socket
+import time
 
 os.environ["GRPC_DNS_RESOLVER"] = "native"  # Force gRPC to use system DNS
 
@@ -21,7 +22,6 @@ from pypdf import PdfReader
 import csv
 import base64
 import re
-from ddgs import DDGS
 
 # RAG Service (lazy import to avoid startup failure if Qdrant unavailable)
 def get_rag_service():
@@ -32,20 +32,33 @@ def get_rag_service():
     except Exception as e:
         print(f"Warning: RAG service unavailable: {e}")
         return None
+
+
+def get_async_rag_service():
+    """Get the async (search-only) RAG service singleton (lazy load)."""
+    try:
+        from rag_service import get_async_rag_service as _get_async_rag
+        return _get_async_rag()
+    except Exception as e:
+        print(f"Warning: async RAG service unavailable: {e}")
+        return None
 import firebase_admin
 from firebase_admin import credentials, firestore, storage, auth as firebase_auth
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-from langchain_anthropic import ChatAnthropic
-from langchain_cohere import ChatCohere
-from langchain_google_genai import ChatGoogleGenerativeAI
 import google.generativeai as genai
-from langchain_openai import ChatOpenAI
-from openai import AsyncOpenAI
-from google.cloud.firestore_v1.query import Query
-from google.cloud.firestore_v1.transaction import Transaction
-from google.cloud.firestore_v1.document import DocumentReference
-from cost_tracker import estimate_tokens, estimate_request_cost, calculate_cost_cents, get_models_catalog
+import llm_clients
+import token_verifier
+import url_fetcher
+from search_service import get_search_stats, web_search
+from url_fetcher import URL_FETCH_BUDGET, extract_urls, load_url_cache, save_url_cache, url_cache
+from local_router import (
+    LOCAL_ROUTER_CONFIDENCE, REALTIME_PATTERNS, ROUTER_MAX_CHARS, classify_message, get_router_stats, router_stats,
+    router_cache, load_router_cache, save_router_cache,
+)
+from rag_context import PASSAGE_SEPARATOR, pack_context
+from cost_tracker import estimate_tokens, estimate_tokens_async, estimate_request_cost, calculate_cost_cents, get_models_catalog, warm_encodings, PRICING_INDEX
+import datastore
+from usage_writer import UsageEvent, usage_writer
+from credit_cache import credit_cache
 
 # Stripe integration (optional - gracefully handle if not configured)
 try:
@@ -117,6 +130,7 @@ if not firebase_admin._apps:
     firebase_admin.initialize_app(cred, {
         'storageBucket': os.getenv('STORAGE_BUCKET')
     })
+# Sync client for background threads; request handlers go through the async datastore module
 db = firestore.client()
 bucket = storage.bucket()
 
@@ -175,28 +189,6 @@ def send_to_email_marketing_background(email: str, tags: List[str] = None):
         print(f"✗ Failed to send to email marketing: {e}")
 
 
-def web_search(query: str, max_results: int = 5) -> list:
-    """Resilient DuckDuckGo/multi-engine search.
-
-    DDG frequently blocks datacenter IPs (e.g. Railway), returning
-    'No results found'. Retry across backends so a single engine being
-    blocked doesn't kill the feature. Returns [] if everything fails.
-    """
-    backends = ["auto", "google, bing, brave, mojeek, yahoo, duckduckgo"]
-    last_err = None
-    for backend in backends:
-        try:
-            results = list(DDGS().text(query, max_results=max_results, backend=backend))
-            if results:
-                return results
-        except Exception as e:
-            last_err = e
-            print(f"web_search backend='{backend}' failed: {type(e).__name__}: {e}")
-    if last_err:
-        print(f"web_search exhausted all backends: {type(last_err).__name__}: {last_err}")
-    return []
-
-
 # Anthropic rejects images over ~5MB or with very large dimensions
 # ("Could not process image"). Normalize uploads to safe bounds.
 IMAGE_MAX_EDGE = 1568          # px on the long edge (Anthropic's recommended cap)
@@ -270,7 +262,7 @@ def sanitize_image_data_uri(data_uri: str):
         return None
 
 
-def log_usage_with_cost(
+async def log_usage_with_cost(
     user_id: str,
     model: str,
     original_model: str,
@@ -278,56 +270,60 @@ def log_usage_with_cost(
     input_text: str,
     output_text: str,
     search_web: bool = False,
-    search_docs: bool = False
+    search_docs: bool = False,
+    extra_fields: Optional[dict] = None,
+    usage: Optional[dict] = None
 ):
     """
     Log usage with actual token counts and cost calculation.
-    Also updates monthly aggregates for billing.
+    Also updates monthly aggregates for billing (written behind by usage_writer).
+
+    usage is the provider-reported {'input_tokens', 'output_tokens'} from the
+    stream; tiktoken estimates are only used when the provider sent none.
     """
     try:
         # Calculate tokens and cost
-        input_tokens = estimate_tokens(input_text, model)
-        output_tokens = estimate_tokens(output_text, model)
+        if usage and usage.get("input_tokens") is not None and usage.get("output_tokens") is not None:
+            input_tokens = usage["input_tokens"]
+            output_tokens = usage["output_tokens"]
+            token_source = "provider"
+        else:
+            input_tokens = await estimate_tokens_async(input_text, model)
+            output_tokens = await estimate_tokens_async(output_text, model)
+            token_source = "tiktoken"
         cost_cents = calculate_cost_cents(model, input_tokens, output_tokens)
 
         now = datetime.now()
         month_key = now.strftime("%Y-%m")
         date_key = now.strftime("%Y-%m-%d")
 
-        # Log individual request
-        db.collection("usage_logs").add({
-            "user_id": user_id,
-            "model": model,
-            "original_model": original_model,
-            "routed_category": routed_category,
-            "timestamp": firestore.SERVER_TIMESTAMP,
-            "date_key": date_key,
-            "month_key": month_key,
-            "search_web": search_web,
-            "search_docs": search_docs,
-            # New cost tracking fields
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            "cost_cents": cost_cents,
-        })
-
-        # Update monthly aggregate for this user
-        monthly_ref = db.collection("user_monthly_usage").document(f"{user_id}_{month_key}")
-        monthly_ref.set({
-            "user_id": user_id,
-            "month": month_key,
-            "total_ai_cost_cents": firestore.Increment(cost_cents),
-            "total_requests": firestore.Increment(1),
-            "total_input_tokens": firestore.Increment(input_tokens),
-            "total_output_tokens": firestore.Increment(output_tokens),
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        }, merge=True)
-
-        # Update user's all-time totals
-        db.collection("users").document(user_id).set({
-            "all_time_ai_cost_cents": firestore.Increment(cost_cents),
-            "all_time_requests": firestore.Increment(1),
-        }, merge=True)
+        # Queue the log and aggregate increments; the usage writer batches
+        # them into Firestore in the background so billing writes never
+        # hold up the response stream.
+        usage_writer.record(UsageEvent(
+            log={
+                "user_id": user_id,
+                "model": model,
+                "original_model": original_model,
+                "routed_category": routed_category,
+                "timestamp": firestore.SERVER_TIMESTAMP,
+                "date_key": date_key,
+                "month_key": month_key,
+                "search_web": search_web,
+                "search_docs": search_docs,
+                # New cost tracking fields
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cost_cents": cost_cents,
+                "token_source": token_source,
+                **(extra_fields or {}),
+            },
+            user_id=user_id,
+            month_key=month_key,
+            cost_cents=cost_cents,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        ))
 
         print(f"Usage logged: {model}, {input_tokens}+{output_tokens} tokens, ${cost_cents/100:.4f}")
 
@@ -344,8 +340,8 @@ async def get_current_user(authorization: str = Header(...)):
     token = authorization.split("Bearer ")[1]
     
     try:
-        # Verify the token against the Firebase project.
-        decoded_token = id_token.verify_firebase_token(token, google_requests.Request())
+        # Verify the token against the Firebase project (cached; misses run off the event loop).
+        decoded_token = await token_verifier.verify_firebase_token(token)
         return decoded_token
     except ValueError as e:
         # Token is invalid
@@ -368,17 +364,45 @@ main_app.add_middleware(
     allow_headers=["*"],
 )
 
+@main_app.on_event("startup")
+async def load_caches():
+    """Restore persisted routing decisions and fetched pages, prefetch auth certs and tokenizers."""
+    load_router_cache()
+    load_url_cache()
+    usage_writer.start()
+    credit_cache.start()
+    await token_verifier.warm_certs()
+    await asyncio.to_thread(warm_encodings)
+
+@main_app.on_event("shutdown")
+async def close_llm_clients():
+    """Release pooled provider, URL-fetch and Qdrant connections."""
+    await url_fetcher.close_client()
+    try:
+        from rag_service import close_async_rag_service
+        await close_async_rag_service()
+    except Exception as e:
+        print(f"Warning: could not close async Qdrant client: {e}")
+    await llm_clients.close_clients()
+
+@main_app.on_event("shutdown")
+async def persist_caches():
+    """Persist routing decisions and fetched pages, flush queued usage logs and return unspent credit leases."""
+    save_router_cache()
+    save_url_cache()
+    await usage_writer.stop()
+    await credit_cache.stop()
+
 # --- Public Endpoints (no auth required) ---
 
 @main_app.get("/health")
 async def health_check():
     """Verifies Anthropic API and Qdrant are reachable. Used by monitoring cron."""
-    import anthropic as _anthropic
     results = {"ai_ok": False, "qdrant_ok": False}
 
     # AI check — minimal Haiku call
     try:
-        _client = _anthropic.AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+        _client = llm_clients.get_anthropic_client()
         await _client.messages.create(
             model="claude-haiku-4-5-20251001",
             max_tokens=1,
@@ -425,6 +449,8 @@ class ChatRequest(BaseModel):
     search_docs: bool = False
     temperature: float = 0.7
     therapy_mode: bool = False
+    speculative: bool = False  # auto mode: stream from the general model while routing
+    hybrid_search: Optional[bool] = None  # documents: fuse keyword + semantic matches (None = RAG_HYBRID_DEFAULT)
 
 class ArchiveRequest(BaseModel):
     history: List[Message]
@@ -493,11 +519,9 @@ async def check_signup_rate_limit(request: Request):
         return {"allowed": True, "attempts_remaining": 999}
 
     # Get signup attempts from this IP in the last 24 hours
-    signup_ref = db.collection("signup_rate_limits").document(client_ip)
-    signup_doc = signup_ref.get()
+    data = await datastore.get_signup_attempts(client_ip)
 
-    if signup_doc.exists:
-        data = signup_doc.to_dict()
+    if data:
         attempts = data.get("attempts", [])
 
         # Filter to only attempts within the rate window
@@ -534,21 +558,19 @@ async def record_signup(request: Request, background_tasks: BackgroundTasks, bod
     """Record a successful signup attempt for rate limiting and send to email marketing."""
     client_ip = get_client_ip(request)
 
-    signup_ref = db.collection("signup_rate_limits").document(client_ip)
-    signup_doc = signup_ref.get()
+    data = await datastore.get_signup_attempts(client_ip)
 
     now = datetime.now(timezone.utc)
     cutoff = now - timedelta(hours=SIGNUP_RATE_WINDOW_HOURS)
 
-    if signup_doc.exists:
-        data = signup_doc.to_dict()
+    if data:
         attempts = data.get("attempts", [])
         # Keep only recent attempts + new one
         recent_attempts = [a for a in attempts if a > cutoff]
         recent_attempts.append(now)
-        signup_ref.update({"attempts": recent_attempts, "last_attempt": now})
+        await datastore.set_signup_attempts(client_ip, recent_attempts, now)
     else:
-        signup_ref.set({"attempts": [now], "last_attempt": now})
+        await datastore.set_signup_attempts(client_ip, [now], now)
 
     # Send to email marketing tool in the background
     if body and body.email:
@@ -582,61 +604,8 @@ def get_llm(model_name: str, temperature: float = 0.7):
         # OpenAI GPT-4, xAI, etc. support up to 2.0, but we'll cap at 1.5 for better results
         temperature = max(0.0, min(1.5, float(temperature)))
 
-    if model_name.startswith("claude-"):
-        return ChatAnthropic(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=4096,
-            anthropic_api_key=os.getenv("ANTHROPIC_API_KEY")
-        )
-    elif model_name.startswith(("gpt-", "o3-", "chatgpt-")):
-        return ChatOpenAI(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=4096,
-            openai_api_key=os.getenv("OPENAI_API_KEY")
-        )
-    elif model_name.startswith("grok-"):
-        return ChatOpenAI(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=4096,
-            openai_api_key=os.getenv("XAI_API_KEY"),
-            openai_api_base="https://api.x.ai/v1",
-        )
-    elif model_name.startswith("deepseek-"):
-        return ChatOpenAI(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=4096,
-            openai_api_key=os.getenv("DEEPSEEK_API_KEY"),
-            openai_api_base="https://api.deepseek.com",
-        )
-    elif model_name.startswith("command-"):
-        return ChatCohere(
-            model=model_name,
-            temperature=temperature,
-            cohere_api_key=os.getenv("COHERE_API_KEY"),
-            max_tokens=4096
-        )
-    elif model_name.startswith("gemini-"):
-        return ChatGoogleGenerativeAI(
-            model=model_name,
-            temperature=temperature,
-            google_api_key=os.getenv("GOOGLE_API_KEY"),
-            max_output_tokens=4096
-        )
-    elif model_name.startswith("sonar-"):
-        # Perplexity uses OpenAI-compatible API
-        return ChatOpenAI(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=4096,
-            openai_api_key=os.getenv("PERPLEXITY_API_KEY"),
-            openai_api_base="https://api.perplexity.ai",
-        )
-    else:
-        raise ValueError(f"Unknown model provider for {model_name}")
+    # Clients are pooled per provider; temperature/max_tokens are bound per request
+    return llm_clients.get_chat_model(model_name, temperature, max_tokens=4096)
 
 def is_gpt5_model(model_name: str) -> bool:
     """Check if model is a GPT-5 family model that requires Responses API."""
@@ -690,47 +659,21 @@ Message: "{message}"
 
 Category:"""
 
-import re as _re
-
-_REALTIME_PATTERNS = _re.compile(
-    r'\b('
-    # Time-sensitive queries
-    r'today|tonight|yesterday|this (?:week|month|year)|last (?:week|month|year|night)'
-    r'|latest|current(?:ly)?|recent(?:ly)?|right now|just now'
-    # News, weather, sports, markets
-    r'|news|headline|weather|forecast|temperature outside'
-    r'|stock (?:price|market)|price of|how much (?:is|are|does)'
-    r'|score|who (?:won|lost|is winning)|game (?:tonight|today|yesterday)'
-    r'|election|poll|results'
-    r'|trending|viral'
-    r'|what (?:time|day) is it'
-    # Explicit search requests
-    r'|search (?:for|the web|online|google)'
-    r'|look up|google'
-    # People, places, and topic lookups
-    r'|who is|who are|who was|tell me about|what is .{0,20} known for'
-    r'|what (?:happened|is happening)'
-    r'|where is|what country|what state|what city'
-    r')\b',
-    _re.IGNORECASE
-)
-
 def _needs_web_search(message: str) -> bool:
     """Lightweight keyword check to detect queries needing web search."""
-    return bool(_REALTIME_PATTERNS.search(message))
+    return bool(REALTIME_PATTERNS.search(message))
 
 
-async def route_to_best_model(user_message: str) -> tuple[str, str]:
+async def route_with_llm(user_message: str) -> tuple[str, str]:
     """
-    Use Gemini 2.0 Flash to quickly classify the message and route to the best model.
+    Use Gemini 2.0 Flash to classify the message and route to the best model.
     Returns (model_name, category) tuple.
     """
     try:
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        model = genai.GenerativeModel("gemini-2.0-flash")
+        model = llm_clients.get_gemini_model("gemini-2.0-flash")
 
         response = await model.generate_content_async(
-            ROUTER_PROMPT.format(message=user_message[:500]),
+            ROUTER_PROMPT.format(message=user_message[:ROUTER_MAX_CHARS]),
             generation_config=genai.GenerationConfig(
                 max_output_tokens=20,
                 temperature=0.0  # Deterministic for consistent routing
@@ -748,17 +691,53 @@ async def route_to_best_model(user_message: str) -> tuple[str, str]:
                 category = cat
                 break
 
-        if category:
-            routed_model = ROUTING_MODELS[category]
-            print(f"Router: '{category}' -> {routed_model}")
-            return routed_model, category
-        else:
-            print(f"Router: Could not extract category from '{raw_response}', defaulting to general")
-            return ROUTING_MODELS["general"], "general"
+        if not category:
+            raise ValueError(f"could not extract category from '{raw_response}'")
+
+        routed_model = ROUTING_MODELS[category]
+        print(f"Router: '{category}' -> {routed_model}")
+        return routed_model, category
 
     except Exception as e:
         print(f"Router failed: {e}, defaulting to general")
+        raise
+
+
+async def route_to_best_model(user_message: str) -> tuple[str, str]:
+    """
+    Route a message to the best model for its category.
+
+    The in-process classifier decides when it is confident enough
+    (LOCAL_ROUTER_CONFIDENCE); otherwise a cached LLM decision for the same
+    normalized message is reused, and only then is the Gemini router called.
+    Returns (model_name, category) tuple.
+    """
+    started = time.perf_counter()
+    category, confidence = classify_message(user_message)
+    local_ms = (time.perf_counter() - started) * 1000
+
+    if confidence >= LOCAL_ROUTER_CONFIDENCE:
+        router_stats.record_local(category, local_ms)
+        routed_model = ROUTING_MODELS[category]
+        print(f"Router (local, confidence={confidence:.2f}): '{category}' -> {routed_model}")
+        return routed_model, category
+
+    cached_category = router_cache.get(user_message)
+    if cached_category:
+        router_stats.record_cache_hit(cached_category, (time.perf_counter() - started) * 1000)
+        routed_model = ROUTING_MODELS[cached_category]
+        print(f"Router (cached): '{cached_category}' -> {routed_model}")
+        return routed_model, cached_category
+
+    print(f"Router (local) unsure: '{category}' confidence={confidence:.2f} < {LOCAL_ROUTER_CONFIDENCE}, asking LLM")
+    try:
+        routed_model, remote_category = await route_with_llm(user_message)
+    except Exception:
+        router_stats.record_remote("general", category, local_ms, failed=True)
         return ROUTING_MODELS["general"], "general"
+    router_cache.put(user_message, remote_category)
+    router_stats.record_remote(remote_category, category, local_ms)
+    return routed_model, remote_category
 
 THERAPY_SYSTEM_PROMPT = """You are a compassionate, emotionally intelligent AI companion operating in therapy mode. You are NOT a licensed therapist, and you should be transparent about that when appropriate. But you are a skilled emotional support presence.
 
@@ -777,16 +756,13 @@ When session notes from previous conversations are provided, use them like a the
 async def get_therapy_notes(user_id: str, limit: int = 5) -> str:
     """Retrieve recent therapy session notes for context injection."""
     try:
-        notes_ref = db.collection("users").document(user_id).collection("therapy_notes")
-        notes_query = notes_ref.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit)
-        notes = notes_query.get()
+        notes = await datastore.list_therapy_notes(user_id, limit=limit)
 
         if not notes:
             return ""
 
         formatted_notes = []
-        for note in reversed(notes):  # Show oldest first for chronological context
-            data = note.to_dict()
+        for _, data in reversed(notes):  # Show oldest first for chronological context
             date = data.get("created_at", "Unknown date")
             if hasattr(date, 'strftime'):
                 date = date.strftime("%B %d, %Y")
@@ -817,56 +793,7 @@ async def get_therapy_notes(user_id: str, limit: int = 5) -> str:
         return ""
 
 
-# --- URL fetching (Jina Reader) ---
-URL_REGEX = re.compile(r'https?://[^\s\])>"\'`]+', re.IGNORECASE)
-MAX_URLS_PER_MESSAGE = 3
-MAX_URL_CONTENT_CHARS = 50000  # ~12K tokens
-URL_FETCH_TIMEOUT = 15  # seconds
-
-
-def extract_urls(text: str) -> List[str]:
-    """Find unique URLs in a string, preserving order, capped at MAX_URLS_PER_MESSAGE."""
-    if not isinstance(text, str):
-        return []
-    found = []
-    seen = set()
-    for match in URL_REGEX.findall(text):
-        # Strip common trailing punctuation
-        cleaned = match.rstrip('.,;:!?')
-        if cleaned not in seen:
-            seen.add(cleaned)
-            found.append(cleaned)
-        if len(found) >= MAX_URLS_PER_MESSAGE:
-            break
-    return found
-
-
-async def fetch_url_content(url: str) -> Optional[dict]:
-    """Fetch a URL via Jina Reader (https://r.jina.ai/<url>) and return clean text.
-
-    Jina Reader handles JS-rendered pages and returns markdown-formatted text.
-    Returns dict with 'url' and 'content' on success, None on failure.
-    """
-    import requests
-    try:
-        reader_url = f"https://r.jina.ai/{url}"
-        # Run blocking request in a thread so we don't block the event loop
-        response = await asyncio.to_thread(
-            requests.get,
-            reader_url,
-            timeout=URL_FETCH_TIMEOUT,
-            headers={"Accept": "text/plain"},
-        )
-        if response.status_code != 200:
-            print(f"URL fetch failed for {url}: HTTP {response.status_code}")
-            return None
-        content = response.text
-        if len(content) > MAX_URL_CONTENT_CHARS:
-            content = content[:MAX_URL_CONTENT_CHARS] + "\n\n[...content truncated...]"
-        return {"url": url, "content": content}
-    except Exception as e:
-        print(f"URL fetch failed for {url}: {type(e).__name__}: {e}")
-        return None
+# --- URL fetching (Jina Reader, see url_fetcher) ---
 
 
 async def fetch_urls_from_text(text: str) -> List[dict]:
@@ -875,8 +802,7 @@ async def fetch_urls_from_text(text: str) -> List[dict]:
     if not urls:
         return []
     print(f"Fetching {len(urls)} URL(s): {urls}")
-    results = await asyncio.gather(*[fetch_url_content(u) for u in urls])
-    return [r for r in results if r is not None]
+    return await url_fetcher.fetch_urls(urls)
 
 
 def build_url_context_block(fetched: List[dict]) -> str:
@@ -891,6 +817,19 @@ def build_url_context_block(fetched: List[dict]) -> str:
     return "\n\n".join(parts)
 
 
+def build_url_message(user_content: str, fetched: List[dict]) -> str:
+    """Rewrite a user message so it carries the content of the pages it links to."""
+    url_block = build_url_context_block(fetched)
+    return (
+        "The user's message contains links. Here is the content of those pages, "
+        "fetched for you:\n\n"
+        f"{url_block}\n\n"
+        "Use this content to answer the user accurately. "
+        "If a page failed to load, it will be missing from the list above.\n\n"
+        f"User message: {user_content}"
+    )
+
+
 async def generate_gpt5_response(
     req: ChatRequest,
     user_id: str,
@@ -900,7 +839,7 @@ async def generate_gpt5_response(
     therapy_notes: str = ""
 ):
     """Generate streaming response for GPT-5 models using Chat Completions API with GPT-5 parameters."""
-    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    client = llm_clients.get_openai_client()
 
     # Convert history to messages format (convert 'context' role to 'user' for API compatibility)
     messages = []
@@ -956,7 +895,7 @@ async def generate_gpt5_response(
             search_snippets = []
             try:
                 print(f"Starting web search for GPT-5: {user_query[:100]}")
-                results = web_search(user_query, max_results=5)
+                results = await web_search(user_query, max_results=5)
                 print(f"Web search returned {len(results)} results")
 
                 for result in results:
@@ -991,12 +930,16 @@ async def generate_gpt5_response(
         response = await client.chat.completions.create(
             model=req.model,
             messages=messages,
-            stream=True
+            stream=True,
+            stream_options={"include_usage": True}
         )
 
         # Stream the response
         full_response = ""
+        usage = None
         async for chunk in response:
+            if chunk.usage:
+                usage = {"input_tokens": chunk.usage.prompt_tokens, "output_tokens": chunk.usage.completion_tokens}
             if chunk.choices and len(chunk.choices) > 0:
                 delta = chunk.choices[0].delta
                 if hasattr(delta, 'content') and delta.content:
@@ -1015,7 +958,7 @@ async def generate_gpt5_response(
 
         # Log usage with actual token counts and costs
         input_text = "\n".join([m.get('content', '') for m in messages])
-        log_usage_with_cost(
+        await log_usage_with_cost(
             user_id=user_id,
             model=req.model,
             original_model=original_model or req.model,
@@ -1024,6 +967,7 @@ async def generate_gpt5_response(
             output_text=full_response,
             search_web=req.search_web,
             search_docs=req.search_docs,
+            usage=usage,
         )
 
     except Exception as e:
@@ -1033,345 +977,216 @@ async def generate_gpt5_response(
         traceback.print_exc()
         yield json.dumps(f"ERROR: {str(e)}")
 
-async def generate_chat_response(req: ChatRequest, user_id: str):
-    user_ref = db.collection("users").document(user_id)
+# --- Pre-generation stage ---
+# Every lookup that has to finish before the first token (credit check, router,
+# URL fetch, RAG, profile, therapy notes) is started at the same moment. Each
+# step gets its own budget so one slow dependency degrades that feature
+# instead of holding up the whole stream.
+PREGEN_ACCESS_TIMEOUT = 15   # seconds; the credit check is the only hard dependency
+PREGEN_ROUTER_TIMEOUT = 8
+PREGEN_URL_TIMEOUT = URL_FETCH_BUDGET + 5
+PREGEN_RAG_TIMEOUT = 20
+PREGEN_PROFILE_TIMEOUT = 5
+PREGEN_THERAPY_TIMEOUT = 5
+
+
+async def run_pregen_step(coro, timeout: float, label: str, default=None):
+    """Await a pre-generation step under its own timeout, returning ``default`` on failure."""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        print(f"{label} timed out after {timeout}s (non-fatal)")
+    except Exception as e:
+        print(f"{label} failed (non-fatal): {type(e).__name__}: {e}")
+    return default
+
+
+def cancel_pending(tasks: List[asyncio.Task]):
+    """Cancel any pre-generation tasks that are still running."""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+
+
+def find_last_user_index(history: List[Message]) -> int:
+    """Return the index of the last user message in history, or -1."""
+    for i in range(len(history) - 1, -1, -1):
+        if history[i].role == 'user':
+            return i
+    return -1
+
+
+def format_profile_context(profile: dict) -> str:
+    """Format a stored user profile into the system-prompt context block."""
+    profile_parts = []
+    currently_parts = []
+
+    # Always Remember goes first - user-specified priority info
+    if profile.get("always_remember"):
+        profile_parts.append(f"IMPORTANT - User wants you to always remember: {profile['always_remember']}")
+
+    # Format static profile into readable context
+    if profile.get("work"):
+        profile_parts.append(f"Work: {profile['work']}")
+    if profile.get("background"):
+        profile_parts.append(f"Background: {profile['background']}")
+    if profile.get("location"):
+        profile_parts.append(f"Location: {profile['location']}")
+    if profile.get("family"):
+        profile_parts.append(f"Family: {', '.join(profile['family'])}")
+    if profile.get("pets"):
+        profile_parts.append(f"Pets: {', '.join(profile['pets'])}")
+    if profile.get("interests"):
+        profile_parts.append(f"Interests: {', '.join(profile['interests'])}")
+    if profile.get("philosophies"):
+        profile_parts.append(f"Values/Philosophies: {', '.join(profile['philosophies'])}")
+    if profile.get("communication_preferences"):
+        profile_parts.append(f"Communication preferences: {', '.join(profile['communication_preferences'])}")
+    if profile.get("projects"):
+        profile_parts.append(f"Ongoing projects: {', '.join(profile['projects'])}")
+    if profile.get("other"):
+        profile_parts.append(f"Other: {', '.join(profile['other'])}")
+
+    # Currently section - dynamic recent context
+    if profile.get("currently"):
+        currently_parts = profile['currently']
+
+    if not (profile_parts or currently_parts):
+        return ""
 
-    # Check subscription status and credits
-    transaction = db.transaction()
+    context_sections = []
+    if profile_parts:
+        context_sections.append("About this user:\n" + "\n".join(f"- {p}" for p in profile_parts))
+    if currently_parts:
+        context_sections.append("Currently:\n" + "\n".join(f"- {c}" for c in currently_parts))
+    return "\n\n".join(context_sections)
 
-    @firestore.transactional
-    def check_access_and_update(transaction: Transaction, user_ref: DocumentReference):
-        """
-        Check if user can access the service:
-        1. Active subscribers → unlimited access (no credit deduction)
-        2. Free users → use credits (100 free messages)
-        """
-        user_snapshot = user_ref.get(transaction=transaction)
-
-        if not user_snapshot.exists:
-            # New user - give them 100 free messages
-            initial_credits = 100
-            transaction.set(user_ref, {
-                "credits": initial_credits - 1,
-                "credits_used": 1,
-                "subscription_status": "none"
-            })
-            return {"is_subscriber": False, "credits_remaining": initial_credits - 1}
 
-        user_data = user_snapshot.to_dict()
-        subscription_status = user_data.get("subscription_status", "none")
+async def get_profile_context(user_id: str) -> str:
+    """Load the user's profile document and format it for the system prompt."""
+    profile = await datastore.get_profile(user_id)
+    if not profile:
+        return ""
+    profile_context = format_profile_context(profile)
+    if profile_context:
+        print(f"Loaded user profile for {user_id}")
+    return profile_context
 
-        # Active subscribers get unlimited access
-        if subscription_status == "active":
-            return {"is_subscriber": True, "credits_remaining": None}
 
-        # Free users use credits
-        credits = user_data.get("credits", 0)
+async def search_docs_context(user_id: str, query: str, hybrid: Optional[bool] = None,
+                              model: str = "auto") -> tuple[str, List[str]]:
+    """Search the user's documents and build the numbered RAG context block,
+    packed to the model's document-context token budget.
 
-        if credits <= 0:
-            raise HTTPException(
-                status_code=402,
-                detail="You've used all your free messages! Subscribe to continue and support Houseless Movement."
-            )
+    Returns (rag_context, rag_sources) where rag_sources is the ordered list of
+    unique filenames cited as [1], [2], ...
+    """
+    rag = get_async_rag_service()
+    if not rag or not query:
+        return "", []
+
+    print(f"RAG searching for user {user_id}: '{query[:100]}...'")
+    results = await rag.search(user_id, query, top_k=5, score_threshold=0.5, hybrid=hybrid)
+    if not results:
+        return "", []
+    # Tokenizing up to a budget's worth of text: keep it off the event loop
+    passages = await asyncio.to_thread(pack_context, results, model)
+
+    # Dedupe filenames into a numbered source list so chunks from
+    # the same document share one citation number.
+    rag_sources = []
+    filename_to_num = {}
+    context_parts = []
+    for p in passages:
+        fname = p['filename']
+        if fname not in filename_to_num:
+            filename_to_num[fname] = len(rag_sources) + 1
+            rag_sources.append(fname)
+        num = filename_to_num[fname]
+        context_parts.append(
+            f"[Source {num}: {fname}]\n{p['chunk_text']}"
+        )
+    print(f"RAG found {len(results)} relevant chunks across {len(rag_sources)} document(s) for user {user_id}")
+    return PASSAGE_SEPARATOR.join(context_parts), rag_sources
 
-        transaction.update(user_ref, {
-            "credits": firestore.Increment(-1),
-            "credits_used": firestore.Increment(1)
-        })
 
-        return {"is_subscriber": False, "credits_remaining": credits - 1}
+# --- Model resolution & prompt building ---
+FREE_TIER_MODEL = "claude-haiku-4-5-20251001"
+PAID_ONLY_MODELS = {
+    "claude-sonnet-4-6", "claude-sonnet-4-5", "claude-sonnet-4-5-20250929",
+    "claude-opus-4-7", "claude-opus-4-6", "claude-opus-4-5", "claude-opus-4-5-20250514",
+}
 
-    try:
-        access_info = check_access_and_update(transaction, user_ref)
-    except HTTPException as e:
-        yield f"data: ERROR: {e.detail}\n\n"
-        yield "data: [DONE]\n\n"
-        return
+# Opt-in speculative generation for auto mode: start streaming from the
+# "general" model while the router is still deciding. Can also be enabled
+# per request with ChatRequest.speculative.
+SPECULATIVE_ROUTING = os.getenv("SPECULATIVE_ROUTING", "false").lower() == "true"
 
-    # Send a heartbeat immediately so the browser knows the stream is alive
-    yield ": ping\n\n"
 
-    # --- Auto-routing: If model is "auto", use router to select best model ---
-    routed_category = None
-    original_model = req.model  # Store for logging
-    if req.model == "auto":
-        # Find the last user message for routing
-        last_user_msg = None
-        for msg in reversed(req.history):
-            if msg.role == 'user':
-                last_user_msg = msg.content
-                break
+def resolve_model_request(
+    req: ChatRequest,
+    routed_model: Optional[str],
+    routed_category: Optional[str],
+    is_subscriber: bool,
+    last_user_content,
+) -> tuple[ChatRequest, List[dict]]:
+    """
+    Apply the routing decision, the free-tier model cap and keyword web-search detection.
 
-        if last_user_msg:
-            routed_model, routed_category = await route_to_best_model(last_user_msg)
-            print(f"Auto-routing: '{last_user_msg[:50]}...' -> {routed_model} ({routed_category})")
+    Returns the updated request and the SSE events announcing the changes.
+    """
+    events = []
+    model = req.model
+    search_web = req.search_web
+
+    if routed_model:
+        model = routed_model
+        if routed_category:
             # Auto-enable web search for realtime queries
-            auto_search_web = req.search_web or routed_category == "realtime"
-            if auto_search_web and not req.search_web:
+            if routed_category == "realtime" and not search_web:
                 print(f"Auto-enabling web search for realtime query")
-            # Update the request model
-            req = ChatRequest(
-                history=req.history,
-                model=routed_model,
-                search_web=auto_search_web,
-                search_docs=req.search_docs,
-                temperature=req.temperature,
-                therapy_mode=req.therapy_mode
-            )
+                search_web = True
             # Send routing info to frontend
-            yield f"data: {json.dumps({'routed_model': routed_model, 'routed_category': routed_category})}\n\n"
-        else:
-            # No user message, default to general
-            req = ChatRequest(
-                history=req.history,
-                model=ROUTING_MODELS["general"],
-                search_web=req.search_web,
-                search_docs=req.search_docs,
-                temperature=req.temperature,
-                therapy_mode=req.therapy_mode
-            )
+            events.append({'routed_model': routed_model, 'routed_category': routed_category})
 
     # --- Free-tier model cap: redirect free users to Haiku 4.5 ---
-    FREE_TIER_MODEL = "claude-haiku-4-5-20251001"
-    PAID_ONLY_MODELS = {
-        "claude-sonnet-4-6", "claude-sonnet-4-5", "claude-sonnet-4-5-20250929",
-        "claude-opus-4-7", "claude-opus-4-6", "claude-opus-4-5", "claude-opus-4-5-20250514",
-    }
-    if not access_info["is_subscriber"] and req.model in PAID_ONLY_MODELS:
-        req = ChatRequest(
-            history=req.history,
-            model=FREE_TIER_MODEL,
-            search_web=req.search_web,
-            search_docs=req.search_docs,
-            temperature=req.temperature,
-            therapy_mode=req.therapy_mode
-        )
-        yield f"data: {json.dumps({'free_tier_model': FREE_TIER_MODEL})}\n\n"
+    if not is_subscriber and model in PAID_ONLY_MODELS:
+        model = FREE_TIER_MODEL
+        events.append({'free_tier_model': FREE_TIER_MODEL})
 
     # --- Auto-detect web search need (for all models, not just "auto") ---
-    if not req.search_web:
-        last_user_msg_for_search = None
-        for msg in reversed(req.history):
-            if msg.role == 'user':
-                last_user_msg_for_search = msg.content if isinstance(msg.content, str) else ""
-                break
-        if last_user_msg_for_search and _needs_web_search(last_user_msg_for_search):
-            print(f"Auto-enabling web search (keyword match) for: {last_user_msg_for_search[:80]}")
-            req = ChatRequest(
-                history=req.history,
-                model=req.model,
-                search_web=True,
-                search_docs=req.search_docs,
-                temperature=req.temperature,
-                therapy_mode=req.therapy_mode
-            )
-
-    # Usage logging moved to AFTER response generation (so we can capture output tokens)
-    # Store variables needed for logging
-    usage_log_data = {
-        "user_id": user_id,
-        "model": req.model,
-        "original_model": original_model,
-        "routed_category": routed_category,
-        "search_web": req.search_web,
-        "search_docs": req.search_docs,
-    }
-
-    # --- URL fetching: auto-detect links in last user message and fetch their content ---
-    try:
-        last_user_idx = -1
-        for i in range(len(req.history) - 1, -1, -1):
-            if req.history[i].role == 'user':
-                last_user_idx = i
-                break
-
-        if last_user_idx != -1:
-            last_user_content = req.history[last_user_idx].content
-            urls = extract_urls(last_user_content) if isinstance(last_user_content, str) else []
-            if urls:
-                # Notify frontend that we're reading links
-                yield f"data: {json.dumps({'fetching_urls': urls})}\n\n"
-                fetched = await fetch_urls_from_text(last_user_content)
-                if fetched:
-                    url_block = build_url_context_block(fetched)
-                    new_content = (
-                        "The user's message contains links. Here is the content of those pages, "
-                        "fetched for you:\n\n"
-                        f"{url_block}\n\n"
-                        "Use this content to answer the user accurately. "
-                        "If a page failed to load, it will be missing from the list above.\n\n"
-                        f"User message: {last_user_content}"
-                    )
-                    # Rewrite the last user message in-place so both regular & GPT-5 paths see it
-                    new_history = list(req.history)
-                    new_history[last_user_idx] = Message(role='user', content=new_content)
-                    req = ChatRequest(
-                        history=new_history,
-                        model=req.model,
-                        search_web=req.search_web,
-                        search_docs=req.search_docs,
-                        temperature=req.temperature,
-                        therapy_mode=req.therapy_mode
-                    )
-                    yield f"data: {json.dumps({'fetched_urls': [f['url'] for f in fetched]})}\n\n"
-    except Exception as e:
-        print(f"URL fetching failed (non-fatal): {type(e).__name__}: {e}")
-
-    # --- RAG: Search user's documents for relevant context (only if enabled) ---
-    rag_context = ""
-    rag_sources = []  # Ordered list of unique filenames cited as [1], [2], ...
-    if req.search_docs:
-        try:
-            rag = get_rag_service()
-            if rag:
-                # Find the last user message for search
-                last_user_msg = None
-                for msg in reversed(req.history):
-                    if msg.role == 'user':
-                        last_user_msg = msg.content
-                        break
-
-                if last_user_msg:
-                    print(f"RAG searching for user {user_id}: '{last_user_msg[:100]}...'")
-                    results = rag.search(user_id, last_user_msg, top_k=5, score_threshold=0.5)
-
-                    if results:
-                        # Dedupe filenames into a numbered source list so chunks from
-                        # the same document share one citation number.
-                        filename_to_num = {}
-                        context_parts = []
-                        for r in results:
-                            fname = r['filename']
-                            if fname not in filename_to_num:
-                                filename_to_num[fname] = len(rag_sources) + 1
-                                rag_sources.append(fname)
-                            num = filename_to_num[fname]
-                            context_parts.append(
-                                f"[Source {num}: {fname}]\n{r['chunk_text']}"
-                            )
-                        rag_context = "\n\n---\n\n".join(context_parts)
-                        print(f"RAG found {len(results)} relevant chunks across {len(rag_sources)} document(s) for user {user_id}")
-                        # Notify the frontend of the sources being used
-                        yield f"data: {json.dumps({'rag_sources': rag_sources})}\n\n"
-        except Exception as e:
-            print(f"RAG search failed (non-fatal): {e}")
-
-    # --- Retrieve user profile for personalization ---
-    profile_context = ""
-    try:
-        profile_ref = db.collection("users").document(user_id).collection("settings").document("profile")
-        profile_doc = profile_ref.get()
-
-        if profile_doc.exists:
-            profile = profile_doc.to_dict()
-            profile_parts = []
-            currently_parts = []
-
-            # Always Remember goes first - user-specified priority info
-            if profile.get("always_remember"):
-                profile_parts.append(f"IMPORTANT - User wants you to always remember: {profile['always_remember']}")
-
-            # Format static profile into readable context
-            if profile.get("work"):
-                profile_parts.append(f"Work: {profile['work']}")
-            if profile.get("background"):
-                profile_parts.append(f"Background: {profile['background']}")
-            if profile.get("location"):
-                profile_parts.append(f"Location: {profile['location']}")
-            if profile.get("family"):
-                profile_parts.append(f"Family: {', '.join(profile['family'])}")
-            if profile.get("pets"):
-                profile_parts.append(f"Pets: {', '.join(profile['pets'])}")
-            if profile.get("interests"):
-                profile_parts.append(f"Interests: {', '.join(profile['interests'])}")
-            if profile.get("philosophies"):
-                profile_parts.append(f"Values/Philosophies: {', '.join(profile['philosophies'])}")
-            if profile.get("communication_preferences"):
-                profile_parts.append(f"Communication preferences: {', '.join(profile['communication_preferences'])}")
-            if profile.get("projects"):
-                profile_parts.append(f"Ongoing projects: {', '.join(profile['projects'])}")
-            if profile.get("other"):
-                profile_parts.append(f"Other: {', '.join(profile['other'])}")
-
-            # Currently section - dynamic recent context
-            if profile.get("currently"):
-                currently_parts = profile['currently']
-
-            if profile_parts or currently_parts:
-                context_sections = []
-                if profile_parts:
-                    context_sections.append("About this user:\n" + "\n".join(f"- {p}" for p in profile_parts))
-                if currently_parts:
-                    context_sections.append("Currently:\n" + "\n".join(f"- {c}" for c in currently_parts))
-                profile_context = "\n\n".join(context_sections)
-                print(f"Loaded user profile for {user_id} ({len(profile_parts)} static fields, {len(currently_parts)} currently items)")
-    except Exception as e:
-        print(f"Profile retrieval failed (non-fatal): {e}")
-
-    # --- Retrieve therapy session notes if therapy mode is active ---
-    therapy_notes_context = ""
-    if req.therapy_mode:
-        therapy_notes_context = await get_therapy_notes(user_id, limit=5)
-        if therapy_notes_context:
-            print(f"Loaded therapy notes for {user_id}")
-
-    # Build the RAG-augmented user prompt with citation instructions
-    def build_rag_prompt(original_query: str) -> str:
-        sources_list = "\n".join(f"[{i+1}] {fname}" for i, fname in enumerate(rag_sources))
-        return (
-            "The following excerpts come from the user's own document library. "
-            "Each excerpt is tagged with a source number like [Source 1: filename.pdf]. "
-            "When you use information from one of these excerpts, cite it inline using "
-            "bracketed numbers like [1] or [2]. At the end of your response, include a "
-            '"Sources" section listing each source you cited by number and filename. '
-            "Only cite sources you actually used. If the excerpts don't contain the answer, "
-            "say so plainly rather than guessing.\n\n"
-            "--- DOCUMENT EXCERPTS ---\n"
-            f"{rag_context}\n"
-            "--- END EXCERPTS ---\n\n"
-            "Available sources:\n"
-            f"{sources_list}\n\n"
-            f"User question: {original_query}"
-        )
-
-    # Check if this is a GPT-5 model that requires Responses API
-    if is_gpt5_model(req.model):
-        # For GPT-5 models, inject RAG context into request history
-        if rag_context:
-            # Create a modified request with RAG context
-            modified_history = list(req.history)
-            for i in range(len(modified_history) - 1, -1, -1):
-                if modified_history[i].role == 'user':
-                    original_query = modified_history[i].content
-                    modified_history[i] = Message(
-                        role='user',
-                        content=build_rag_prompt(original_query)
-                    )
-                    break
-            req = ChatRequest(
-                history=modified_history,
-                model=req.model,
-                search_web=req.search_web,
-                temperature=req.temperature,
-                therapy_mode=req.therapy_mode
-            )
-
-        # Use the Responses API for GPT-5 models
-        async for token in generate_gpt5_response(
-            req, user_id, profile_context,
-            original_model=usage_log_data["original_model"],
-            routed_category=usage_log_data["routed_category"],
-            therapy_notes=therapy_notes_context
-        ):
-            yield f"data: {token}\n\n"
-        yield "data: [DONE]\n\n"
-        return
+    if not search_web and isinstance(last_user_content, str) and last_user_content:
+        if _needs_web_search(last_user_content):
+            print(f"Auto-enabling web search (keyword match) for: {last_user_content[:80]}")
+            search_web = True
+
+    req = req.model_copy(update={"model": model, "search_web": search_web})
+    return req, events
+
+
+def build_rag_prompt(original_query: str, rag_context: str, rag_sources: List[str]) -> str:
+    """Build the RAG-augmented user prompt with citation instructions."""
+    sources_list = "\n".join(f"[{i+1}] {fname}" for i, fname in enumerate(rag_sources))
+    return (
+        "The following excerpts come from the user's own document library. "
+        "Each excerpt is tagged with a source number like [Source 1: filename.pdf]. "
+        "When you use information from one of these excerpts, cite it inline using "
+        "bracketed numbers like [1] or [2]. At the end of your response, include a "
+        '"Sources" section listing each source you cited by number and filename. '
+        "Only cite sources you actually used. If the excerpts don't contain the answer, "
+        "say so plainly rather than guessing.\n\n"
+        "--- DOCUMENT EXCERPTS ---\n"
+        f"{rag_context}\n"
+        "--- END EXCERPTS ---\n\n"
+        "Available sources:\n"
+        f"{sources_list}\n\n"
+        f"User question: {original_query}"
+    )
 
-    llm = get_llm(req.model, req.temperature)
-    history_messages = [message.dict() for message in req.history]
 
-    # Add base system prompt with optional profile context for non-GPT5 models
-    if req.therapy_mode:
+def build_system_content(therapy_mode: bool, profile_context: str, therapy_notes_context: str) -> str:
+    """Base system prompt with optional profile context for non-GPT5 models."""
+    if therapy_mode:
         base_instruction = THERAPY_SYSTEM_PROMPT
     else:
         base_instruction = "When the user changes topics or asks about something new, respond to that topic directly without forcing connections to previous unrelated topics in this conversation. Treat each distinct subject independently unless there's a clear and explicit connection."
@@ -1381,6 +1196,18 @@ async def generate_chat_response(req: ChatRequest, user_id: str):
         system_content += f"\n\nHere is what you know about this user:\n{profile_context}\n\nUse this context only when directly relevant to the current question."
     if therapy_notes_context:
         system_content += f"\n\n--- PREVIOUS SESSION NOTES ---\n{therapy_notes_context}\n--- END SESSION NOTES ---"
+    return system_content
+
+
+async def build_llm_messages(req: ChatRequest, system_content: str, rag_context: str, rag_sources: List[str]) -> tuple[list, list]:
+    """
+    Build the message list for a LangChain model.
+
+    Returns (history_messages, llm_history): the plain history that gets saved
+    as the conversation, and the same messages converted for the model
+    (context role mapped to user, image data URIs turned into content blocks).
+    """
+    history_messages = [message.dict() for message in req.history]
 
     history_messages.insert(0, {
         "role": "system",
@@ -1392,7 +1219,7 @@ async def generate_chat_response(req: ChatRequest, user_id: str):
         for i in range(len(history_messages) - 1, -1, -1):
             if history_messages[i]['role'] == 'user':
                 original_query = history_messages[i]['content']
-                history_messages[i]['content'] = build_rag_prompt(original_query)
+                history_messages[i]['content'] = build_rag_prompt(original_query, rag_context, rag_sources)
                 break
 
     if req.search_web:
@@ -1408,7 +1235,7 @@ async def generate_chat_response(req: ChatRequest, user_id: str):
             try:
                 # Resilient multi-engine web search (DDG blocks Railway's IP)
                 print(f"Starting web search for: {user_query[:100]}")
-                results = web_search(user_query, max_results=5)
+                results = await web_search(user_query, max_results=5)
                 print(f"Web search returned {len(results)} results")
 
                 # Extract relevant information from the results
@@ -1477,11 +1304,319 @@ async def generate_chat_response(req: ChatRequest, user_id: str):
         else:
             llm_history.append({'role': role, 'content': content})
 
+    return history_messages, llm_history
+
+
+def llm_history_text(llm_history: list) -> str:
+    """Flatten model messages to text for token estimation."""
+    return "\n".join([
+        m.get('content', '') if isinstance(m.get('content'), str)
+        else ' '.join(b.get('text', '[image]') for b in m.get('content', []))
+        for m in llm_history
+    ])
+
+
+async def astream_tokens(llm, llm_history: list, usage: Optional[dict] = None):
+    """
+    Yield the text of each chunk streamed by a LangChain model.
+
+    If usage is given, it is filled in from the provider-reported
+    usage_metadata (sent on a final, empty chunk).
+    """
+    async for chunk in llm.astream(llm_history):
+        usage_metadata = getattr(chunk, 'usage_metadata', None)
+        if usage is not None and usage_metadata:
+            usage.update(usage_metadata)
+        token = chunk.content if hasattr(chunk, 'content') else str(chunk)
+        if token:
+            yield token
+
+
+class SpeculativeStream:
+    """
+    Streams a model's response into a buffer before the router has decided.
+
+    Nothing reaches the client until the caller iterates the stream, which it
+    only does once the router confirms the speculative model. Otherwise
+    cancel() stops generation and reports the discarded work.
+    """
+
+    def __init__(self, model: str, llm, llm_history: list):
+        self.model = model
+        self.llm_history = llm_history
+        self.started = time.perf_counter()
+        self.parts: List[str] = []
+        self.usage: dict = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(llm))
+
+    async def _run(self, llm):
+        try:
+            async for token in astream_tokens(llm, self.llm_history, self.usage):
+                self.parts.append(token)
+                self._queue.put_nowait(token)
+        except Exception as e:
+            self._queue.put_nowait(e)
+        self._queue.put_nowait(None)
+
+    async def __aiter__(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def abort(self):
+        """Stop generating without waiting (e.g. when the client disconnects)."""
+        if not self._task.done():
+            self._task.cancel()
+
+    async def cancel(self) -> dict:
+        """Stop generating and return how much work was thrown away."""
+        self.abort()
+        await asyncio.gather(self._task, return_exceptions=True)
+        if self.usage:
+            input_tokens = self.usage["input_tokens"]
+            output_tokens = self.usage["output_tokens"]
+        else:
+            # Only feeds the speculation stats, so an approximate count will do
+            input_tokens = estimate_tokens(llm_history_text(self.llm_history), self.model, approximate=True)
+            output_tokens = estimate_tokens("".join(self.parts), self.model, approximate=True)
+        return {
+            "model": self.model,
+            "chunks": len(self.parts),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost_cents": calculate_cost_cents(self.model, input_tokens, output_tokens),
+            "elapsed_ms": round((time.perf_counter() - self.started) * 1000),
+        }
+
+
+async def generate_chat_response(req: ChatRequest, user_id: str):
+    # Check subscription status and credits:
+    # 1. Active subscribers → unlimited access (no credit deduction)
+    # 2. Free users → use credits (100 free messages)
+    # --- Pre-generation stage: start every independent lookup at once ---
+    last_user_idx = find_last_user_index(req.history)
+    last_user_content = req.history[last_user_idx].content if last_user_idx != -1 else None
+    urls = extract_urls(last_user_content) if isinstance(last_user_content, str) else []
+
+    access_task = asyncio.create_task(asyncio.wait_for(
+        credit_cache.consume(user_id),
+        PREGEN_ACCESS_TIMEOUT,
+    ))
+
+    route_task = None
+    if req.model == "auto" and last_user_content:
+        route_task = asyncio.create_task(run_pregen_step(
+            route_to_best_model(last_user_content), PREGEN_ROUTER_TIMEOUT, "Router",
+            default=(ROUTING_MODELS["general"], "general"),
+        ))
+    # In speculative mode the router's verdict is only needed once the prompt is ready
+    speculate = route_task is not None and (req.speculative or SPECULATIVE_ROUTING)
+
+    url_task = None
+    if urls:
+        url_task = asyncio.create_task(run_pregen_step(
+            fetch_urls_from_text(last_user_content), PREGEN_URL_TIMEOUT, "URL fetching", default=[],
+        ))
+
+    async def rag_step(hybrid: Optional[bool], model: str):
+        # RAG searches the URL-rewritten message, so it is the one step that
+        # has to wait for another before it can start.
+        fetched = await url_task if url_task else []
+        query = build_url_message(last_user_content, fetched) if fetched else last_user_content
+        return await search_docs_context(user_id, query, hybrid, model)
+
+    rag_task = None
+    if req.search_docs and last_user_content:
+        rag_task = asyncio.create_task(run_pregen_step(
+            rag_step(req.hybrid_search, req.model), PREGEN_RAG_TIMEOUT + (PREGEN_URL_TIMEOUT if url_task else 0), "RAG search", default=("", []),
+        ))
+
+    profile_task = asyncio.create_task(run_pregen_step(
+        get_profile_context(user_id), PREGEN_PROFILE_TIMEOUT, "Profile retrieval", default="",
+    ))
+
+    therapy_task = None
+    if req.therapy_mode:
+        therapy_task = asyncio.create_task(run_pregen_step(
+            get_therapy_notes(user_id, limit=5), PREGEN_THERAPY_TIMEOUT, "Therapy notes", default="",
+        ))
+
+    pregen_tasks = [t for t in (access_task, route_task, url_task, rag_task, profile_task, therapy_task) if t]
+
+    try:
+        access_info = await access_task
+    except datastore.InsufficientCreditsError:
+        cancel_pending(pregen_tasks)
+        yield "data: ERROR: You've used all your free messages! Subscribe to continue and support Houseless Movement.\n\n"
+        yield "data: [DONE]\n\n"
+        return
+    except asyncio.TimeoutError:
+        cancel_pending(pregen_tasks)
+        print(f"Access check timed out after {PREGEN_ACCESS_TIMEOUT}s for user {user_id}")
+        yield "data: ERROR: Could not verify your account right now. Please try again.\n\n"
+        yield "data: [DONE]\n\n"
+        return
+    except asyncio.CancelledError:
+        cancel_pending(pregen_tasks)
+        raise
+
+    # Send a heartbeat immediately so the browser knows the stream is alive
+    yield ": ping\n\n"
+
+    routed_category = None
+    original_model = req.model  # Store for logging
+    speculation = None
+    speculation_log = None
+    try:
+        # --- Auto-routing: If model is "auto", use router to select best model ---
+        if not speculate:
+            routed_model = None
+            if req.model == "auto":
+                if route_task:
+                    routed_model, routed_category = await route_task
+                    print(f"Auto-routing: '{last_user_content[:50]}...' -> {routed_model} ({routed_category})")
+                else:
+                    # No user message, default to general
+                    routed_model = ROUTING_MODELS["general"]
+            req, model_events = resolve_model_request(
+                req, routed_model, routed_category, access_info["is_subscriber"], last_user_content
+            )
+            for event in model_events:
+                yield f"data: {json.dumps(event)}\n\n"
+
+        # --- URL fetching: content of links in the last user message ---
+        if url_task:
+            # Notify frontend that we're reading links
+            yield f"data: {json.dumps({'fetching_urls': urls})}\n\n"
+            fetched = await url_task
+            if fetched:
+                # Rewrite the last user message in-place so both regular & GPT-5 paths see it
+                new_history = list(req.history)
+                new_history[last_user_idx] = Message(role='user', content=build_url_message(last_user_content, fetched))
+                req = req.model_copy(update={"history": new_history})
+                yield f"data: {json.dumps({'fetched_urls': [f['url'] for f in fetched], 'cached_urls': [f['url'] for f in fetched if f.get('cached')]})}\n\n"
+
+        # --- RAG: Search user's documents for relevant context (only if enabled) ---
+        rag_context = ""
+        rag_sources = []  # Ordered list of unique filenames cited as [1], [2], ...
+        if rag_task:
+            rag_context, rag_sources = await rag_task
+            if rag_sources:
+                # Notify the frontend of the sources being used
+                yield f"data: {json.dumps({'rag_sources': rag_sources})}\n\n"
+
+        # --- User profile for personalization ---
+        profile_context = await profile_task
+
+        # --- Therapy session notes if therapy mode is active ---
+        therapy_notes_context = ""
+        if therapy_task:
+            therapy_notes_context = await therapy_task
+            if therapy_notes_context:
+                print(f"Loaded therapy notes for {user_id}")
+
+        system_content = build_system_content(req.therapy_mode, profile_context, therapy_notes_context)
+
+        # --- Speculative auto-routing: generate with the general model while the router decides ---
+        if speculate:
+            spec_req = None
+            if not route_task.done():
+                spec_req, _ = resolve_model_request(
+                    req, ROUTING_MODELS["general"], "general", access_info["is_subscriber"], last_user_content
+                )
+                if not is_gpt5_model(spec_req.model):
+                    spec_history, spec_llm_history = await build_llm_messages(spec_req, system_content, rag_context, rag_sources)
+                    speculation = SpeculativeStream(
+                        spec_req.model, get_llm(spec_req.model, spec_req.temperature), spec_llm_history
+                    )
+                    print(f"Speculating with {spec_req.model} while the router decides")
+
+            routed_model, routed_category = await route_task
+            print(f"Auto-routing: '{last_user_content[:50]}...' -> {routed_model} ({routed_category})")
+            req, model_events = resolve_model_request(
+                req, routed_model, routed_category, access_info["is_subscriber"], last_user_content
+            )
+
+            if speculation:
+                if req.model == spec_req.model and req.search_web == spec_req.search_web:
+                    print(f"Speculation hit: keeping {speculation.model} stream")
+                    router_stats.record_speculation(hit=True)
+                    speculation_log = {"speculation": "hit"}
+                else:
+                    wasted = await speculation.cancel()
+                    speculation = None
+                    print(f"Speculation miss: discarded {wasted['model']} stream ({wasted['output_tokens']} output tokens, {wasted['elapsed_ms']}ms)")
+                    router_stats.record_speculation(
+                        hit=False, wasted_tokens=wasted["output_tokens"], wasted_cost_cents=wasted["cost_cents"]
+                    )
+                    speculation_log = {"speculation": "miss", "speculation_wasted": wasted}
+
+            for event in model_events:
+                yield f"data: {json.dumps(event)}\n\n"
+    except BaseException:
+        if speculation:
+            speculation.abort()
+        raise
+    finally:
+        cancel_pending(pregen_tasks)
+
+    # Usage logging happens AFTER response generation (so we can capture output tokens)
+    # Store variables needed for logging
+    usage_log_data = {
+        "user_id": user_id,
+        "model": req.model,
+        "original_model": original_model,
+        "routed_category": routed_category,
+        "search_web": req.search_web,
+        "search_docs": req.search_docs,
+    }
+
+    # Check if this is a GPT-5 model that requires Responses API
+    if is_gpt5_model(req.model):
+        # For GPT-5 models, inject RAG context into request history
+        if rag_context:
+            # Create a modified request with RAG context
+            modified_history = list(req.history)
+            for i in range(len(modified_history) - 1, -1, -1):
+                if modified_history[i].role == 'user':
+                    original_query = modified_history[i].content
+                    modified_history[i] = Message(
+                        role='user',
+                        content=build_rag_prompt(original_query, rag_context, rag_sources)
+                    )
+                    break
+            req = req.model_copy(update={"history": modified_history})
+
+        # Use the Responses API for GPT-5 models
+        async for token in generate_gpt5_response(
+            req, user_id, profile_context,
+            original_model=usage_log_data["original_model"],
+            routed_category=usage_log_data["routed_category"],
+            therapy_notes=therapy_notes_context
+        ):
+            yield f"data: {token}\n\n"
+        yield "data: [DONE]\n\n"
+        return
+
+    if speculation:
+        history_messages, llm_history = spec_history, spec_llm_history
+        token_stream = speculation
+        stream_usage = speculation.usage
+    else:
+        llm = get_llm(req.model, req.temperature)
+        history_messages, llm_history = await build_llm_messages(req, system_content, rag_context, rag_sources)
+        stream_usage = {}
+        token_stream = astream_tokens(llm, llm_history, stream_usage)
+
     response_accum = ""
     try:
         try:
-            async for chunk in llm.astream(llm_history):
-                token = chunk.content if hasattr(chunk, 'content') else str(chunk)
+            async for token in token_stream:
                 response_accum += token
                 # Use JSON encoding to safely transport tokens with special characters
                 yield f"data: {json.dumps(token)}\n\n"
@@ -1498,28 +1633,27 @@ async def generate_chat_response(req: ChatRequest, user_id: str):
             yield f"data: {json.dumps(err_msg)}\n\n"
 
         final_history = history_messages + [{"role": "assistant", "content": response_accum}]
-        save_conversation(user_id, final_history)
+        await datastore.save_conversation(user_id, final_history)
 
         # Log usage with actual token counts and costs
-        input_text = "\n".join([
-            m.get('content', '') if isinstance(m.get('content'), str)
-            else ' '.join(b.get('text', '[image]') for b in m.get('content', []))
-            for m in llm_history
-        ])
-        log_usage_with_cost(
+        await log_usage_with_cost(
             user_id=usage_log_data["user_id"],
             model=usage_log_data["model"],
             original_model=usage_log_data["original_model"],
             routed_category=usage_log_data["routed_category"],
-            input_text=input_text,
+            input_text=llm_history_text(llm_history),
             output_text=response_accum,
             search_web=usage_log_data["search_web"],
             search_docs=usage_log_data["search_docs"],
+            extra_fields=speculation_log,
+            usage=stream_usage,
         )
 
     except asyncio.CancelledError:
         print("Stream cancelled by client.")
     finally:
+        if speculation:
+            speculation.abort()
         yield "data: [DONE]\n\n"
 
 @main_app.post("/chat_stream")
@@ -1556,7 +1690,7 @@ async def archive_chat(req: ArchiveRequest, user: dict = Depends(get_current_use
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         archive_id = f"chat_archive_{timestamp}.md"
 
-    db.collection("users").document(user_id).collection("archives").document(archive_id).set({
+    await datastore.set_archive(user_id, archive_id, {
         "projectName": project_name,
         "model": req.model,
         "messages": [msg.dict() for msg in req.history],
@@ -1603,7 +1737,7 @@ Respond ONLY with valid JSON, no markdown formatting."""
 
     try:
         # Use a capable model for note generation
-        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = llm_clients.get_openai_client()
         response = await client.chat.completions.create(
             model="gpt-5-mini-2025-08-07",
             messages=[
@@ -1635,7 +1769,7 @@ Respond ONLY with valid JSON, no markdown formatting."""
             "session_mood": notes_data.get("session_mood", "processing"),
         }
 
-        db.collection("users").document(user_id).collection("therapy_notes").add(doc_data)
+        await datastore.add_therapy_note(user_id, doc_data)
         print(f"Therapy notes saved for user {user_id}")
 
         return JSONResponse(content={"notes": doc_data, "message": "Session notes generated and saved."})
@@ -1654,19 +1788,16 @@ async def get_therapy_notes_endpoint(user: dict = Depends(get_current_user)):
     user_id = user["user_id"]
 
     try:
-        notes_ref = db.collection("users").document(user_id).collection("therapy_notes")
-        notes_query = notes_ref.order_by("created_at", direction=firestore.Query.DESCENDING)
-        notes = notes_query.get()
+        notes = await datastore.list_therapy_notes(user_id)
 
         result = []
-        for note in notes:
-            data = note.to_dict()
+        for note_id, data in notes:
             created_at = data.get("created_at")
             if hasattr(created_at, 'isoformat'):
                 data["created_at"] = created_at.isoformat()
             elif created_at:
                 data["created_at"] = str(created_at)
-            data["id"] = note.id
+            data["id"] = note_id
             result.append(data)
 
         return JSONResponse(content={"notes": result})
@@ -1724,11 +1855,10 @@ async def get_user_profile(user: dict = Depends(get_current_user)):
     """Get the user's curated profile."""
     user_id = user['user_id']
     try:
-        profile_ref = db.collection("users").document(user_id).collection("settings").document("profile")
-        profile_doc = profile_ref.get()
+        profile = await datastore.get_profile(user_id)
 
-        if profile_doc.exists:
-            return JSONResponse(content={"profile": profile_doc.to_dict()})
+        if profile:
+            return JSONResponse(content={"profile": profile})
         else:
             # Return empty profile structure
             return JSONResponse(content={"profile": {
@@ -1756,10 +1886,9 @@ async def update_user_profile(profile: UserProfile, user: dict = Depends(get_cur
     """Manually update the user's profile."""
     user_id = user['user_id']
     try:
-        profile_ref = db.collection("users").document(user_id).collection("settings").document("profile")
         profile_data = profile.model_dump()
         profile_data["last_updated"] = datetime.now().isoformat()
-        profile_ref.set(profile_data)
+        await datastore.set_profile(user_id, profile_data)
         return JSONResponse(content={"message": "Profile updated successfully", "profile": profile_data})
     except Exception as e:
         print(f"Error updating profile: {e}")
@@ -1777,14 +1906,13 @@ async def generate_user_profile(user: dict = Depends(get_current_user)):
 
     try:
         # Get existing profile to preserve fields
-        profile_ref = db.collection("users").document(user_id).collection("settings").document("profile")
-        existing_profile_doc = profile_ref.get()
-        existing_profile = existing_profile_doc.to_dict() if existing_profile_doc.exists else {}
+        existing_profile = await datastore.get_profile(user_id) or {}
 
         # Fetch archives
-        archives_ref = db.collection("users").document(user_id).collection("archives")
-        archives_list = list(archives_ref.order_by("archivedAt", direction=firestore.Query.DESCENDING).limit(50).stream())
-        total_archive_count = len(list(archives_ref.stream()))
+        archives_list, total_archive_count = await asyncio.gather(
+            datastore.list_recent_archives(user_id, limit=50),
+            datastore.count_archives(user_id),
+        )
 
         # Split into recent (for "currently") and all (for static profile)
         recent_archives = archives_list[:5]  # Last 5 for "currently"
@@ -1792,8 +1920,7 @@ async def generate_user_profile(user: dict = Depends(get_current_user)):
         # Extract conversation content
         def extract_conversations(archive_list, max_convs=30):
             conversations = []
-            for archive in archive_list:
-                data = archive.to_dict()
+            for _, data in archive_list:
                 messages = data.get("messages", [])
                 if messages:
                     conv_text = []
@@ -1815,7 +1942,7 @@ async def generate_user_profile(user: dict = Depends(get_current_user)):
                 "profile": None
             })
 
-        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = llm_clients.get_openai_client()
 
         # Check which static fields need filling
         static_fields = ['family', 'pets', 'work', 'background', 'location',
@@ -1921,7 +2048,7 @@ Focus on recent/current activities, not permanent traits. Return ONLY valid JSON
         profile_data["last_updated"] = datetime.now().isoformat()
         profile_data["last_archive_count"] = total_archive_count
 
-        profile_ref.set(profile_data)
+        await datastore.set_profile(user_id, profile_data)
 
         return JSONResponse(content={
             "message": "Profile generated successfully",
@@ -1945,16 +2072,13 @@ async def auto_generate_profile(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
 
     try:
-        # Get current profile
-        profile_ref = db.collection("users").document(user_id).collection("settings").document("profile")
-        profile_doc = profile_ref.get()
-
-        # Count total archives
-        archives_ref = db.collection("users").document(user_id).collection("archives")
-        total_archives = len(list(archives_ref.stream()))
+        # Get current profile and count total archives
+        profile, total_archives = await asyncio.gather(
+            datastore.get_profile(user_id),
+            datastore.count_archives(user_id),
+        )
 
-        if profile_doc.exists:
-            profile = profile_doc.to_dict()
+        if profile:
             last_archive_count = profile.get("last_archive_count", 0)
 
             # Only regenerate if 10+ new archives since last generation
@@ -2001,12 +2125,10 @@ async def auto_generate_profile(user: dict = Depends(get_current_user)):
 @main_app.get("/archives")
 async def get_archives(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
-    archives_ref = db.collection("users").document(user_id).collection("archives")
-    archives = archives_ref.stream()
+    archives = await datastore.list_archives(user_id)
 
     project_archives = {}
-    for archive in archives:
-        data = archive.to_dict()
+    for archive_id, data in archives:
         project = data.get("projectName", "General")
         if project not in project_archives:
             project_archives[project] = []
@@ -2041,10 +2163,10 @@ async def get_archives(user: dict = Depends(get_current_user)):
                     break
 
         project_archives[project].append({
-            "id": archive.id,
+            "id": archive_id,
             "model": data.get("model"),
             "archivedAt": archived_at,
-            "title": title or archive.id.replace(".md", ""),
+            "title": title or archive_id.replace(".md", ""),
             "preview": preview or "No preview available",
             "messageCount": len(messages)
         })
@@ -2056,19 +2178,16 @@ async def get_projects(user: dict = Depends(get_current_user)):
     """Get all projects with their chats and documents organized together."""
     user_id = user['user_id']
     try:
-        # Get archives
-        archives_ref = db.collection("users").document(user_id).collection("archives")
-        archives = archives_ref.stream()
-
-        # Get documents
-        docs_ref = db.collection("users").document(user_id).collection("documents")
-        docs = docs_ref.stream()
+        # Get archives and documents
+        archives, docs = await asyncio.gather(
+            datastore.list_archives(user_id),
+            datastore.list_documents(user_id),
+        )
 
         projects = {}
 
         # Process archives
-        for archive in archives:
-            data = archive.to_dict()
+        for archive_id, data in archives:
             project = data.get("projectName", "General")
             if project not in projects:
                 projects[project] = {"chats": [], "documents": []}
@@ -2078,15 +2197,14 @@ async def get_projects(user: dict = Depends(get_current_user)):
                 archived_at = archived_at.isoformat()
 
             projects[project]["chats"].append({
-                "id": archive.id,
+                "id": archive_id,
                 "model": data.get("model"),
                 "archivedAt": archived_at,
                 "type": "chat"
             })
 
         # Process documents
-        for doc in docs:
-            data = doc.to_dict()
+        for _, data in docs:
             project = data.get("projectName", "General")
             if project not in projects:
                 projects[project] = {"chats": [], "documents": []}
@@ -2114,12 +2232,10 @@ async def get_projects(user: dict = Depends(get_current_user)):
 async def get_archive_content(archive_id: str, user: dict = Depends(get_current_user)):
     user_id = user['user_id']
     try:
-        doc_ref = db.collection("users").document(user_id).collection("archives").document(archive_id)
-        doc = doc_ref.get()
-        if not doc.exists:
+        data = await datastore.get_archive(user_id, archive_id)
+        if data is None:
             raise HTTPException(status_code=404, detail="Archive not found")
-        
-        data = doc.to_dict()
+
         # Convert timestamp to string before sending
         archived_at = data.get("archivedAt")
         if archived_at and hasattr(archived_at, 'isoformat'):
@@ -2133,12 +2249,10 @@ async def get_archive_content(archive_id: str, user: dict = Depends(get_current_
 async def get_documents(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
     try:
-        docs_ref = db.collection("users").document(user_id).collection("documents").order_by("uploadedAt", direction=Query.DESCENDING)
-        docs = docs_ref.stream()
+        docs = await datastore.list_documents(user_id, newest_first=True)
         
         project_documents = {}
-        for doc in docs:
-            data = doc.to_dict()
+        for _, data in docs:
             project = data.get("projectName", "General")  # Default to "General" for existing docs
             
             if project not in project_documents:
@@ -2157,11 +2271,7 @@ async def get_documents(user: dict = Depends(get_current_user)):
 @main_app.get("/history")
 async def get_history(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
-    doc_ref = db.collection("users").document(user_id).collection("conversations").document("current_chat")
-    doc = doc_ref.get()
-    if doc.exists:
-        return JSONResponse(content=doc.to_dict().get("messages", []))
-    return JSONResponse(content=[])
+    return JSONResponse(content=await datastore.get_conversation(user_id))
 
 @main_app.get("/documents/indexed")
 async def get_indexed_documents(user: dict = Depends(get_current_user)):
@@ -2180,16 +2290,15 @@ async def get_indexed_documents(user: dict = Depends(get_current_user)):
 @main_app.get("/user/credits")
 async def get_user_credits(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
-    user_ref = db.collection("users").document(user_id)
-    user_snapshot = user_ref.get()
+    user_data = await datastore.get_user(user_id)
 
-    if not user_snapshot.exists:
+    if user_data is None:
         # This case should ideally not happen if user has interacted at least once.
         # But as a fallback, we can say they have the initial free credits.
         return JSONResponse(content={"credits": 100})
 
-    user_data = user_snapshot.to_dict()
-    credits = user_data.get("credits", 0)
+    # Include credits this worker has leased but the user hasn't spent yet
+    credits = user_data.get("credits", 0) + credit_cache.unspent_credits(user_id)
     return JSONResponse(content={"credits": credits})
 
 
@@ -2201,17 +2310,14 @@ async def get_user_billing(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
 
     try:
-        # Get user data
-        user_ref = db.collection("users").document(user_id)
-        user_snapshot = user_ref.get()
-        user_data = user_snapshot.to_dict() if user_snapshot.exists else {}
-
-        # Get current month's usage
+        # Get user data and current month's usage
         now = datetime.now()
         month_key = now.strftime("%Y-%m")
-        monthly_ref = db.collection("user_monthly_usage").document(f"{user_id}_{month_key}")
-        monthly_snapshot = monthly_ref.get()
-        monthly_data = monthly_snapshot.to_dict() if monthly_snapshot.exists else {}
+        user_data, monthly_data = await asyncio.gather(
+            datastore.get_user(user_id),
+            datastore.get_monthly_usage(user_id, month_key),
+        )
+        user_data = user_data or {}
 
         # Get subscription info
         subscription_amount_cents = user_data.get("subscription_amount", 2000)  # Default $20
@@ -2236,8 +2342,9 @@ async def get_user_billing(user: dict = Depends(get_current_user)):
         usage_warning = current_month_ai_cost_cents >= (subscription_amount_cents * 0.8)
 
         # Get free messages remaining for non-subscribers
-        free_messages_remaining = user_data.get("credits", 100) if subscription_status != "active" else None
-        free_messages_used = user_data.get("credits_used", 0)
+        unspent_leased = credit_cache.unspent_credits(user_id)
+        free_messages_remaining = user_data.get("credits", 100) + unspent_leased if subscription_status != "active" else None
+        free_messages_used = user_data.get("credits_used", 0) - unspent_leased
 
         return JSONResponse(content={
             "subscription": {
@@ -2283,18 +2390,15 @@ async def get_user_subscription(user: dict = Depends(get_current_user)):
     user_id = user['user_id']
 
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_snapshot = user_ref.get()
+        user_data = await datastore.get_user(user_id)
 
-        if not user_snapshot.exists:
+        if user_data is None:
             return JSONResponse(content={
                 "status": "none",
                 "amount_cents": 0,
                 "stripe_customer_id": None,
             })
 
-        user_data = user_snapshot.to_dict()
-
         # Convert Firestore timestamp to ISO string if present
         current_period_end = user_data.get("subscription_current_period_end")
         if current_period_end:
@@ -2343,9 +2447,7 @@ async def create_stripe_checkout(
         amount_cents = max(req.amount_cents, 2000)
 
         # Check if user already has a Stripe customer ID
-        user_ref = db.collection("users").document(user_id)
-        user_snapshot = user_ref.get()
-        user_data = user_snapshot.to_dict() if user_snapshot.exists else {}
+        user_data = await datastore.get_user(user_id) or {}
         stripe_customer_id = user_data.get("stripe_customer_id")
 
         # Create or retrieve Stripe customer
@@ -2356,7 +2458,7 @@ async def create_stripe_checkout(
             )
             stripe_customer_id = customer.id
             # Save customer ID
-            user_ref.set({"stripe_customer_id": stripe_customer_id}, merge=True)
+            await datastore.set_user(user_id, {"stripe_customer_id": stripe_customer_id})
 
         # Create checkout session with variable pricing
         # Using a price_data approach for flexible amounts
@@ -2412,16 +2514,13 @@ async def create_stripe_portal(req: PortalRequest = None, user: dict = Depends(g
     user_id = user['user_id']
 
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_snapshot = user_ref.get()
+        user_data = await datastore.get_user(user_id)
 
-        if not user_snapshot.exists:
+        if user_data is None:
             return JSONResponse(
                 status_code=404,
                 content={"error": "User not found"}
             )
-
-        user_data = user_snapshot.to_dict()
         stripe_customer_id = user_data.get("stripe_customer_id")
 
         if not stripe_customer_id:
@@ -2471,16 +2570,13 @@ async def update_stripe_subscription(req: UpdateSubscriptionRequest, user: dict
     user_id = user['user_id']
 
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_snapshot = user_ref.get()
+        user_data = await datastore.get_user(user_id)
 
-        if not user_snapshot.exists:
+        if user_data is None:
             return JSONResponse(
                 status_code=404,
                 content={"error": "User not found"}
             )
-
-        user_data = user_snapshot.to_dict()
         subscription_id = user_data.get("stripe_subscription_id")
 
         if not subscription_id:
@@ -2536,7 +2632,7 @@ async def update_stripe_subscription(req: UpdateSubscriptionRequest, user: dict
         )
 
         # Update Firestore with new amount
-        user_ref.update({
+        await datastore.update_user(user_id, {
             "subscription_amount": req.amount_cents,
         })
 
@@ -2599,14 +2695,15 @@ async def stripe_webhook(request: Request):
                 # Get subscription details
                 subscription = stripe.Subscription.retrieve(subscription_id)
 
-                db.collection("users").document(user_id).set({
+                await datastore.set_user(user_id, {
                     "stripe_customer_id": customer_id,
                     "stripe_subscription_id": subscription_id,
                     "subscription_status": "active",
                     "subscription_amount": amount_cents,
                     "subscription_started_at": firestore.SERVER_TIMESTAMP,
                     "subscription_current_period_end": datetime.fromtimestamp(subscription.current_period_end),
-                }, merge=True)
+                })
+                await credit_cache.invalidate(user_id)
 
                 print(f"Subscription activated for user {user_id}: ${amount_cents/100}")
 
@@ -2616,49 +2713,51 @@ async def stripe_webhook(request: Request):
             customer_id = data.get("customer")
 
             # Find user by customer ID
-            users = db.collection("users").where("stripe_customer_id", "==", customer_id).limit(1).get()
+            found = await datastore.find_user_by_stripe_customer(customer_id)
 
-            for user_doc in users:
-                user_doc.reference.update({
+            if found:
+                user_id, _ = found
+                await datastore.update_user(user_id, {
                     "subscription_status": status,
                     "subscription_current_period_end": datetime.fromtimestamp(data.get("current_period_end", 0)),
                 })
-                print(f"Subscription updated for {user_doc.id}: {status}")
+                await credit_cache.invalidate(user_id)
+                print(f"Subscription updated for {user_id}: {status}")
 
         elif event_type == "customer.subscription.deleted":
             customer_id = data.get("customer")
 
             # Find user by customer ID
-            users = db.collection("users").where("stripe_customer_id", "==", customer_id).limit(1).get()
+            found = await datastore.find_user_by_stripe_customer(customer_id)
 
-            for user_doc in users:
-                user_doc.reference.update({
+            if found:
+                user_id, _ = found
+                await datastore.update_user(user_id, {
                     "subscription_status": "canceled",
                 })
-                print(f"Subscription canceled for {user_doc.id}")
+                await credit_cache.invalidate(user_id)
+                print(f"Subscription canceled for {user_id}")
 
         elif event_type == "invoice.paid":
             customer_id = data.get("customer")
             amount_paid = data.get("amount_paid", 0)
 
             # Find user and update charity tracking
-            users = db.collection("users").where("stripe_customer_id", "==", customer_id).limit(1).get()
+            found = await datastore.find_user_by_stripe_customer(customer_id)
 
-            for user_doc in users:
+            if found:
                 # Get current month's AI cost to calculate charity portion
-                user_id = user_doc.id
+                user_id, _ = found
                 month_key = datetime.now().strftime("%Y-%m")
-                monthly_ref = db.collection("user_monthly_usage").document(f"{user_id}_{month_key}")
-                monthly_snapshot = monthly_ref.get()
-                monthly_data = monthly_snapshot.to_dict() if monthly_snapshot.exists else {}
+                monthly_data = await datastore.get_monthly_usage(user_id, month_key)
                 ai_cost = monthly_data.get("total_ai_cost_cents", 0)
 
                 charity_amount = max(0, amount_paid - ai_cost)
 
-                user_doc.reference.set({
+                await datastore.set_user(user_id, {
                     "all_time_charity_cents": firestore.Increment(charity_amount),
                     "last_payment_at": firestore.SERVER_TIMESTAMP,
-                }, merge=True)
+                })
 
                 print(f"Invoice paid for {user_id}: ${amount_paid/100}, charity: ${charity_amount/100}")
 
@@ -2852,7 +2951,6 @@ async def upload_file(user: dict = Depends(get_current_user), file: UploadFile =
             indexing_error = str(e)
 
         # Save metadata to Firestore
-        doc_ref = db.collection("users").document(user_id).collection("documents").document(file.filename)
         doc_data = {
             "storagePath": file_path,
             "filename": file.filename,
@@ -2864,7 +2962,7 @@ async def upload_file(user: dict = Depends(get_current_user), file: UploadFile =
             "chunkCount": indexed_chunks,
             "indexingError": indexing_error
         }
-        doc_ref.set(doc_data)
+        await datastore.set_document(user_id, file.filename, doc_data)
 
         # We can't get the server timestamp back immediately without another read,
         # so we'll approximate it for the response. The value in the DB will be accurate.
@@ -2879,9 +2977,9 @@ async def upload_file(user: dict = Depends(get_current_user), file: UploadFile =
         }
         
         # Append a notification to the current conversation
-        history = get_conversation(user_id)
+        history = await datastore.get_conversation(user_id)
         history.append(context_message)
-        save_conversation(user_id, history)
+        await datastore.save_conversation(user_id, history)
         
         return JSONResponse(content={
             "message": f"File '{file.filename}' uploaded successfully.", 
@@ -2902,11 +3000,9 @@ async def get_document_content(filename: str, user: dict = Depends(get_current_u
     user_id = user['user_id']
     try:
         # Lookup the document metadata to confirm it exists and get storage path
-        doc_ref = db.collection("users").document(user_id).collection("documents").document(filename)
-        doc_snapshot = doc_ref.get()
-        if not doc_snapshot.exists:
+        doc_data = await datastore.get_document(user_id, filename)
+        if doc_data is None:
             raise HTTPException(status_code=404, detail="Document not found.")
-        doc_data = doc_snapshot.to_dict()
         storage_path = doc_data["storagePath"]
 
         blob = bucket.blob(storage_path)
@@ -2941,13 +3037,10 @@ async def get_document_content(filename: str, user: dict = Depends(get_current_u
 async def delete_archive(archive_id: str, user: dict = Depends(get_current_user)):
     user_id = user['user_id']
     try:
-        doc_ref = db.collection("users").document(user_id).collection("archives").document(archive_id)
-        
-        # Check if the document exists before trying to delete
-        if not doc_ref.get().exists:
+        # Returns False if the archive didn't exist
+        if not await datastore.delete_archive(user_id, archive_id):
             raise HTTPException(status_code=404, detail="Archive not found.")
 
-        doc_ref.delete()
         return JSONResponse(content={"message": f"Archive '{archive_id}' deleted successfully."})
     except HTTPException:
         raise
@@ -2959,13 +3052,9 @@ async def delete_document(filename: str, user: dict = Depends(get_current_user))
     user_id = user['user_id']
     try:
         # First, delete the Firestore metadata document
-        doc_ref = db.collection("users").document(user_id).collection("documents").document(filename)
-        doc_snapshot = doc_ref.get()
-        if not doc_snapshot.exists:
+        if not await datastore.delete_document(user_id, filename):
             raise HTTPException(status_code=404, detail="Document metadata not found.")
 
-        doc_ref.delete()
-
         # Second, delete the actual file from Cloud Storage
         storage_path = f"{user_id}/documents/{filename}"
         blob = bucket.blob(storage_path)
@@ -2994,12 +3083,10 @@ async def download_document(filename: str, user: dict = Depends(get_current_user
 
     try:
         # Verify document exists in Firestore
-        doc_ref = db.collection("users").document(user_id).collection("documents").document(filename)
-        doc_snapshot = doc_ref.get()
-        if not doc_snapshot.exists:
+        doc_data = await datastore.get_document(user_id, filename)
+        if doc_data is None:
             raise HTTPException(status_code=404, detail="Document not found.")
 
-        doc_data = doc_snapshot.to_dict()
         storage_path = doc_data.get("storagePath", f"{user_id}/documents/{filename}")
 
         # Get blob and generate signed URL
@@ -3025,20 +3112,6 @@ async def download_document(filename: str, user: dict = Depends(get_current_user
         raise HTTPException(status_code=500, detail=f"Failed to generate download link: {e}")
 
 
-# --- Firestore Data Functions ---
-def get_conversation(user_id: str) -> List[dict]:
-    """Loads the current conversation history from Firestore."""
-    doc_ref = db.collection("users").document(user_id).collection("conversations").document("current_chat")
-    doc = doc_ref.get()
-    if doc.exists:
-        return doc.to_dict().get("messages", [])
-    return []
-
-def save_conversation(user_id: str, messages: List[dict]):
-    """Saves the entire conversation history to Firestore."""
-    doc_ref = db.collection("users").document(user_id).collection("conversations").document("current_chat")
-    doc_ref.set({"messages": messages, "updatedAt": firestore.SERVER_TIMESTAMP})
-
 async def get_current_admin_user(user: dict = Depends(get_current_user)):
     """Verifies that the current user is an admin."""
     # The 'admin' claim is set by the set_admin.py script
@@ -3063,8 +3136,11 @@ async def list_users(_: dict = Depends(get_current_admin_user)):
     """Lists all users from Firebase Auth and merges with Firestore data."""
     try:
         # Get all users from Firebase Authentication
-        auth_users = firebase_auth.list_users().iterate_all()
-        
+        auth_users = list(firebase_auth.list_users().iterate_all())
+
+        # Fetch credit data from Firestore in one batched read
+        firestore_users = await datastore.get_users([user.uid for user in auth_users])
+
         users_list = []
         for user in auth_users:
             user_data = {
@@ -3076,10 +3152,8 @@ async def list_users(_: dict = Depends(get_current_admin_user)):
                 "credits_used": 0 # Default used credits
             }
             
-            # Fetch credit data from Firestore
-            user_doc = db.collection("users").document(user.uid).get()
-            if user_doc.exists:
-                firestore_data = user_doc.to_dict()
+            firestore_data = firestore_users.get(user.uid)
+            if firestore_data:
                 user_data["credits"] = firestore_data.get("credits", 0)
                 user_data["credits_used"] = firestore_data.get("credits_used", 0)
                 user_data["subscriptionStatus"] = firestore_data.get("subscription_status", "none")
@@ -3093,8 +3167,7 @@ async def list_users(_: dict = Depends(get_current_admin_user)):
 @main_app.post("/admin/users/{user_id}/credits")
 async def update_user_credits(user_id: str, credit_update: CreditUpdate, _: dict = Depends(get_current_admin_user)):
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_ref.set({"credits": firestore.Increment(credit_update.amount)}, merge=True)
+        await datastore.set_user(user_id, {"credits": firestore.Increment(credit_update.amount)})
         return JSONResponse(content={"message": f"Credits for user {user_id} updated successfully."})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -3117,8 +3190,9 @@ async def update_user(user_id: str, user_update: UserUpdate, _: dict = Depends(g
 
         # Update credits in Firestore
         if user_update.credits is not None:
-            user_ref = db.collection("users").document(user_id)
-            user_ref.set({"credits": user_update.credits}, merge=True)
+            await datastore.set_user(user_id, {"credits": user_update.credits})
+            # The new balance replaces any leased credits
+            await credit_cache.invalidate(user_id, return_unused=False)
 
         # Update admin status in Firebase Auth custom claims
         if user_update.is_admin is not None:
@@ -3132,21 +3206,9 @@ async def update_user(user_id: str, user_update: UserUpdate, _: dict = Depends(g
 async def admin_delete_user(user_id: str, _: dict = Depends(get_current_admin_user)):
     """Permanently delete a user and all their data."""
     try:
-        # Delete from Firestore - user document and subcollections
-        user_ref = db.collection("users").document(user_id)
-
-        # Delete subcollections (archives, conversations, documents)
-        for subcollection_name in ['archives', 'conversations', 'documents']:
-            try:
-                subcollection = user_ref.collection(subcollection_name)
-                docs = list(subcollection.stream())
-                for doc in docs:
-                    doc.reference.delete()
-            except Exception as sub_err:
-                print(f"Error deleting {subcollection_name} for {user_id}: {sub_err}")
-
-        # Delete the user document itself
-        user_ref.delete()
+        # Delete from Firestore - user document and subcollections (archives, conversations, documents)
+        await credit_cache.invalidate(user_id, return_unused=False)
+        await datastore.delete_user_data(user_id)
 
         # Delete from Firebase Auth (this must be last as it invalidates the user)
         firebase_auth.delete_user(user_id)
@@ -3161,11 +3223,11 @@ async def admin_delete_user(user_id: str, _: dict = Depends(get_current_admin_us
 async def set_user_paid(user_id: str, _: dict = Depends(get_current_admin_user)):
     """Manually mark a user as a paid subscriber (bypasses Stripe)."""
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_ref.set({
+        await datastore.set_user(user_id, {
             "subscription_status": "active",
             "subscription_started_at": firestore.SERVER_TIMESTAMP,
-        }, merge=True)
+        })
+        await credit_cache.invalidate(user_id)
         print(f"Admin manually set user {user_id} as paid")
         return {"message": "User marked as paid subscriber"}
     except Exception as e:
@@ -3175,10 +3237,10 @@ async def set_user_paid(user_id: str, _: dict = Depends(get_current_admin_user))
 async def set_user_free(user_id: str, _: dict = Depends(get_current_admin_user)):
     """Manually revert a user to free tier."""
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_ref.set({
+        await datastore.set_user(user_id, {
             "subscription_status": "none",
-        }, merge=True)
+        })
+        await credit_cache.invalidate(user_id)
         print(f"Admin manually set user {user_id} as free")
         return {"message": "User reverted to free tier"}
     except Exception as e:
@@ -3188,10 +3250,8 @@ async def set_user_free(user_id: str, _: dict = Depends(get_current_admin_user))
 async def unsubscribe_user(user_id: str, _: dict = Depends(get_current_admin_user)):
     """Unsubscribe a user from all system emails."""
     try:
-        user_ref = db.collection("users").document(user_id)
-
         # Set all email preferences to False
-        user_ref.set({
+        await datastore.set_user(user_id, {
             "email_preferences": {
                 "feature_updates": False,
                 "bug_fixes": False,
@@ -3199,7 +3259,7 @@ async def unsubscribe_user(user_id: str, _: dict = Depends(get_current_admin_use
                 "usage_tips": False,
                 "charity_updates": False
             }
-        }, merge=True)
+        })
 
         print(f"User {user_id} unsubscribed from all emails")
         return {"message": "User unsubscribed from all emails"}
@@ -3214,8 +3274,7 @@ async def debug_user_credits(user_id: str, _: dict = Depends(get_current_admin_u
     """
     try:
         # Get user data from Firestore
-        user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
+        user_data = await datastore.get_user(user_id)
         
         # Get user data from Firebase Auth
         auth_user_data = None
@@ -3231,24 +3290,16 @@ async def debug_user_credits(user_id: str, _: dict = Depends(get_current_admin_u
         except Exception as auth_error:
             print(f"Auth error for user {user_id}: {auth_error}")
 
-        # Simulate the credit check logic
-        transaction = db.transaction()
-        
-        @firestore.transactional
-        def simulate_credit_check(transaction: Transaction, user_ref):
-            user_snapshot = user_ref.get(transaction=transaction)
-            
-            if not user_snapshot.exists:
-                return {
-                    "status": "new_user",
-                    "would_get_initial_credits": True,
-                    "initial_credits_amount": 100
-                }
-            
-            user_data = user_snapshot.to_dict()
+        # Simulate the credit check logic (read-only, so no transaction needed)
+        if user_data is None:
+            credit_simulation = {
+                "status": "new_user",
+                "would_get_initial_credits": True,
+                "initial_credits_amount": 100
+            }
+        else:
             credits = user_data.get("credits", 0)
-            
-            return {
+            credit_simulation = {
                 "status": "existing_user",
                 "current_credits": credits,
                 "credits_type": type(credits).__name__,
@@ -3256,8 +3307,6 @@ async def debug_user_credits(user_id: str, _: dict = Depends(get_current_admin_u
                 "credits_after_use": credits - 1 if credits > 0 else credits
             }
         
-        credit_simulation = simulate_credit_check(transaction, user_ref)
-        
         # Prepare response
         debug_info = {
             "user_id": user_id,
@@ -3267,8 +3316,8 @@ async def debug_user_credits(user_id: str, _: dict = Depends(get_current_admin_u
                 "data": auth_user_data
             },
             "firestore": {
-                "document_exists": user_doc.exists,
-                "raw_data": user_doc.to_dict() if user_doc.exists else None
+                "document_exists": user_data is not None,
+                "raw_data": user_data
             },
             "credit_simulation": credit_simulation,
             "diagnosis": {
@@ -3278,7 +3327,7 @@ async def debug_user_credits(user_id: str, _: dict = Depends(get_current_admin_u
         }
         
         # Determine likely issues and recommendations
-        if not user_doc.exists:
+        if user_data is None:
             debug_info["diagnosis"]["likely_issue"] = "User document doesn't exist in Firestore"
             debug_info["diagnosis"]["recommendations"] = [
                 "User should make their first request to create the document with initial 100 credits",
@@ -3313,6 +3362,7 @@ async def debug_credits_summary(_: dict = Depends(get_current_admin_user)):
     try:
         # Get all users from Firebase Auth (limit to 100 for performance)
         auth_users = firebase_auth.list_users(max_results=100).users
+        firestore_users = await datastore.get_users([user.uid for user in auth_users])
         
         summary = {
             "total_users_checked": len(auth_users),
@@ -3326,13 +3376,11 @@ async def debug_credits_summary(_: dict = Depends(get_current_admin_user)):
         
         for user in auth_users:
             try:
-                user_ref = db.collection("users").document(user.uid)
-                user_doc = user_ref.get()
+                user_data = firestore_users.get(user.uid)
                 
-                if not user_doc.exists:
+                if user_data is None:
                     summary["users_no_firestore_data"] += 1
                 else:
-                    user_data = user_doc.to_dict()
                     credits = user_data.get("credits", 0)
                     
                     if isinstance(credits, (int, float)):
@@ -3377,17 +3425,17 @@ async def fix_user_credits(user_id: str, credit_amount: int, _: dict = Depends(g
         if credit_amount < 0:
             raise HTTPException(status_code=400, detail="Credit amount must be non-negative")
         
-        user_ref = db.collection("users").document(user_id)
-        user_ref.set({
+        await datastore.set_user(user_id, {
             "credits": credit_amount,
             "credits_fixed_at": firestore.SERVER_TIMESTAMP,
             "credits_fixed_by": "admin_debug_endpoint"
-        }, merge=True)
+        })
+        await credit_cache.invalidate(user_id, return_unused=False)
         
         # Verify the fix
-        updated_doc = user_ref.get()
-        if updated_doc.exists:
-            updated_credits = updated_doc.to_dict().get("credits")
+        updated_data = await datastore.get_user(user_id)
+        if updated_data is not None:
+            updated_credits = updated_data.get("credits")
             return JSONResponse(content={
                 "message": f"Credits fixed successfully",
                 "user_id": user_id,
@@ -3407,73 +3455,52 @@ async def fix_user_credits(user_id: str, credit_amount: int, _: dict = Depends(g
 
 # Cost estimates per request (in dollars, based on ~2K tokens average)
 # Formula: (input_price * 1K + output_price * 1K) / 1M = cost per 2K tokens
-MODEL_COSTS = {
-    # OpenAI GPT-5 family
-    "gpt-5-nano": 0.0005,       # $0.05 input / $0.40 output
-    "gpt-5-mini": 0.002,        # $0.25 input / $2.00 output
-    "gpt-5.2-codex": 0.016,     # $1.75 input / $14.00 output (coding-optimized)
-    "gpt-5.2-pro": 0.19,        # $21.00 input / $168.00 output (premium)
-    "gpt-5.2": 0.016,           # $1.75 input / $14.00 output (flagship)
-    # Anthropic Claude
-    "claude-opus-4-6": 0.03,   # $5 input / $25 output (flagship)
-    "claude-opus-4-5": 0.03,   # $5 input / $25 output (legacy)
-    "claude-sonnet": 0.018,    # $3 input / $15 output
-    "claude-haiku": 0.006,     # $1 input / $5 output
-    # Google Gemini
-    "gemini-3.1-pro": 0.014,  # $2 input / $12 output - newest reasoning
-    "gemini-3-pro": 0.014,  # $2 input / $12 output - best multimodal
-    "gemini-3-flash": 0.004, # $0.50 input / $3.00 output - fast frontier
-    "gemini-2.5-pro": 0.011,# $1.25 input / $10 output - coding/reasoning
-    "gemini-2.5-flash": 0.003, # $0.30 input / $2.50 output - hybrid reasoning
-    "gemini-2.5-flash-lite": 0.0005, # $0.10 input / $0.40 output - ultra cheap
-    # Perplexity
-    "sonar-pro": 0.01,
-}
+# Derived from cost_tracker's pricing index so prices live in one place.
+def _cost_per_request(pricing: dict) -> float:
+    return round((pricing["input"] * 1000 + pricing["output"] * 1000) / 1_000_000, 4)
+
 
 def estimate_cost(model: str, request_count: int) -> float:
     """Estimate cost for a model based on request count."""
-    for prefix, cost in MODEL_COSTS.items():
-        if model.startswith(prefix):
-            return request_count * cost
-    return 0.0  # Unknown model
+    pricing = PRICING_INDEX.lookup(model)
+    if pricing is None:
+        return 0.0  # Unknown model
+    return request_count * _cost_per_request(pricing)
 
 @main_app.get("/admin/analytics/overview")
 async def get_analytics_overview(_: dict = Depends(get_current_admin_user)):
-    """Get high-level usage statistics."""
+    """Get high-level usage statistics (from the daily and per-model rollups)."""
     try:
         today = datetime.now().strftime("%Y-%m-%d")
         week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
         month_ago = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
 
-        usage_logs = db.collection("usage_logs")
-
-        # Get all logs (for total count)
-        all_logs = list(usage_logs.stream())
-        total_requests = len(all_logs)
+        # One doc per day for the last 30 days plus one doc per model
+        days, model_rollups = await asyncio.gather(
+            datastore.list_daily_rollups(since_date_key=month_ago),
+            datastore.list_model_rollups(),
+        )
 
         # Count by date ranges
         today_count = 0
         week_count = 0
         month_count = 0
-        model_counts = {}
-        unique_users_today = set()
-
-        for log in all_logs:
-            data = log.to_dict()
-            date_key = data.get("date_key", "")
-            model = data.get("model", "unknown")
-            user_id = data.get("user_id", "")
+        active_users_today = 0
 
-            # Count by model
-            model_counts[model] = model_counts.get(model, 0) + 1
+        for day in days:
+            date_key = day.get("date", "")
+            requests = day.get("total_requests", 0)
 
             if date_key == today:
-                today_count += 1
-                unique_users_today.add(user_id)
+                today_count += requests
+                active_users_today = len(day.get("users", {}))
             if date_key >= week_ago:
-                week_count += 1
-            if date_key >= month_ago:
-                month_count += 1
+                week_count += requests
+            month_count += requests
+
+        # All-time totals by model
+        model_counts = {m.get("model", "unknown"): m.get("total_requests", 0) for m in model_rollups}
+        total_requests = sum(model_counts.values())
 
         # Find top model
         top_model = max(model_counts, key=model_counts.get) if model_counts else "N/A"
@@ -3484,7 +3511,7 @@ async def get_analytics_overview(_: dict = Depends(get_current_admin_user)):
             "total_requests_today": today_count,
             "total_requests_this_week": week_count,
             "total_requests_this_month": month_count,
-            "active_users_today": len(unique_users_today),
+            "active_users_today": active_users_today,
             "top_model": top_model,
             "top_model_requests": top_model_count
         }
@@ -3499,31 +3526,29 @@ async def get_daily_analytics(
 ):
     """Get daily request counts for the past N days. Use days=0 for all time."""
     try:
-        usage_logs = db.collection("usage_logs")
-
         if days == 0:
             # All time - no date filter
-            logs = list(usage_logs.stream())
+            rollups = await datastore.list_daily_rollups()
         else:
             start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-            logs = list(usage_logs.where("date_key", ">=", start_date).stream())
-
-        # Aggregate by date
-        daily_data = {}
-        for log in logs:
-            data = log.to_dict()
-            date_key = data.get("date_key", "")
-            model = data.get("model", "unknown")
-
-            if date_key not in daily_data:
-                daily_data[date_key] = {"date": date_key, "total_requests": 0, "requests_by_model": {}}
-
-            daily_data[date_key]["total_requests"] += 1
-            daily_data[date_key]["requests_by_model"][model] = daily_data[date_key]["requests_by_model"].get(model, 0) + 1
-
-        # Sort by date
-        result = sorted(daily_data.values(), key=lambda x: x["date"])
-        return result
+            rollups = await datastore.list_daily_rollups(since_date_key=start_date)
+
+        # Already sorted by date
+        return [
+            {
+                "date": day.get("date", ""),
+                "total_requests": day.get("total_requests", 0),
+                "requests_by_model": {
+                    model: totals.get("total_requests", 0)
+                    for model, totals in day.get("by_model", {}).items()
+                },
+                "unique_users": len(day.get("users", {})),
+                "input_tokens": day.get("input_tokens", 0),
+                "output_tokens": day.get("output_tokens", 0),
+                "cost_cents": day.get("cost_cents", 0),
+            }
+            for day in rollups
+        ]
     except Exception as e:
         print(f"Daily analytics error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get daily analytics: {str(e)}")
@@ -3535,35 +3560,38 @@ async def get_model_analytics(
 ):
     """Get usage breakdown by model with cost estimates. Use days=0 for all time."""
     try:
-        usage_logs = db.collection("usage_logs")
-
+        # Aggregate by model
+        model_totals = {}
         if days == 0:
-            # All time - no date filter
-            logs = list(usage_logs.stream())
+            # All time - one rollup doc per model
+            for rollup in await datastore.list_model_rollups():
+                model_totals[rollup.get("model", "unknown")] = {**rollup, "users": set(rollup.get("users", {}))}
         else:
             start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-            logs = list(usage_logs.where("date_key", ">=", start_date).stream())
-
-        # Aggregate by model
-        model_counts = {}
-        total_requests = 0
+            for day in await datastore.list_daily_rollups(since_date_key=start_date):
+                for model, totals in day.get("by_model", {}).items():
+                    merged = model_totals.setdefault(model, {})
+                    for field in ("total_requests", "input_tokens", "output_tokens", "cost_cents"):
+                        merged[field] = merged.get(field, 0) + totals.get(field, 0)
+                    merged.setdefault("users", set()).update(totals.get("users", {}))
 
-        for log in logs:
-            data = log.to_dict()
-            model = data.get("model", "unknown")
-            model_counts[model] = model_counts.get(model, 0) + 1
-            total_requests += 1
+        total_requests = sum(t.get("total_requests", 0) for t in model_totals.values())
 
         # Build result with percentages and costs
         result = []
-        for model, count in sorted(model_counts.items(), key=lambda x: x[1], reverse=True):
+        for model, totals in sorted(model_totals.items(), key=lambda x: x[1].get("total_requests", 0), reverse=True):
+            count = totals.get("total_requests", 0)
             percentage = (count / total_requests * 100) if total_requests > 0 else 0
             estimated_cost = estimate_cost(model, count)
             result.append({
                 "model": model,
                 "total_requests": count,
                 "percentage": round(percentage, 1),
-                "estimated_cost": round(estimated_cost, 2)
+                "estimated_cost": round(estimated_cost, 2),
+                "input_tokens": totals.get("input_tokens", 0),
+                "output_tokens": totals.get("output_tokens", 0),
+                "cost_cents": totals.get("cost_cents", 0),
+                "unique_users": len(totals.get("users", ())),
             })
 
         return result
@@ -3679,17 +3707,16 @@ async def get_users_for_email(email_type: str) -> List[dict]:
             "display_name": "Test Admin"
         }]
 
-    users_ref = db.collection("users")
     users = []
 
     # Get all users from Firebase Auth
     try:
         page = firebase_auth.list_users()
+        # Get user preferences from Firestore in one batched read
+        firestore_users = await datastore.get_users([user.uid for user in page.users])
         for user in page.users:
-            # Get user preferences from Firestore
-            user_doc = users_ref.document(user.uid).get()
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
+            user_data = firestore_users.get(user.uid)
+            if user_data is not None:
                 email_prefs = user_data.get("email_preferences", {})
 
                 # Check if user wants this type of email
@@ -3767,11 +3794,9 @@ async def send_bulk_email(email_request: EmailRequest, _: dict = Depends(get_cur
 @main_app.get("/user/email-preferences")
 async def get_user_email_preferences(user: dict = Depends(get_current_user)):
     """Get user's email preferences."""
-    user_ref = db.collection("users").document(user["user_id"])
-    user_doc = user_ref.get()
+    user_data = await datastore.get_user(user["user_id"])
     
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
+    if user_data is not None:
         email_prefs = user_data.get("email_preferences", {
             "feature_updates": True,
             "bug_fixes": True,
@@ -3796,10 +3821,8 @@ async def update_user_email_preferences(
     user: dict = Depends(get_current_user)
 ):
     """Update user's email preferences."""
-    user_ref = db.collection("users").document(user["user_id"])
-    
     # Update or create user document with email preferences
-    user_ref.set({
+    await datastore.set_user(user["user_id"], {
         "email_preferences": {
             "feature_updates": preferences.feature_updates,
             "bug_fixes": preferences.bug_fixes,
@@ -3807,7 +3830,7 @@ async def update_user_email_preferences(
             "usage_tips": preferences.usage_tips,
             "charity_updates": preferences.charity_updates
         }
-    }, merge=True)
+    })
     
     return {"message": "Email preferences updated successfully"}
 
@@ -3815,8 +3838,7 @@ async def update_user_email_preferences(
 async def get_user_chat_settings(user: dict = Depends(get_current_user)):
     """Get user's chat settings (simplified mode, default model, etc.)."""
     user_id = user["user_id"]
-    user_ref = db.collection("users").document(user_id)
-    user_doc = user_ref.get()
+    user_data = await datastore.get_user(user_id)
 
     # Default settings for new users
     default_settings = {
@@ -3828,8 +3850,7 @@ async def get_user_chat_settings(user: dict = Depends(get_current_user)):
         "therapy_mode": False
     }
 
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
+    if user_data is not None:
         return user_data.get("chat_settings", default_settings)
     return default_settings
 
@@ -3840,9 +3861,8 @@ async def update_user_chat_settings(
 ):
     """Update user's chat settings."""
     user_id = user["user_id"]
-    user_ref = db.collection("users").document(user_id)
 
-    user_ref.set({
+    await datastore.set_user(user_id, {
         "chat_settings": {
             "simplified_mode": settings.simplified_mode,
             "default_model": settings.default_model,
@@ -3851,7 +3871,7 @@ async def update_user_chat_settings(
             "dark_mode": settings.dark_mode,
             "therapy_mode": settings.therapy_mode
         }
-    }, merge=True)
+    })
 
     return {"message": "Chat settings updated successfully"}
 
@@ -3864,7 +3884,7 @@ async def submit_feedback(
     user_id = user["user_id"]
 
     try:
-        db.collection("feedback").add({
+        await datastore.add_feedback({
             "user_id": user_id,
             "message_id": feedback.message_id,
             "rating": feedback.rating,
@@ -3886,13 +3906,11 @@ async def get_feedback_analytics(
 ):
     """Get feedback analytics - thumbs up/down by model."""
     try:
-        feedback_logs = db.collection("feedback")
-
         if days == 0:
-            logs = list(feedback_logs.stream())
+            logs = await datastore.list_feedback()
         else:
             start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-            logs = list(feedback_logs.where("date_key", ">=", start_date).stream())
+            logs = await datastore.list_feedback(since_date_key=start_date)
 
         # Aggregate by model and rating
         model_feedback = {}
@@ -3900,8 +3918,7 @@ async def get_feedback_analytics(
         total_up = 0
         total_down = 0
 
-        for log in logs:
-            data = log.to_dict()
+        for data in logs:
             model = data.get("model", "unknown")
             rating = data.get("rating", "unknown")
             category = data.get("routed_category", "direct")
@@ -3948,18 +3965,51 @@ async def get_feedback_analytics(
         print(f"Feedback analytics error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get feedback analytics: {str(e)}")
 
+@main_app.get("/admin/analytics/router")
+async def get_router_analytics(_: dict = Depends(get_current_admin_user)):
+    """Get auto-mode routing stats - local classifier, decision cache and LLM router hit rates (this process)."""
+    return get_router_stats()
+
+@main_app.get("/admin/analytics/usage-writer")
+async def get_usage_writer_stats(_: dict = Depends(get_current_admin_user)):
+    """Get write-behind usage logging stats - queue depth, flushes and writes per event (this process)."""
+    return usage_writer.stats()
+
+@main_app.get("/admin/analytics/credit-cache")
+async def get_credit_cache_stats(_: dict = Depends(get_current_admin_user)):
+    """Get credit access cache stats - subscriber/lease hits vs. Firestore transactions (this process)."""
+    return credit_cache.stats()
+
+@main_app.get("/admin/analytics/url-cache")
+async def get_url_cache_stats(_: dict = Depends(get_current_admin_user)):
+    """Get fetched-URL cache stats - hits, cached failures, size and evictions (this process)."""
+    return url_cache.stats()
+
+@main_app.get("/admin/analytics/web-search")
+async def get_web_search_stats(_: dict = Depends(get_current_admin_user)):
+    """Get web search stats - hedged requests, winning backends and cache hit rate (this process)."""
+    return get_search_stats()
+
+@main_app.get("/admin/analytics/rag-cache")
+async def get_rag_cache_analytics(_: dict = Depends(get_current_admin_user)):
+    """Get RAG cache stats - query embedding hit rate and memory used (this process)."""
+    try:
+        from rag_service import get_rag_cache_stats
+        # The first call opens the SQLite chunk store: keep it off the event loop
+        return await asyncio.to_thread(get_rag_cache_stats)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"RAG service unavailable: {e}")
+
 @main_app.get("/unsubscribe/{user_id}")
 async def unsubscribe_user(user_id: str, email_type: str = None):
     """Unsubscribe user from specific email type or all emails."""
     try:
         # Get user from Firebase Auth
         user = firebase_auth.get_user(user_id)
-        user_ref = db.collection("users").document(user_id)
         
         # Get current preferences
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data = await datastore.get_user(user_id)
+        if user_data is not None:
             email_prefs = user_data.get("email_preferences", {
                 "feature_updates": True,
                 "bug_fixes": True,
@@ -3988,9 +4038,9 @@ async def unsubscribe_user(user_id: str, email_type: str = None):
             message = "Unsubscribed from all emails"
         
         # Save updated preferences
-        user_ref.set({
+        await datastore.set_user(user_id, {
             "email_preferences": email_prefs
-        }, merge=True)
+        })
         
         # Return HTML page with confirmation
         html_content = f"""
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Bootstrap / migrate the Qdrant collection used for document RAG.
+
+Creates the collection if it doesn't exist and the keyword payload indexes
+every filtered query relies on (user_id as the tenant key, project_name,
+document_id). Safe to re-run. Without the indexes Qdrant filters by
+scanning payloads, so search latency grows with the total number of users.
+
+Usage:
+    python qdrant_bootstrap.py                 # create missing indexes
+    python qdrant_bootstrap.py --tenant-hnsw   # also build per-tenant HNSW graphs
+    python qdrant_bootstrap.py --benchmark     # time filtered searches before and after
+    python qdrant_bootstrap.py --benchmark-only
+
+Uses QDRANT_URL / QDRANT_API_KEY like the app.
+"""
+import random
+import statistics
+import sys
+import time
+
+from qdrant_client import QdrantClient
+
+from rag_service import (
+    COLLECTION_NAME, EMBEDDING_DIMENSION,
+    _qdrant_connection_kwargs, _search_filter, ensure_collection_layout,
+)
+
+BENCHMARK_USERS = 20
+BENCHMARK_RUNS = 5
+READY_TIMEOUT = 600
+
+
+def sample_user_ids(qdrant: QdrantClient, limit: int = BENCHMARK_USERS) -> list:
+    """Distinct user_ids found in the first pages of the collection."""
+    users = []
+    offset = None
+    while len(users) < limit:
+        points, offset = qdrant.scroll(
+            collection_name=COLLECTION_NAME, limit=256, offset=offset,
+            with_payload=["user_id"], with_vectors=False,
+        )
+        for point in points:
+            user_id = (point.payload or {}).get("user_id")
+            if user_id and user_id not in users:
+                users.append(user_id)
+        if offset is None:
+            break
+    return users[:limit]
+
+
+def benchmark(qdrant: QdrantClient, user_ids: list, runs: int = BENCHMARK_RUNS) -> dict:
+    """Latency of user-filtered searches (random query vectors), in ms."""
+    rng = random.Random(0)
+    timings = []
+    for _ in range(runs):
+        for user_id in user_ids:
+            vector = [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSION)]
+            start = time.perf_counter()
+            qdrant.search(
+                collection_name=COLLECTION_NAME,
+                query_vector=vector,
+                query_filter=_search_filter(user_id),
+                limit=5,
+            )
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "searches": len(timings),
+        "p50_ms": round(statistics.median(timings), 1),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 1),
+        "max_ms": round(timings[-1], 1),
+    }
+
+
+def wait_until_ready(qdrant: QdrantClient):
+    """Wait for Qdrant to finish (re)building indexes after a migration."""
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        status = qdrant.get_collection(COLLECTION_NAME).status
+        if str(getattr(status, "value", status)) == "green":
+            return
+        time.sleep(2)
+    print(f"⚠️ Collection still optimizing after {READY_TIMEOUT}s; results may be noisy")
+
+
+def main():
+    args = sys.argv[1:]
+    qdrant = QdrantClient(**_qdrant_connection_kwargs(), timeout=120)
+
+    run_benchmark = "--benchmark" in args or "--benchmark-only" in args
+    user_ids = []
+    if run_benchmark and qdrant.collection_exists(COLLECTION_NAME):
+        user_ids = sample_user_ids(qdrant)
+        if user_ids:
+            before = benchmark(qdrant, user_ids)
+            info = qdrant.get_collection(COLLECTION_NAME)
+            print(f"📊 Before ({info.points_count} points, {len(user_ids)} users): {before}")
+
+    if "--benchmark-only" in args:
+        return
+
+    changes = ensure_collection_layout(qdrant, tenant_hnsw="--tenant-hnsw" in args)
+    for change in changes:
+        print(f"✅ {change}")
+    if not changes:
+        print("✅ Collection layout already up to date")
+
+    if user_ids:
+        wait_until_ready(qdrant)
+        after = benchmark(qdrant, user_ids)
+        print(f"📊 After: {after}")
+
+
+if __name__ == "__main__":
+    main()
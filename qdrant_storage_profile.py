@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Switch the document collection to a storage profile, or compare profiles.
+
+Profiles (see rag_service.STORAGE_PROFILES):
+    full        float32 vectors in RAM (original layout)
+    scalar      int8 quantized in RAM, originals on disk, rescored
+    binary      1-bit quantized in RAM, originals on disk, rescored
+    scalar-512  512-dim embeddings, int8 quantized, originals on disk
+
+Usage:
+    python qdrant_storage_profile.py apply scalar
+        Same-dimension profiles are applied to romalume_documents in place
+        (Qdrant re-quantizes in the background). Reduced-dimension profiles
+        get their own collection, filled from romalume_documents with
+        shortened vectors. Then set RAG_STORAGE_PROFILE=<profile> and
+        redeploy; the source collection is left untouched. The copy is
+        repeated on every run (same point IDs, so it is safe), which also
+        finishes a copy that was interrupted.
+        Documents uploaded between the copy and the redeploy only go to
+        the old collection: run apply again right after the redeploy to
+        bring them over.
+        With RAG_SPARSE_VECTORS=true every profile gets a *_hybrid
+        collection (sparse vectors can't be added to an existing one),
+        filled the same way with sparse vectors built from chunk_text.
+
+    python qdrant_storage_profile.py report [--points 5000] [--queries 200]
+        Copies a sample of romalume_documents into temporary collections,
+        one per profile, and reports recall@5 against exact float32 search
+        plus search latency. The temporary collections are dropped after.
+
+Uses QDRANT_URL / QDRANT_API_KEY like the app.
+"""
+import random
+import statistics
+import sys
+import time
+
+from qdrant_client import QdrantClient
+from qdrant_client.models import HasIdCondition, Filter, PointStruct, SearchParams
+
+from rag_service import (
+    BASE_COLLECTION_NAME, STORAGE_PROFILES, StorageProfile,
+    _qdrant_connection_kwargs, ensure_collection_layout, migrate_points, shorten_embedding,
+)
+
+TOP_K = 5
+READY_TIMEOUT = 600
+
+
+def wait_until_ready(qdrant: QdrantClient, collection: str):
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        status = qdrant.get_collection(collection).status
+        if str(getattr(status, "value", status)) == "green":
+            return
+        time.sleep(2)
+    print(f"⚠️ {collection} still optimizing after {READY_TIMEOUT}s")
+
+
+def apply(qdrant: QdrantClient, name: str):
+    profile = STORAGE_PROFILES[name]
+    for change in ensure_collection_layout(qdrant, profile=profile):
+        print(f"✅ {change}")
+    if profile.collection != BASE_COLLECTION_NAME:
+        # Always (re)copy from the original dense-only collection: points keep
+        # their IDs, so this completes an interrupted copy and picks up
+        # documents uploaded since the last run
+        copied = migrate_points(qdrant, BASE_COLLECTION_NAME, profile)
+        print(f"✅ Copied {copied} points into {profile.collection}")
+        source_count = qdrant.count(BASE_COLLECTION_NAME, exact=True).count
+        target_count = qdrant.count(profile.collection, exact=True).count
+        if target_count < source_count:
+            print(f"⚠️ {profile.collection} has {target_count} points but {BASE_COLLECTION_NAME} has "
+                  f"{source_count}; re-run apply before switching")
+    wait_until_ready(qdrant, profile.collection)
+    print(f"Set RAG_STORAGE_PROFILE={name} to serve from {profile.collection}")
+
+
+def sample_points(qdrant: QdrantClient, limit: int) -> list:
+    points = []
+    offset = None
+    while len(points) < limit:
+        page, offset = qdrant.scroll(
+            collection_name=BASE_COLLECTION_NAME, limit=256, offset=offset,
+            with_payload=False, with_vectors=True,
+        )
+        points.extend(page)
+        if offset is None:
+            break
+    return points[:limit]
+
+
+def build_eval_collection(qdrant: QdrantClient, profile: StorageProfile, points: list) -> str:
+    collection = f"{BASE_COLLECTION_NAME}_eval_{profile.name}"
+    if qdrant.collection_exists(collection):
+        qdrant.delete_collection(collection)
+    qdrant.create_collection(
+        collection_name=collection,
+        vectors_config=profile.vectors_config(),
+        quantization_config=profile.quantization,
+    )
+    for start in range(0, len(points), 256):
+        qdrant.upsert(collection_name=collection, points=[
+            PointStruct(id=p.id, vector=shorten_embedding(p.vector, profile.dimensions)
+                        if len(p.vector) > profile.dimensions else p.vector)
+            for p in points[start:start + 256]
+        ])
+    wait_until_ready(qdrant, collection)
+    return collection
+
+
+def search_ids(qdrant: QdrantClient, collection: str, vector: list, exclude, params) -> tuple:
+    start = time.perf_counter()
+    hits = qdrant.search(
+        collection_name=collection,
+        query_vector=vector,
+        query_filter=Filter(must_not=[HasIdCondition(has_id=[exclude])]),
+        search_params=params,
+        limit=TOP_K,
+    )
+    return [h.id for h in hits], (time.perf_counter() - start) * 1000
+
+
+def report(qdrant: QdrantClient, n_points: int, n_queries: int):
+    points = sample_points(qdrant, n_points)
+    if len(points) < TOP_K + 1:
+        print("Not enough points to evaluate")
+        return
+    queries = random.Random(0).sample(points, min(n_queries, len(points)))
+    print(f"Evaluating {len(queries)} queries over {len(points)} sampled points (recall@{TOP_K} vs exact float32)\n")
+
+    # Ground truth: exact (brute-force) search over the full-precision vectors
+    full = build_eval_collection(qdrant, STORAGE_PROFILES["full"], points)
+    truth = {q.id: search_ids(qdrant, full, q.vector, q.id, SearchParams(exact=True))[0] for q in queries}
+
+    print(f"{'profile':<12}{'dims':>6}{'RAM/vector':>12}{'recall@5':>10}{'p50 ms':>9}{'p95 ms':>9}")
+    for name, profile in STORAGE_PROFILES.items():
+        collection = full if name == "full" else build_eval_collection(qdrant, profile, points)
+        recalls, timings = [], []
+        for q in queries:
+            vector = shorten_embedding(q.vector, profile.dimensions) if len(q.vector) > profile.dimensions else q.vector
+            ids, ms = search_ids(qdrant, collection, vector, q.id, profile.search_params())
+            recalls.append(len(set(ids) & set(truth[q.id])) / TOP_K)
+            timings.append(ms)
+        timings.sort()
+        if profile.quantization is None:
+            ram = profile.dimensions * 4
+        elif name.startswith("binary"):
+            ram = profile.dimensions // 8
+        else:
+            ram = profile.dimensions
+        print(f"{name:<12}{profile.dimensions:>6}{ram:>10} B{statistics.mean(recalls):>10.3f}"
+              f"{statistics.median(timings):>9.1f}{timings[int(len(timings) * 0.95) - 1]:>9.1f}")
+        if collection != full:
+            qdrant.delete_collection(collection)
+    qdrant.delete_collection(full)
+
+
+def main():
+    args = sys.argv[1:]
+    qdrant = QdrantClient(**_qdrant_connection_kwargs(), timeout=120)
+    if len(args) >= 2 and args[0] == "apply" and args[1] in STORAGE_PROFILES:
+        apply(qdrant, args[1])
+    elif args and args[0] == "report":
+        n_points = int(args[args.index("--points") + 1]) if "--points" in args else 5000
+        n_queries = int(args[args.index("--queries") + 1]) if "--queries" in args else 200
+        report(qdrant, n_points, n_queries)
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Token-budgeted packing of document search results for RomaLume.
+
+Search returns the top chunks (up to CHUNK_SIZE characters each) with
+their scores. Before they go into the prompt they are packed:
+
+- chunks scoring below RAG_MIN_RELATIVE_SCORE x the best score are dropped
+  (only when the best score is positive; the top chunk is always kept)
+- chunks that are neighbours in the same document are merged into one
+  passage, and the CHUNK_OVERLAP characters the splitter repeats at the
+  start of each chunk are cut so they are sent once
+- passages are added best-first until the token budget is spent; the
+  budget is RAG_CONTEXT_RATIO of the model's context window (from
+  MODELS_CATALOG)
+"""
+
+import os
+from typing import List, Optional
+
+from cost_tracker import CHARS_PER_TOKEN, estimate_tokens, get_models_catalog
+
+# How rag_service splits documents
+CHUNK_SIZE = 4000      # ~1000 tokens
+CHUNK_OVERLAP = 800    # ~200 tokens overlap
+
+RAG_CONTEXT_RATIO = float(os.getenv("RAG_CONTEXT_RATIO", "0.04"))  # 128K window: ~5K tokens
+RAG_CONTEXT_MIN_TOKENS = int(os.getenv("RAG_CONTEXT_MIN_TOKENS", "1500"))
+# Relative, so it works for cosine scores and for rank-fused (RRF) hybrid
+# scores alike: with RRF a chunk ranked first by only one retriever scores
+# half as much as one ranked first by both, and is kept.
+RAG_MIN_RELATIVE_SCORE = float(os.getenv("RAG_MIN_RELATIVE_SCORE", "0.5"))
+
+# Models missing from the catalog (and "auto", which is routed after the
+# search has run) get the smallest window in the catalog
+DEFAULT_CONTEXT_WINDOW = min(m["context_window"] for m in get_models_catalog())
+
+# Shortest repeated run treated as splitter overlap rather than coincidence
+MIN_OVERLAP_CHARS = 40
+
+PASSAGE_SEPARATOR = "\n\n---\n\n"
+
+
+def context_token_budget(model: str) -> int:
+    """Tokens of document context allowed for a model."""
+    window = next(
+        (m["context_window"] for m in get_models_catalog() if m["id"] == model),
+        DEFAULT_CONTEXT_WINDOW,
+    )
+    return max(RAG_CONTEXT_MIN_TOKENS, int(window * RAG_CONTEXT_RATIO))
+
+
+def overlap_length(previous: str, following: str) -> int:
+    """
+    Length of the longest suffix of `previous` that starts `following`,
+    i.e. the text the splitter repeated between two neighbouring chunks.
+    """
+    anchor = following[:MIN_OVERLAP_CHARS]
+    if len(anchor) < MIN_OVERLAP_CHARS:
+        return 0
+    # The repeated text starts at most CHUNK_OVERLAP (plus a separator's
+    # worth of slack) before the end of the previous chunk
+    start = max(0, len(previous) - CHUNK_OVERLAP - MIN_OVERLAP_CHARS)
+    pos = previous.find(anchor, start)
+    while pos != -1:
+        tail = previous[pos:]
+        if following.startswith(tail):
+            return len(tail)
+        pos = previous.find(anchor, pos + 1)
+    return 0
+
+
+def merge_adjacent(results: List[dict]) -> List[dict]:
+    """
+    Group chunks into passages of consecutive chunk_index from the same
+    document, with the overlap between neighbours removed. A passage's
+    score is the best score among its chunks.
+    """
+    by_position = sorted(results, key=lambda r: (r["filename"], r.get("project_name") or "", r["chunk_index"]))
+    passages = []
+    for r in by_position:
+        last = passages[-1] if passages else None
+        if (last and last["filename"] == r["filename"]
+                and last.get("project_name") == r.get("project_name")
+                and r["chunk_index"] == last["last_index"] + 1):
+            cut = overlap_length(last["chunk_text"], r["chunk_text"])
+            last["chunk_text"] += r["chunk_text"][cut:] if cut else "\n" + r["chunk_text"]
+            last["last_index"] = r["chunk_index"]
+            last["score"] = max(last["score"], r["score"])
+            last["chunks"] += 1
+        elif last and last["filename"] == r["filename"] and r["chunk_index"] == last["last_index"]:
+            continue  # same chunk twice
+        else:
+            passages.append({**r, "last_index": r["chunk_index"], "chunks": 1})
+    return passages
+
+
+def pack_context(results: List[dict], model: str, budget: Optional[int] = None) -> List[dict]:
+    """
+    Select, merge and order search results to fit the model's budget.
+
+    Returns passages (dicts like the search results, with merged
+    chunk_text plus "chunks" and "tokens") best-first.
+    """
+    if not results:
+        return []
+    if budget is None:
+        budget = context_token_budget(model)
+
+    top = max(results, key=lambda r: r["score"])
+    best = top["score"]
+    # A relative cutoff means nothing for zero or negative (cosine) scores
+    relevant = [
+        r for r in results
+        if r is top or best <= 0 or r["score"] >= best * RAG_MIN_RELATIVE_SCORE
+    ]
+
+    packed = []
+    remaining = budget
+    for passage in sorted(merge_adjacent(relevant), key=lambda p: p["score"], reverse=True):
+        tokens = estimate_tokens(passage["chunk_text"], model)
+        if tokens > remaining:
+            if not packed:
+                # Always send something: the start of the best passage
+                passage["chunk_text"] = passage["chunk_text"][:remaining * CHARS_PER_TOKEN]
+                passage["tokens"] = estimate_tokens(passage["chunk_text"], model)
+                packed.append(passage)
+            break
+        passage["tokens"] = tokens
+        packed.append(passage)
+        remaining -= tokens
+
+    dropped = len(results) - len(relevant)
+    print(f"RAG context: {sum(p['tokens'] for p in packed)}/{budget} tokens in {len(packed)} passage(s) "
+          f"from {sum(p['chunks'] for p in packed)} of {len(results)} chunks ({dropped} below score cutoff)")
+    return packed
@@ -4,21 +4,40 @@ RAG Service for RomaLume - Qdrant-based document retrieval
 This module handles:
 - Document chunking and embedding
 - Storing document vectors in Qdrant
-- Semantic search for relevant context
+- Semantic search for relevant context, optionally fused with keyword
+  (sparse BM25) search for exact names, identifiers and error strings
 """
 
+import asyncio
+import hashlib
 import os
+import re
+import sqlite3
+import threading
 import time
-from typing import List, Optional
+import uuid
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from qdrant_client.models import (
     Distance, VectorParams, PointStruct,
-    Filter, FieldCondition, MatchValue
+    Filter, FieldCondition, MatchValue, PointIdsList,
+    HnswConfigDiff, KeywordIndexParams,
+    BinaryQuantization, BinaryQuantizationConfig, Disabled,
+    QuantizationSearchParams, ScalarQuantization, ScalarQuantizationConfig,
+    ScalarType, SearchParams, VectorParamsDiff,
+    Fusion, FusionQuery, Modifier, Prefetch, SparseVector, SparseVectorParams
 )
 from openai import OpenAI
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from rag_context import CHUNK_OVERLAP, CHUNK_SIZE
+
+
 def retry_on_timeout(func, max_retries=3, delay=2):
     """Retry a function on timeout with exponential backoff."""
     for attempt in range(max_retries):
@@ -34,89 +53,718 @@ def retry_on_timeout(func, max_retries=3, delay=2):
 # Configuration
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-COLLECTION_NAME = "romalume_documents"
+BASE_COLLECTION_NAME = "romalume_documents"
 EMBEDDING_MODEL = "text-embedding-3-small"
-EMBEDDING_DIMENSION = 1536
+FULL_EMBEDDING_DIMENSION = 1536
 
+# Hybrid retrieval: chunks also get a BM25-style sparse vector (Qdrant
+# applies IDF server-side) so exact terms - names, identifiers, error
+# strings - are found even when the dense embedding misses them. Adding
+# sparse vectors needs a new collection, see qdrant_storage_profile.py.
+RAG_SPARSE_VECTORS = os.getenv("RAG_SPARSE_VECTORS", "false").lower() == "true"
+RAG_HYBRID_DEFAULT = os.getenv("RAG_HYBRID_DEFAULT", "false").lower() == "true"
+SPARSE_VECTOR_NAME = "text"
 
-class RAGService:
-    """Service for document indexing and retrieval using Qdrant."""
 
-    def __init__(self):
-        if not QDRANT_URL:
-            raise ValueError("QDRANT_URL environment variable not set")
-
-        # Parse URL to extract host and port
-        parsed = urlparse(QDRANT_URL)
-        host = parsed.hostname
-        use_https = parsed.scheme == "https"
-
-        # For internal Railway URLs (.railway.internal), use port 6333 and try gRPC
-        if host and '.railway.internal' in host:
-            port = 6333
-            use_https = False  # Internal network uses HTTP
-            # Try using gRPC for better performance on internal network
+class StorageProfile:
+    """
+    How document vectors are stored and searched in Qdrant.
+
+    Quantized profiles keep a compressed copy of every vector in RAM for the
+    search itself and (with on_disk) leave the float32 originals on disk,
+    where they are only read to rescore the oversampled candidates.
+    Reduced-dimension profiles ask the embeddings API for shorter vectors
+    (text-embedding-3 supports this natively) and live in their own
+    collection, since a collection's vector size is fixed.
+    """
+
+    def __init__(self, name: str, dimensions: int = FULL_EMBEDDING_DIMENSION, quantization=None,
+                 on_disk: bool = False, oversampling: Optional[float] = None, sparse: bool = RAG_SPARSE_VECTORS):
+        self.name = name
+        self.dimensions = dimensions
+        self.quantization = quantization
+        self.on_disk = on_disk
+        self.oversampling = oversampling
+        self.sparse = sparse
+
+    @property
+    def collection(self) -> str:
+        name = BASE_COLLECTION_NAME
+        if self.dimensions != FULL_EMBEDDING_DIMENSION:
+            name += f"_{self.dimensions}d"
+        if self.sparse:
+            name += "_hybrid"
+        return name
+
+    @property
+    def embedding_key(self) -> str:
+        """Model identity for embedding caches (vectors differ per dimension)."""
+        if self.dimensions == FULL_EMBEDDING_DIMENSION:
+            return EMBEDDING_MODEL
+        return f"{EMBEDDING_MODEL}:{self.dimensions}"
+
+    def embedding_kwargs(self) -> dict:
+        if self.dimensions == FULL_EMBEDDING_DIMENSION:
+            return {}
+        return {"dimensions": self.dimensions}
+
+    def vectors_config(self) -> VectorParams:
+        return VectorParams(size=self.dimensions, distance=Distance.COSINE, on_disk=self.on_disk)
+
+    def sparse_vectors_config(self) -> Optional[dict]:
+        if not self.sparse:
+            return None
+        return {SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)}
+
+    def search_params(self) -> Optional[SearchParams]:
+        if self.quantization is None:
+            return None
+        return SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=self.oversampling))
+
+
+def _scalar_int8() -> ScalarQuantization:
+    return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+
+
+def _binary() -> BinaryQuantization:
+    return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+
+
+STORAGE_PROFILES = {
+    # float32 in RAM (the original layout)
+    "full": StorageProfile("full"),
+    # int8 in RAM (4x smaller), originals on disk, rescored
+    "scalar": StorageProfile("scalar", quantization=_scalar_int8(), on_disk=True, oversampling=2.0),
+    # 1 bit per dimension in RAM (32x smaller), originals on disk, rescored
+    "binary": StorageProfile("binary", quantization=_binary(), on_disk=True, oversampling=3.0),
+    # 512-dim embeddings, int8 in RAM, originals on disk
+    "scalar-512": StorageProfile("scalar-512", dimensions=512, quantization=_scalar_int8(), on_disk=True, oversampling=2.0),
+}
+
+RAG_STORAGE_PROFILE = os.getenv("RAG_STORAGE_PROFILE", "full")
+if RAG_STORAGE_PROFILE not in STORAGE_PROFILES:
+    raise ValueError(f"Unknown RAG_STORAGE_PROFILE {RAG_STORAGE_PROFILE!r} (expected one of {', '.join(STORAGE_PROFILES)})")
+STORAGE_PROFILE = STORAGE_PROFILES[RAG_STORAGE_PROFILE]
+
+COLLECTION_NAME = STORAGE_PROFILE.collection
+EMBEDDING_DIMENSION = STORAGE_PROFILE.dimensions
+EMBEDDING_KEY = STORAGE_PROFILE.embedding_key
+
+# Indexing: chunks are packed into token-budgeted batches (the API caps
+# inputs and tokens per request) and the batches are embedded in parallel
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "50000"))
+EMBEDDING_BATCH_MAX_INPUTS = 512
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_BATCH_RETRIES = 3
+
+# Chat-path deadlines (seconds) for the async search
+RAG_EMBED_TIMEOUT = float(os.getenv("RAG_EMBED_TIMEOUT", "5"))
+RAG_SEARCH_TIMEOUT = float(os.getenv("RAG_SEARCH_TIMEOUT", "5"))
+
+
+# Query embedding cache: re-asked / regenerated questions skip the embeddings call
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2000"))
+QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", str(24 * 3600)))
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+class EmbeddingCache:
+    """
+    LRU+TTL cache of query embeddings keyed by SHA-256 of (model, normalized
+    text). Vectors are kept as float32 arrays (~6KB for 1536 dims instead of
+    ~50KB as a list of Python floats).
+    """
+
+    def __init__(self, maxsize: int = QUERY_EMBEDDING_CACHE_SIZE, ttl: int = QUERY_EMBEDDING_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[array, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(model: str, text: str) -> str:
+        normalized = _SPACE_RE.sub(" ", text).strip()
+        return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _drop(self, key: str):
+        vector, _ = self._entries.pop(key)
+        self._bytes -= len(vector) * vector.itemsize
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = self.key_for(model, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0].tolist()
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        key = self.key_for(model, text)
+        vector = array("f", embedding)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (vector, time.time() + self.ttl)
+            self._bytes += len(vector) * vector.itemsize
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+query_embedding_cache = EmbeddingCache()
+
+
+# Chunk embeddings are content-addressed and kept on disk, so re-uploading a
+# document (or a revision sharing most of its chunks) only embeds new chunks
+CHUNK_EMBEDDING_CACHE_PATH = os.getenv("CHUNK_EMBEDDING_CACHE_PATH", "chunk_embeddings.sqlite3")
+# ~6 KB per 1536-dim row, so the default caps the file at roughly 300 MB
+CHUNK_EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("CHUNK_EMBEDDING_CACHE_MAX_ROWS", "50000"))
+CHUNK_EMBEDDING_CACHE_MAX_AGE = int(os.getenv("CHUNK_EMBEDDING_CACHE_MAX_AGE_DAYS", "90")) * 86400
+CHUNK_EMBEDDING_PRUNE_INTERVAL = 3600
+SQLITE_MAX_VARIABLES = 500
+
+
+class ChunkEmbeddingStore:
+    """
+    Persistent chunk embeddings in SQLite, keyed by SHA-256 of (model, chunk
+    text) and stored as float32 blobs. If the file can't be opened the store
+    disables itself and every chunk is embedded as before.
+
+    Rows are shared by every document containing the same chunk, so deleting
+    a document doesn't delete them. Instead rows unused for
+    CHUNK_EMBEDDING_CACHE_MAX_AGE are dropped, and the least recently used
+    ones go once there are more than CHUNK_EMBEDDING_CACHE_MAX_ROWS.
+    """
+
+    def __init__(self, path: str = CHUNK_EMBEDDING_CACHE_PATH, max_rows: int = CHUNK_EMBEDDING_CACHE_MAX_ROWS,
+                 max_age: float = CHUNK_EMBEDDING_CACHE_MAX_AGE):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._rows = 0
+        self._pruned_at = 0.0
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(chunk_embeddings)")]
+            if "created_at" in columns:
+                # Files from before pruning: the timestamp now tracks last use
+                self._db.execute("ALTER TABLE chunk_embeddings RENAME COLUMN created_at TO used_at")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_embeddings "
+                "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS chunk_embeddings_used_at ON chunk_embeddings (used_at)")
+            self._db.commit()
+            self._rows = self._db.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0]
+            self._prune()
+        except sqlite3.Error as e:
+            print(f"Chunk embedding cache disabled ({path}): {e}")
+            self._db = None
+
+    @staticmethod
+    def key_for(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[int, List[float]]:
+        """Cached embeddings by index into texts (marking them as used)."""
+        if self._db is None or not texts:
+            return {}
+        keys = [self.key_for(model, t) for t in texts]
+        found: Dict[str, bytes] = {}
+        now = time.time()
+        with self._lock:
             try:
-                self.qdrant = QdrantClient(
-                    host=host,
-                    grpc_port=6334,  # gRPC port
-                    api_key=QDRANT_API_KEY,
-                    timeout=60,
-                    prefer_grpc=True,
-                    https=False
-                )
-                print(f"Qdrant client initialized for {host}:6334 (gRPC)")
-            except Exception as e:
-                print(f"gRPC connection failed, falling back to REST: {e}")
-                self.qdrant = QdrantClient(
-                    host=host,
-                    port=port,
-                    api_key=QDRANT_API_KEY,
-                    timeout=60,
-                    prefer_grpc=False,
-                    https=use_https
-                )
-                print(f"Qdrant client initialized for {host}:{port} (REST)")
-        else:
-            # For Railway public URLs (.up.railway.app), always use port 443
-            if host and '.up.railway.app' in host:
-                port = 443
-                use_https = True
-            else:
-                port = parsed.port or (443 if use_https else 6333)
-
-            self.qdrant = QdrantClient(
-                host=host,
-                port=port,
-                api_key=QDRANT_API_KEY,
-                timeout=60,
-                prefer_grpc=False,
-                https=use_https
+                for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                    batch = keys[start:start + SQLITE_MAX_VARIABLES]
+                    placeholders = ','.join('?' * len(batch))
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({placeholders})",
+                        batch,
+                    ).fetchall()
+                    found.update(rows)
+                    if rows:
+                        self._db.execute(
+                            f"UPDATE chunk_embeddings SET used_at = ? WHERE key IN ({placeholders})",
+                            [now, *batch],
+                        )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Chunk embedding cache read failed: {e}")
+                return {}
+        result = {}
+        for i, key in enumerate(keys):
+            blob = found.get(key)
+            if blob is not None:
+                vector = array("f")
+                vector.frombytes(blob)
+                result[i] = vector.tolist()
+        self.hits += len(result)
+        self.misses += len(texts) - len(result)
+        return result
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        if self._db is None or not texts:
+            return
+        now = time.time()
+        rows = [(self.key_for(model, t), array("f", e).tobytes(), now) for t, e in zip(texts, embeddings)]
+        with self._lock:
+            try:
+                # Same key means same model and text, so an existing row is already right
+                cursor = self._db.executemany("INSERT OR IGNORE INTO chunk_embeddings VALUES (?, ?, ?)", rows)
+                self._rows += cursor.rowcount
+                self._db.commit()
+                if self._rows > self.max_rows or now - self._pruned_at > CHUNK_EMBEDDING_PRUNE_INTERVAL:
+                    self._prune()
+            except sqlite3.Error as e:
+                print(f"Chunk embedding cache write failed: {e}")
+
+    def _prune(self):
+        """Drop expired rows, then least recently used ones down to 90% of max_rows (lock held)."""
+        now = time.time()
+        self._pruned_at = now
+        deleted = self._db.execute("DELETE FROM chunk_embeddings WHERE used_at < ?", (now - self.max_age,)).rowcount
+        excess = self._rows - deleted - self.max_rows
+        if excess > 0:
+            excess += self.max_rows // 10  # headroom, so pruning isn't needed on every write
+            deleted += self._db.execute(
+                "DELETE FROM chunk_embeddings WHERE key IN "
+                "(SELECT key FROM chunk_embeddings ORDER BY used_at LIMIT ?)",
+                (excess,),
+            ).rowcount
+        self._db.commit()
+        if deleted:
+            self._rows -= deleted
+            self.pruned += deleted
+            print(f"Chunk embedding cache: pruned {deleted} rows ({self._rows} left)")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self._db is not None,
+            "path": self.path,
+            "rows": self._rows,
+            "max_rows": self.max_rows,
+            "max_age_days": round(self.max_age / 86400, 1),
+            "pruned": self.pruned,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+_chunk_embedding_store: Optional[ChunkEmbeddingStore] = None
+
+
+def get_chunk_embedding_store() -> ChunkEmbeddingStore:
+    global _chunk_embedding_store
+    if _chunk_embedding_store is None:
+        _chunk_embedding_store = ChunkEmbeddingStore()
+    return _chunk_embedding_store
+
+
+def get_rag_cache_stats() -> dict:
+    """Stats for the RAG caches in this process."""
+    return {
+        "query_embeddings": query_embedding_cache.stats(),
+        "chunk_embeddings": get_chunk_embedding_store().stats(),
+    }
+
+
+# BM25 term-frequency saturation; IDF comes from Qdrant's Modifier.IDF
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_AVG_CHUNK_TERMS = 600  # a 4000-char chunk is ~600-700 words
+
+# Identifiers keep their dots/dashes/underscores (e.g. "ERR_CONNECTION_RESET",
+# "rag_service.search"), and their parts are indexed too
+_TERM_RE = re.compile(r"[a-z0-9_]+(?:[.\-/:][a-z0-9_]+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in into is it its me my not of on or "
+    "so that the their them then there these they this to was we what when where which who why will "
+    "with you your".split()
+)
+
+
+def _terms(text: str) -> List[str]:
+    terms = []
+    for term in _TERM_RE.findall(text.lower()):
+        if term in _STOPWORDS:
+            continue
+        terms.append(term)
+        parts = re.split(r"[._\-/:]", term)
+        if len(parts) > 1:
+            terms.extend(p for p in parts if p and p not in _STOPWORDS)
+    return terms
+
+
+def _term_index(term: str) -> int:
+    return zlib.crc32(term.encode("utf-8"))
+
+
+def _sparse(weights: Dict[int, float]) -> SparseVector:
+    indices = sorted(weights)
+    return SparseVector(indices=indices, values=[weights[i] for i in indices])
+
+
+def sparse_document_vector(text: str) -> SparseVector:
+    """BM25 term weights for a chunk (hashed vocabulary)."""
+    counts = Counter(_term_index(t) for t in _terms(text))
+    length_norm = 1 - BM25_B + BM25_B * sum(counts.values()) / BM25_AVG_CHUNK_TERMS
+    return _sparse({
+        index: tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+        for index, tf in counts.items()
+    })
+
+
+def sparse_query_vector(text: str) -> SparseVector:
+    """Each distinct query term weighted 1 (Qdrant multiplies in the IDF)."""
+    return _sparse({_term_index(t): 1.0 for t in set(_terms(text))})
+
+
+def _point_vector(embedding: List[float], chunk_text: str, profile: "StorageProfile"):
+    """Dense vector alone, or dense + sparse for hybrid collections."""
+    if not profile.sparse:
+        return embedding
+    return {"": embedding, SPARSE_VECTOR_NAME: sparse_document_vector(chunk_text)}
+
+
+def _hybrid_query(query_embedding: List[float], query: str, query_filter: Filter, top_k: int) -> dict:
+    """query_points arguments fusing dense and sparse candidates with RRF."""
+    candidates = top_k * HYBRID_CANDIDATES_FACTOR
+    return {
+        "prefetch": [
+            Prefetch(query=query_embedding, filter=query_filter, limit=candidates,
+                     params=STORAGE_PROFILE.search_params()),
+            Prefetch(query=sparse_query_vector(query), using=SPARSE_VECTOR_NAME,
+                     filter=query_filter, limit=candidates),
+        ],
+        "query": FusionQuery(fusion=Fusion.RRF),
+        "query_filter": query_filter,
+        "limit": top_k,
+    }
+
+
+def _use_hybrid(hybrid: Optional[bool]) -> bool:
+    wanted = RAG_HYBRID_DEFAULT if hybrid is None else hybrid
+    if wanted and not STORAGE_PROFILE.sparse:
+        print("Hybrid search requested but RAG_SPARSE_VECTORS is off; using dense search")
+        return False
+    return wanted
+
+
+# Namespace for chunk point IDs (uuid5 of "<document_id>:<chunk_index>")
+POINT_ID_NAMESPACE = uuid.UUID("6f1c2d3e-8a4b-5c6d-9e7f-0a1b2c3d4e5f")
+SCROLL_PAGE_SIZE = 256
+# Candidates per retriever before fusion
+HYBRID_CANDIDATES_FACTOR = 4
+
+
+def chunk_point_id(document_id: str, chunk_index: int) -> str:
+    """Stable Qdrant point ID for a chunk, the same on every worker and restart."""
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{document_id}:{chunk_index}"))
+
+
+def chunk_content_hash(chunk: str, project_name: str) -> str:
+    """Fingerprint of everything a stored chunk depends on (text, project, model)."""
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{project_name}\0{chunk}".encode("utf-8")).hexdigest()
+
+
+# Keyword payload indexes every filtered query relies on. user_id is the
+# tenant key: is_tenant lets Qdrant co-locate each user's points so a
+# filtered search only touches that user's data.
+PAYLOAD_INDEXES = {
+    "user_id": KeywordIndexParams(type="keyword", is_tenant=True),
+    "project_name": KeywordIndexParams(type="keyword"),
+    "document_id": KeywordIndexParams(type="keyword"),
+}
+# Per-tenant HNSW graphs (payload_m) instead of one global graph (m=0);
+# every search is filtered by user_id, so the global graph is never used
+TENANT_HNSW_CONFIG = HnswConfigDiff(payload_m=16, m=0)
+
+
+def ensure_collection_layout(qdrant: QdrantClient, tenant_hnsw: bool = False,
+                             profile: StorageProfile = STORAGE_PROFILE) -> List[str]:
+    """
+    Create the profile's collection if needed, bring its storage settings
+    (quantization, on-disk originals) in line with the profile, and create
+    any missing payload indexes. Idempotent; returns a list of the changes
+    made.
+
+    tenant_hnsw also switches HNSW to per-tenant graphs. Changing the HNSW
+    or storage settings makes Qdrant rebuild in the background.
+    """
+    collection = profile.collection
+    changes = []
+    if not qdrant.collection_exists(collection):
+        qdrant.create_collection(
+            collection_name=collection,
+            vectors_config=profile.vectors_config(),
+            sparse_vectors_config=profile.sparse_vectors_config(),
+            quantization_config=profile.quantization,
+            hnsw_config=TENANT_HNSW_CONFIG if tenant_hnsw else None,
+        )
+        changes.append(f"created collection {collection} ({profile.name} profile)")
+
+    info = qdrant.get_collection(collection)
+    vectors = info.config.params.vectors
+    if bool(vectors.on_disk) != profile.on_disk:
+        qdrant.update_collection(collection, vectors_config={"": VectorParamsDiff(on_disk=profile.on_disk)})
+        changes.append(f"set original vectors on_disk={profile.on_disk}")
+    current_quantization = info.config.quantization_config
+    if current_quantization != profile.quantization:
+        qdrant.update_collection(collection, quantization_config=profile.quantization or Disabled.DISABLED)
+        changes.append(f"set quantization to {type(profile.quantization).__name__ if profile.quantization else 'none'}")
+
+    existing = info.payload_schema or {}
+    for field, params in PAYLOAD_INDEXES.items():
+        current = existing.get(field)
+        current_params = getattr(current, "params", None) if current else None
+        if current is not None and bool(getattr(current_params, "is_tenant", False)) == bool(params.is_tenant):
+            continue
+        if current is not None:
+            qdrant.delete_payload_index(collection, field, wait=True)
+        qdrant.create_payload_index(collection, field, field_schema=params, wait=True)
+        changes.append(f"indexed {field} (keyword{', tenant' if params.is_tenant else ''})")
+
+    if tenant_hnsw:
+        hnsw = info.config.hnsw_config
+        if hnsw.m != TENANT_HNSW_CONFIG.m or hnsw.payload_m != TENANT_HNSW_CONFIG.payload_m:
+            qdrant.update_collection(collection, hnsw_config=TENANT_HNSW_CONFIG)
+            changes.append("switched HNSW to per-tenant graphs (payload_m=16, m=0)")
+    return changes
+
+
+def shorten_embedding(vector: List[float], dimensions: int) -> List[float]:
+    """
+    Truncate a text-embedding-3 vector and re-normalize it, which matches
+    what the API returns for a smaller 'dimensions'.
+    """
+    head = vector[:dimensions]
+    norm = sum(x * x for x in head) ** 0.5 or 1.0
+    return [x / norm for x in head]
+
+
+def migrate_points(qdrant: QdrantClient, source: str, profile: StorageProfile, batch_size: int = SCROLL_PAGE_SIZE) -> int:
+    """
+    Copy every point from the source collection into the profile's
+    collection (same IDs and payloads), shortening vectors if the profile
+    has fewer dimensions and adding sparse vectors (from the stored chunk
+    text) for hybrid collections. Returns the number of points copied.
+    """
+    copied = 0
+    offset = None
+    while True:
+        points, offset = retry_on_timeout(lambda: qdrant.scroll(
+            collection_name=source, limit=batch_size, offset=offset,
+            with_payload=True, with_vectors=True,
+        ))
+        if points:
+            batch = []
+            for point in points:
+                dense = point.vector.get("", []) if isinstance(point.vector, dict) else point.vector
+                if len(dense) > profile.dimensions:
+                    dense = shorten_embedding(dense, profile.dimensions)
+                batch.append(PointStruct(
+                    id=point.id,
+                    vector=_point_vector(dense, (point.payload or {}).get("chunk_text", ""), profile),
+                    payload=point.payload,
+                ))
+            retry_on_timeout(lambda: qdrant.upsert(collection_name=profile.collection, points=batch))
+            copied += len(batch)
+            print(f"Migrated {copied} points to {profile.collection}")
+        if offset is None:
+            return copied
+
+
+def pack_batches(texts: List[str], max_tokens: int, max_inputs: int) -> List[List[int]]:
+    """
+    Group text indices into batches of at most max_tokens (by tiktoken count)
+    and max_inputs texts, keeping the original order.
+    """
+    from cost_tracker import estimate_tokens
+
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text, EMBEDDING_MODEL)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_inputs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _qdrant_connection_kwargs() -> dict:
+    """Connection settings for QdrantClient/AsyncQdrantClient from QDRANT_URL."""
+    if not QDRANT_URL:
+        raise ValueError("QDRANT_URL environment variable not set")
+
+    # Parse URL to extract host and port
+    parsed = urlparse(QDRANT_URL)
+    host = parsed.hostname
+    use_https = parsed.scheme == "https"
+
+    # For internal Railway URLs (.railway.internal), use gRPC on 6334 for
+    # better performance on the internal network
+    if host and '.railway.internal' in host:
+        return {"host": host, "grpc_port": 6334, "api_key": QDRANT_API_KEY, "prefer_grpc": True, "https": False}
+
+    # For Railway public URLs (.up.railway.app), always use port 443
+    if host and '.up.railway.app' in host:
+        port = 443
+        use_https = True
+    else:
+        port = parsed.port or (443 if use_https else 6333)
+    return {"host": host, "port": port, "api_key": QDRANT_API_KEY, "prefer_grpc": False, "https": use_https}
+
+
+def _search_filter(user_id: str, project_name: Optional[str] = None) -> Filter:
+    """Filter restricting a search to one user's (and optionally one project's) chunks."""
+    filter_conditions = [
+        FieldCondition(
+            key="user_id",
+            match=MatchValue(value=user_id)
+        )
+    ]
+    if project_name:
+        filter_conditions.append(
+            FieldCondition(
+                key="project_name",
+                match=MatchValue(value=project_name)
             )
-            print(f"Qdrant client initialized for {host}:{port} (https={use_https})")
+        )
+    return Filter(must=filter_conditions)
+
+
+def _format_results(results) -> List[dict]:
+    return [
+        {
+            "filename": r.payload["filename"],
+            "chunk_text": r.payload["chunk_text"],
+            "chunk_index": r.payload["chunk_index"],
+            "score": r.score,
+            "project_name": r.payload["project_name"]
+        }
+        for r in results
+    ]
+
+
+class RAGService:
+    """Service for document indexing and retrieval using Qdrant."""
 
+    def __init__(self, qdrant: Optional[QdrantClient] = None):
         self.openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.splitter = RecursiveCharacterTextSplitter(
-            chunk_size=4000,      # ~1000 tokens
-            chunk_overlap=800,    # ~200 tokens overlap
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
             separators=["\n\n", "\n", ". ", " ", ""]
         )
+        if qdrant is not None:
+            # e.g. QdrantClient(":memory:") for offline evaluation
+            self.qdrant = qdrant
+            return
+
+        connection = _qdrant_connection_kwargs()
+        try:
+            self.qdrant = QdrantClient(**connection, timeout=60)
+        except Exception as e:
+            if not connection["prefer_grpc"]:
+                raise
+            print(f"gRPC connection failed, falling back to REST: {e}")
+            connection = {**connection, "port": 6333, "prefer_grpc": False}
+            connection.pop("grpc_port")
+            self.qdrant = QdrantClient(**connection, timeout=60)
+        print(f"Qdrant client initialized for {connection['host']} (grpc={connection['prefer_grpc']}, https={connection['https']})")
         self._ensure_collection()
 
     def _ensure_collection(self):
         """Create collection if it doesn't exist."""
         # Skip collection check - collection was created manually
-        # This avoids timeout issues on cross-cloud connections
+        # This avoids timeout issues on cross-cloud connections.
+        # Run `python qdrant_bootstrap.py` to create the payload indexes.
         print(f"Using Qdrant collection: {COLLECTION_NAME}")
 
     def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Get embeddings for a list of texts using OpenAI."""
         response = self.openai.embeddings.create(
             model=EMBEDDING_MODEL,
-            input=texts
+            input=texts,
+            **STORAGE_PROFILE.embedding_kwargs()
         )
         return [item.embedding for item in response.data]
 
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed one batch, retrying just this batch with backoff."""
+        for attempt in range(EMBEDDING_BATCH_RETRIES):
+            try:
+                return self._get_embeddings(texts)
+            except Exception as e:
+                if attempt == EMBEDDING_BATCH_RETRIES - 1:
+                    raise
+                print(f"Embedding batch of {len(texts)} failed ({type(e).__name__}: {e}); "
+                      f"retry {attempt + 1}/{EMBEDDING_BATCH_RETRIES - 1}")
+                time.sleep(2 ** attempt)
+
+    def _embed_in_batches(self, texts: List[str]) -> List[List[float]]:
+        """Embed many texts in token-budgeted batches, EMBEDDING_CONCURRENCY at a time."""
+        batches = pack_batches(texts, EMBEDDING_BATCH_TOKENS, EMBEDDING_BATCH_MAX_INPUTS)
+        if len(batches) == 1:
+            return self._embed_batch(texts)
+        with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as pool:
+            results = pool.map(self._embed_batch, [[texts[i] for i in batch] for batch in batches])
+            embeddings: List[Optional[List[float]]] = [None] * len(texts)
+            for batch, batch_embeddings in zip(batches, results):
+                for i, embedding in zip(batch, batch_embeddings):
+                    embeddings[i] = embedding
+        return embeddings
+
+    def _embed_chunks(self, chunks: List[str]) -> List[List[float]]:
+        """Embed document chunks, reusing stored embeddings for unchanged text."""
+        store = get_chunk_embedding_store()
+        embeddings = store.get_many(EMBEDDING_KEY, chunks)
+        missing = [i for i in range(len(chunks)) if i not in embeddings]
+        if missing:
+            # Repeated chunks (boilerplate, headers) are embedded once
+            texts = list(dict.fromkeys(chunks[i] for i in missing))
+            started = time.perf_counter()
+            fresh = dict(zip(texts, self._embed_in_batches(texts)))
+            elapsed = time.perf_counter() - started
+            store.put_many(EMBEDDING_KEY, texts, [fresh[t] for t in texts])
+            embeddings.update((i, fresh[chunks[i]]) for i in missing)
+            print(f"Embedded {len(texts)} chunks in {elapsed:.2f}s ({len(texts) / max(elapsed, 1e-6):.1f} chunks/s)")
+        print(f"Chunk embeddings: {len(chunks) - len(missing)} cached, {len(missing)} embedded")
+        return [embeddings[i] for i in range(len(chunks))]
+
     def index_document(
         self,
         user_id: str,
@@ -136,45 +784,91 @@ class RAGService:
         Returns:
             Number of chunks created
         """
-        # Skip delete for now - upsert will overwrite with same IDs
-        # self.delete_document(user_id, filename)
+        started = time.perf_counter()
 
         # Split into chunks
         chunks = self.splitter.split_text(text)
         if not chunks:
             return 0
 
-        # Get embeddings for all chunks
-        embeddings = self._get_embeddings(chunks)
-
-        # Create points for Qdrant
+        # Diff against what is already stored for this document: point IDs
+        # are stable, so unchanged chunks need no write at all
         document_id = f"{user_id}:{filename}"
-        points = []
-        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            # Create a unique point ID using hash
-            point_id = hash(f"{document_id}:{i}") & 0x7FFFFFFFFFFFFFFF
-            points.append(PointStruct(
-                id=point_id,
-                vector=embedding,
-                payload={
-                    "user_id": user_id,
-                    "filename": filename,
-                    "project_name": project_name,
-                    "chunk_index": i,
-                    "chunk_text": chunk,
-                    "document_id": document_id
-                }
+        wanted = {
+            chunk_point_id(document_id, i): (i, chunk_content_hash(chunk, project_name))
+            for i, chunk in enumerate(chunks)
+        }
+        stored = self._stored_chunk_hashes(document_id)
+        changed = [(point_id, i) for point_id, (i, content_hash) in wanted.items() if stored.get(point_id, (None, None))[1] != content_hash]
+        obsolete = [stored_id for point_id, (stored_id, _) in stored.items() if point_id not in wanted]
+
+        if changed:
+            # Get embeddings for the changed chunks (only new chunk text hits the API)
+            embeddings = self._embed_chunks([chunks[i] for _, i in changed])
+            points = []
+            for (point_id, i), embedding in zip(changed, embeddings):
+                points.append(PointStruct(
+                    id=point_id,
+                    vector=_point_vector(embedding, chunks[i], STORAGE_PROFILE),
+                    payload={
+                        "user_id": user_id,
+                        "filename": filename,
+                        "project_name": project_name,
+                        "chunk_index": i,
+                        "chunk_text": chunks[i],
+                        "document_id": document_id,
+                        "content_hash": wanted[point_id][1],
+                    }
+                ))
+
+            # Upsert to Qdrant with retry
+            retry_on_timeout(lambda: self.qdrant.upsert(
+                collection_name=COLLECTION_NAME,
+                points=points
             ))
 
-        # Upsert to Qdrant with retry
-        retry_on_timeout(lambda: self.qdrant.upsert(
-            collection_name=COLLECTION_NAME,
-            points=points
-        ))
+        if obsolete:
+            retry_on_timeout(lambda: self.qdrant.delete(
+                collection_name=COLLECTION_NAME,
+                points_selector=PointIdsList(points=obsolete)
+            ))
 
-        print(f"Indexed document '{filename}' for user {user_id}: {len(chunks)} chunks")
+        elapsed = time.perf_counter() - started
+        print(f"Indexed document '{filename}' for user {user_id}: {len(chunks)} chunks "
+              f"({len(changed)} upserted, {len(obsolete)} deleted, {len(chunks) - len(changed)} unchanged) "
+              f"in {elapsed:.2f}s ({len(chunks) / max(elapsed, 1e-6):.1f} chunks/s)")
         return len(chunks)
 
+    def _stored_chunk_hashes(self, document_id: str) -> Dict[str, tuple]:
+        """
+        str(point ID) -> (point ID, content_hash) for every chunk currently
+        stored for a document.
+        """
+        stored: Dict[str, tuple] = {}
+        offset = None
+        while True:
+            points, offset = retry_on_timeout(lambda: self.qdrant.scroll(
+                collection_name=COLLECTION_NAME,
+                scroll_filter=Filter(
+                    must=[
+                        FieldCondition(
+                            key="document_id",
+                            match=MatchValue(value=document_id)
+                        )
+                    ]
+                ),
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_payload=["content_hash"],
+                with_vectors=False
+            ))
+            for point in points:
+                # Points written before content hashes (or with the old hash()
+                # IDs) come back without a match, so they get rewritten/deleted
+                stored[str(point.id)] = (point.id, (point.payload or {}).get("content_hash"))
+            if offset is None:
+                return stored
+
     def delete_document(self, user_id: str, filename: str):
         """Delete all chunks for a document from Qdrant."""
         document_id = f"{user_id}:{filename}"
@@ -200,7 +894,8 @@ class RAGService:
         query: str,
         top_k: int = 5,
         score_threshold: float = 0.7,
-        project_name: Optional[str] = None
+        project_name: Optional[str] = None,
+        hybrid: Optional[bool] = None
     ) -> List[dict]:
         """
         Search for relevant document chunks.
@@ -211,47 +906,36 @@ class RAGService:
             top_k: Maximum number of results to return
             score_threshold: Minimum similarity score (0-1)
             project_name: Optional filter by project
+            hybrid: Fuse dense and keyword (sparse) results with RRF;
+                None uses RAG_HYBRID_DEFAULT
 
         Returns:
             List of matching chunks with metadata
         """
         # Get query embedding
-        query_embedding = self._get_embeddings([query])[0]
-
-        # Build filter for user isolation
-        filter_conditions = [
-            FieldCondition(
-                key="user_id",
-                match=MatchValue(value=user_id)
-            )
-        ]
-        if project_name:
-            filter_conditions.append(
-                FieldCondition(
-                    key="project_name",
-                    match=MatchValue(value=project_name)
-                )
-            )
+        query_embedding = query_embedding_cache.get(EMBEDDING_KEY, query)
+        if query_embedding is None:
+            query_embedding = self._get_embeddings([query])[0]
+            query_embedding_cache.put(EMBEDDING_KEY, query, query_embedding)
 
         # Search Qdrant (no score_threshold - let all results through)
-        results = self.qdrant.search(
-            collection_name=COLLECTION_NAME,
-            query_vector=query_embedding,
-            query_filter=Filter(must=filter_conditions),
-            limit=top_k
-        )
+        query_filter = _search_filter(user_id, project_name)
+        if _use_hybrid(hybrid):
+            results = self.qdrant.query_points(
+                collection_name=COLLECTION_NAME,
+                **_hybrid_query(query_embedding, query, query_filter, top_k)
+            ).points
+        else:
+            results = self.qdrant.search(
+                collection_name=COLLECTION_NAME,
+                query_vector=query_embedding,
+                query_filter=query_filter,
+                search_params=STORAGE_PROFILE.search_params(),
+                limit=top_k
+            )
         print(f"Qdrant search returned {len(results)} results")
 
-        return [
-            {
-                "filename": r.payload["filename"],
-                "chunk_text": r.payload["chunk_text"],
-                "chunk_index": r.payload["chunk_index"],
-                "score": r.score,
-                "project_name": r.payload["project_name"]
-            }
-            for r in results
-        ]
+        return _format_results(results)
 
     def get_user_indexed_documents(self, user_id: str) -> List[dict]:
         """
@@ -297,8 +981,89 @@ class RAGService:
             return []
 
 
-# Singleton instance
+class AsyncRAGService:
+    """
+    Non-blocking document search for the chat path.
+
+    Uses AsyncQdrantClient and the shared AsyncOpenAI pool, and gives the
+    query embedding and the Qdrant search their own deadlines so a slow
+    dependency drops the document context instead of stalling the stream.
+    Indexing stays on the sync RAGService.
+    """
+
+    def __init__(self):
+        import llm_clients
+
+        connection = _qdrant_connection_kwargs()
+        self.qdrant = AsyncQdrantClient(**connection, timeout=RAG_SEARCH_TIMEOUT)
+        self.openai = llm_clients.get_openai_client()
+        print(f"Async Qdrant client initialized for {connection['host']} (grpc={connection['prefer_grpc']})")
+
+    async def _get_query_embedding(self, query: str) -> List[float]:
+        cached = query_embedding_cache.get(EMBEDDING_KEY, query)
+        if cached is not None:
+            return cached
+        response = await self.openai.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[query],
+            timeout=RAG_EMBED_TIMEOUT,
+            **STORAGE_PROFILE.embedding_kwargs()
+        )
+        embedding = response.data[0].embedding
+        query_embedding_cache.put(EMBEDDING_KEY, query, embedding)
+        return embedding
+
+    async def search(
+        self,
+        user_id: str,
+        query: str,
+        top_k: int = 5,
+        score_threshold: float = 0.7,
+        project_name: Optional[str] = None,
+        hybrid: Optional[bool] = None
+    ) -> List[dict]:
+        """
+        Search for relevant document chunks (same results as RAGService.search).
+
+        Returns [] if either step misses its deadline or fails.
+        """
+        started = time.perf_counter()
+        try:
+            query_embedding = await asyncio.wait_for(self._get_query_embedding(query), RAG_EMBED_TIMEOUT)
+            embedded = time.perf_counter()
+            query_filter = _search_filter(user_id, project_name)
+            if _use_hybrid(hybrid):
+                response = await asyncio.wait_for(self.qdrant.query_points(
+                    collection_name=COLLECTION_NAME,
+                    **_hybrid_query(query_embedding, query, query_filter, top_k)
+                ), RAG_SEARCH_TIMEOUT)
+                results = response.points
+            else:
+                results = await asyncio.wait_for(self.qdrant.search(
+                    collection_name=COLLECTION_NAME,
+                    query_vector=query_embedding,
+                    query_filter=query_filter,
+                    search_params=STORAGE_PROFILE.search_params(),
+                    limit=top_k
+                ), RAG_SEARCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"RAG search deadline exceeded after {time.perf_counter() - started:.1f}s; continuing without documents")
+            return []
+        except Exception as e:
+            print(f"RAG search failed ({type(e).__name__}: {e}); continuing without documents")
+            return []
+
+        print(f"Qdrant search returned {len(results)} results "
+              f"(embed {(embedded - started) * 1000:.0f}ms, search {(time.perf_counter() - embedded) * 1000:.0f}ms)")
+        return _format_results(results)
+
+    async def close(self):
+        await self.qdrant.close()
+
+
+# Singleton instances
 _rag_service = None
+_async_rag_service = None
 
 
 def get_rag_service() -> RAGService:
@@ -307,3 +1072,19 @@ def get_rag_service() -> RAGService:
     if _rag_service is None:
         _rag_service = RAGService()
     return _rag_service
+
+
+def get_async_rag_service() -> AsyncRAGService:
+    """Get or create the async RAG service singleton (search only)."""
+    global _async_rag_service
+    if _async_rag_service is None:
+        _async_rag_service = AsyncRAGService()
+    return _async_rag_service
+
+
+async def close_async_rag_service():
+    """Close the async Qdrant client (called on app shutdown)."""
+    global _async_rag_service
+    if _async_rag_service is not None:
+        await _async_rag_service.close()
+    _async_rag_service = None
@@ -0,0 +1,190 @@
+"""
+Web search for RomaLume.
+
+DDGS is a blocking client, so every search runs in a worker thread and
+never holds up the event loop. The threads come from a dedicated pool of
+SEARCH_MAX_THREADS, not the default executor, so searches stuck on a
+blocked backend can't starve token verification or token counting. DDG
+frequently blocks datacenter IPs (e.g. Railway), so backends are hedged:
+the first starts immediately, the next joins if the first fails or hasn't
+answered within SEARCH_HEDGE_DELAY, and the first non-empty result wins.
+
+A thread can't be interrupted, so losing hedges (and searches that hit
+SEARCH_TIMEOUT) are not cancelled: they run to completion, bounded by
+SEARCH_BACKEND_TIMEOUT per request, and their results are discarded.
+
+Results are cached for SEARCH_CACHE_TTL seconds by normalized query, so
+the same realtime question asked a few minutes apart (or re-sent with a
+conversation) is answered from memory.
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from ddgs import DDGS
+
+# Tried in order; later entries are hedges for earlier ones
+SEARCH_BACKENDS = ["auto", "google, bing, brave, mojeek, yahoo, duckduckgo"]
+SEARCH_HEDGE_DELAY = float(os.getenv("SEARCH_HEDGE_DELAY", "1.5"))
+SEARCH_TIMEOUT = 12  # seconds for the whole search, all backends included
+SEARCH_BACKEND_TIMEOUT = 5  # per HTTP request inside DDGS
+# Concurrent DDGS calls per worker, abandoned ones included; more wait for a thread
+SEARCH_MAX_THREADS = int(os.getenv("SEARCH_MAX_THREADS", "8"))
+
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_SIZE = 1000
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return _SPACE_RE.sub(" ", query.lower()).strip().rstrip("?.!")
+
+
+class SearchCache:
+    """Bounded LRU of search results with a per-entry TTL."""
+
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE, ttl: int = SEARCH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[list, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query: str, max_results: int) -> Optional[list]:
+        key = (normalize_query(query), max_results)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, query: str, max_results: int, results: list):
+        key = (normalize_query(query), max_results)
+        with self._lock:
+            self._entries[key] = (results, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SearchStats:
+    """Counters for hedged searches (per process)."""
+
+    def __init__(self):
+        self.searches = 0
+        self.hedges = 0
+        self.empty = 0
+        self.wins = {}
+        self.total_ms = 0.0
+
+    def snapshot(self, cache: SearchCache) -> dict:
+        lookups = cache.hits + cache.misses
+        return {
+            "searches": self.searches,
+            "hedged_requests": self.hedges,
+            "empty_results": self.empty,
+            "wins_by_backend": dict(self.wins),
+            "avg_search_ms": round(self.total_ms / self.searches, 1) if self.searches else None,
+            "cache": {
+                "size": len(cache._entries),
+                "ttl_seconds": cache.ttl,
+                "hits": cache.hits,
+                "misses": cache.misses,
+                "hit_rate": round(cache.hits / lookups, 3) if lookups else 0.0,
+            },
+        }
+
+
+search_cache = SearchCache()
+search_stats = SearchStats()
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_THREADS, thread_name_prefix="web-search")
+
+
+def _search_backend(query: str, max_results: int, backend: str) -> list:
+    """One blocking DDGS search; failures are logged and return []."""
+    try:
+        return list(DDGS(timeout=SEARCH_BACKEND_TIMEOUT).text(query, max_results=max_results, backend=backend))
+    except Exception as e:
+        print(f"web_search backend='{backend}' failed: {type(e).__name__}: {e}")
+        return []
+
+
+async def _hedged_search(query: str, max_results: int) -> Tuple[list, Optional[str]]:
+    """Race the backends with staggered starts; return (results, winning backend)."""
+    loop = asyncio.get_running_loop()
+    backends = iter(SEARCH_BACKENDS)
+    running = {}
+
+    def launch() -> bool:
+        backend = next(backends, None)
+        if backend is None:
+            return False
+        if running:
+            search_stats.hedges += 1
+        task = asyncio.ensure_future(loop.run_in_executor(_search_executor, _search_backend, query, max_results, backend))
+        running[task] = backend
+        return True
+
+    launch()
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, timeout=SEARCH_HEDGE_DELAY, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                backend = running.pop(task)
+                results = task.result()
+                if results:
+                    return results, backend
+            # Either the leader is slow or a backend came back empty: bring in the next one
+            launch()
+        return [], None
+    finally:
+        # Losing hedges keep running in their threads until DDGS returns;
+        # cancelling only stops us from waiting on them
+        for task in running:
+            task.cancel()
+
+
+async def web_search(query: str, max_results: int = 5) -> list:
+    """Resilient multi-engine web search, cached and run off the event loop.
+
+    Returns [] if every backend fails or the search runs out of time.
+    """
+    cached = search_cache.get(query, max_results)
+    if cached is not None:
+        print(f"web_search cache hit: {query[:60]}")
+        return cached
+
+    started = time.perf_counter()
+    try:
+        results, backend = await asyncio.wait_for(_hedged_search(query, max_results), SEARCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"web_search timed out after {SEARCH_TIMEOUT}s")
+        results, backend = [], None
+
+    search_stats.searches += 1
+    search_stats.total_ms += (time.perf_counter() - started) * 1000
+    if results:
+        search_stats.wins[backend] = search_stats.wins.get(backend, 0) + 1
+        search_cache.put(query, max_results, results)
+    else:
+        search_stats.empty += 1
+        print("web_search exhausted all backends")
+    return results
+
+
+def get_search_stats() -> dict:
+    return search_stats.snapshot(search_cache)
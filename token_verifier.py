@@ -0,0 +1,163 @@
+"""
+Firebase ID-token verification with caching for RomaLume.
+
+google.oauth2.id_token.verify_firebase_token downloads Google's signing
+certs on every call and runs on the caller's thread. This module keeps:
+
+- the signing certs in memory for as long as their Cache-Control max-age
+  allows (refetched early if a token names an unknown key id), and
+- decoded tokens, keyed by SHA-256 of the raw token, until the token's own
+  ``exp`` claim,
+
+so repeat requests from the same session skip both the network and the
+RSA signature check. Cache misses are verified in a worker thread so the
+event loop never blocks on verification.
+"""
+
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import requests
+from google.auth import jwt
+
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+CERTS_FETCH_TIMEOUT = 10
+# Used when the certs response carries no usable max-age
+DEFAULT_CERTS_MAX_AGE = 3600
+
+TOKEN_CACHE_SIZE = 10000
+CLOCK_SKEW_SECONDS = 0
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+_session = requests.Session()
+
+
+class CertCache:
+    """Google's Firebase signing certs, cached per their Cache-Control max-age."""
+
+    def __init__(self, url: str = FIREBASE_CERTS_URL):
+        self.url = url
+        self._certs: dict = {}
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    def _fetch(self):
+        response = _session.get(self.url, timeout=CERTS_FETCH_TIMEOUT)
+        response.raise_for_status()
+        certs = response.json()
+
+        max_age = DEFAULT_CERTS_MAX_AGE
+        match = _MAX_AGE_RE.search(response.headers.get("Cache-Control", ""))
+        if match:
+            max_age = int(match.group(1))
+            # A shared cache may already have held the response for a while
+            age = response.headers.get("Age", "")
+            if age.isdigit():
+                max_age -= int(age)
+
+        self._certs = certs
+        self._expires_at = time.time() + max(max_age, 0)
+        self.fetches += 1
+        print(f"Auth: fetched {len(certs)} Firebase signing certs (max-age {max_age}s)")
+
+    def get(self, force_refresh: bool = False) -> dict:
+        """Return the current certs, fetching them if stale (blocking)."""
+        with self._lock:
+            if force_refresh or not self._certs or time.time() >= self._expires_at:
+                self._fetch()
+            return self._certs
+
+
+class TokenCache:
+    """LRU of decoded tokens keyed by token hash, valid until each token's exp."""
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                claims, expires_at = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return claims
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, claims: dict):
+        expires_at = float(claims.get("exp", 0))
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (claims, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+cert_cache = CertCache()
+token_cache = TokenCache()
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def verify_firebase_token_sync(token: str, audience: Optional[str] = None) -> dict:
+    """
+    Verify a Firebase ID token against the cached signing certs (blocking).
+
+    Raises:
+        ValueError: if the token is malformed, expired or badly signed
+    """
+    certs = cert_cache.get()
+    try:
+        return jwt.decode(token, certs=certs, audience=audience, clock_skew_in_seconds=CLOCK_SKEW_SECONDS)
+    except ValueError:
+        # Google rotates keys ahead of max-age expiry; retry once with fresh
+        # certs if the token was signed by a key we haven't seen yet.
+        header = jwt.decode_header(token)
+        if header.get("kid") in certs:
+            raise
+        certs = cert_cache.get(force_refresh=True)
+        return jwt.decode(token, certs=certs, audience=audience, clock_skew_in_seconds=CLOCK_SKEW_SECONDS)
+
+
+async def verify_firebase_token(token: str, audience: Optional[str] = None) -> dict:
+    """
+    Verify a Firebase ID token, serving repeats from the decoded-token cache.
+
+    Returns:
+        The decoded token claims (a copy callers may modify)
+
+    Raises:
+        ValueError: if the token is invalid
+    """
+    key = _token_key(token)
+    claims = token_cache.get(key)
+    if claims is None:
+        claims = await asyncio.to_thread(verify_firebase_token_sync, token, audience)
+        token_cache.put(key, claims)
+    return dict(claims)
+
+
+async def warm_certs():
+    """Fetch the signing certs ahead of the first request."""
+    try:
+        await asyncio.to_thread(cert_cache.get)
+    except Exception as e:
+        print(f"Auth: could not prefetch Firebase certs: {e}")
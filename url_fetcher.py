@@ -0,0 +1,313 @@
+"""
+URL fetching through Jina Reader for RomaLume.
+
+Links in a chat message are fetched through Jina Reader
+(https://r.jina.ai/<url>), which renders the page and returns clean text.
+All fetches share one keep-alive httpx client, so repeat fetches reuse
+connections instead of opening one (and a worker thread) per URL. Every
+fetch goes to the reader, so at most URL_READER_CONCURRENCY run against it
+at once (per worker), whatever site the links point to. Bodies are
+streamed and the connection is dropped as soon as MAX_URL_CONTENT_CHARS
+have been read, and every URL in a message shares one URL_FETCH_BUDGET.
+
+Fetched pages are cached by normalized URL for URL_CACHE_TTL seconds in an
+LRU bounded by URL_CACHE_MAX_CHARS of content, so a link that is re-sent
+with every turn of a conversation (or shared across a team) is fetched
+once. Failures are cached for URL_CACHE_NEGATIVE_TTL so a dead link isn't
+retried on every message. Set URL_CACHE_PATH to persist the cache across
+restarts.
+"""
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+
+READER_URL = "https://r.jina.ai/"
+URL_REGEX = re.compile(r'https?://[^\s\])>"\'`]+', re.IGNORECASE)
+MAX_URLS_PER_MESSAGE = 3
+MAX_URL_CONTENT_CHARS = 50000  # ~12K tokens
+URL_FETCH_BUDGET = 15  # seconds, for all the URLs in one message
+URL_CONNECT_TIMEOUT = 5
+URL_READER_CONCURRENCY = int(os.getenv("URL_READER_CONCURRENCY", "8"))
+
+URL_POOL_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60)
+
+TRUNCATION_NOTE = "\n\n[...content truncated...]"
+
+URL_CACHE_TTL = int(os.getenv("URL_CACHE_TTL", "3600"))
+URL_CACHE_NEGATIVE_TTL = int(os.getenv("URL_CACHE_NEGATIVE_TTL", "60"))
+URL_CACHE_MAX_CHARS = int(os.getenv("URL_CACHE_MAX_CHARS", str(20_000_000)))
+URL_CACHE_PATH = os.getenv("URL_CACHE_PATH")  # unset = memory only
+
+# Query parameters that only track where a link was shared
+TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref_src", "igshid"}
+
+_client: Optional[httpx.AsyncClient] = None
+_reader_limit: Optional[asyncio.Semaphore] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Get the shared keep-alive client used for URL fetches."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=URL_POOL_LIMITS,
+            timeout=httpx.Timeout(URL_FETCH_BUDGET, connect=URL_CONNECT_TIMEOUT),
+            headers={"Accept": "text/plain"},
+        )
+    return _client
+
+
+async def close_client():
+    """Close the shared client (called on app shutdown)."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+def _reader_concurrency() -> asyncio.Semaphore:
+    """Concurrency limit for requests to READER_URL (created on first use)."""
+    global _reader_limit
+    if _reader_limit is None:
+        _reader_limit = asyncio.Semaphore(URL_READER_CONCURRENCY)
+    return _reader_limit
+
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of a URL for cache keys: lowercase scheme and host, no
+    default port, fragment or tracking parameters, sorted query.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    netloc = host
+    if port and (scheme, port) not in (("http", 80), ("https", 443)):
+        netloc = f"{host}:{port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS
+    )
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+    return urlunsplit((scheme, netloc, path, urlencode(query), ""))
+
+
+class UrlCache:
+    """
+    LRU of fetched page content keyed by normalized URL, with per-entry
+    expiry. Failed fetches are stored as None for the shorter negative TTL.
+    The LRU is bounded by total content characters.
+    """
+
+    def __init__(self, max_chars: int = URL_CACHE_MAX_CHARS, ttl: int = URL_CACHE_TTL,
+                 negative_ttl: int = URL_CACHE_NEGATIVE_TTL):
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key: str):
+        content, _ = self._entries.pop(key)
+        self._chars -= len(content or "")
+
+    def get(self, url: str) -> Tuple[bool, Optional[str]]:
+        """Return (found, content); content is None for a cached failure."""
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def put(self, url: str, content: Optional[str], expires_at: Optional[float] = None):
+        key = normalize_url(url)
+        size = len(content or "")
+        if size > self.max_chars:
+            return
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if content is not None else self.negative_ttl)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (content, expires_at)
+            self._chars += size
+            while self._chars > self.max_chars:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def load(self, path: str) -> int:
+        """Load unexpired pages from a JSON file. Returns the number loaded."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"URL cache: could not load {path}: {e}")
+            return 0
+
+        now = time.time()
+        loaded = 0
+        # Stored oldest-first, so replaying keeps the LRU order
+        for url, content, expires_at in data.get("entries", []):
+            if expires_at > now and content is not None:
+                self.put(url, content, expires_at)
+                loaded += 1
+        return loaded
+
+    def save(self, path: str):
+        """Write unexpired pages (not failures) to a JSON file (atomically)."""
+        now = time.time()
+        with self._lock:
+            entries = [[k, c, exp] for k, (c, exp) in self._entries.items() if exp > now and c is not None]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries}, f)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "chars": self._chars,
+                "max_chars": self.max_chars,
+                "ttl_seconds": self.ttl,
+                "negative_ttl_seconds": self.negative_ttl,
+                "persistent": bool(URL_CACHE_PATH),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+
+url_cache = UrlCache()
+
+
+def load_url_cache():
+    """Load the persisted URL cache, if URL_CACHE_PATH is set."""
+    if URL_CACHE_PATH:
+        loaded = url_cache.load(URL_CACHE_PATH)
+        print(f"URL cache: loaded {loaded} pages from {URL_CACHE_PATH}")
+
+
+def save_url_cache():
+    """Persist the URL cache, if URL_CACHE_PATH is set."""
+    if URL_CACHE_PATH:
+        try:
+            url_cache.save(URL_CACHE_PATH)
+        except OSError as e:
+            print(f"URL cache: could not save {URL_CACHE_PATH}: {e}")
+
+
+def extract_urls(text: str) -> List[str]:
+    """Find unique URLs in a string, preserving order, capped at MAX_URLS_PER_MESSAGE."""
+    if not isinstance(text, str):
+        return []
+    found = []
+    seen = set()
+    for match in URL_REGEX.findall(text):
+        # Strip common trailing punctuation
+        cleaned = match.rstrip('.,;:!?')
+        if cleaned not in seen:
+            seen.add(cleaned)
+            found.append(cleaned)
+        if len(found) >= MAX_URLS_PER_MESSAGE:
+            break
+    return found
+
+
+async def fetch_url_content(url: str) -> Optional[dict]:
+    """Fetch a URL via Jina Reader and return clean text.
+
+    Jina Reader handles JS-rendered pages and returns markdown-formatted text.
+    Returns dict with 'url' and 'content' on success, None on failure.
+    """
+    try:
+        async with _reader_concurrency():
+            async with get_client().stream("GET", f"{READER_URL}{url}") as response:
+                if response.status_code != 200:
+                    print(f"URL fetch failed for {url}: HTTP {response.status_code}")
+                    return None
+                parts = []
+                size = 0
+                truncated = False
+                async for text in response.aiter_text():
+                    parts.append(text)
+                    size += len(text)
+                    if size > MAX_URL_CONTENT_CHARS:
+                        # Leaving the block closes the connection mid-body
+                        truncated = True
+                        break
+        content = "".join(parts)
+        if truncated:
+            content = content[:MAX_URL_CONTENT_CHARS] + TRUNCATION_NOTE
+        return {"url": url, "content": content}
+    except Exception as e:
+        print(f"URL fetch failed for {url}: {type(e).__name__}: {e}")
+        return None
+
+
+async def fetch_url_cached(url: str) -> Optional[dict]:
+    """fetch_url_content behind the URL cache; results carry 'cached'."""
+    found, content = url_cache.get(url)
+    if found:
+        return {"url": url, "content": content, "cached": True} if content is not None else None
+    result = await fetch_url_content(url)
+    url_cache.put(url, result["content"] if result else None)
+    if result:
+        result["cached"] = False
+    return result
+
+
+async def fetch_urls(urls: List[str], budget: float = URL_FETCH_BUDGET) -> List[dict]:
+    """
+    Fetch URLs in parallel within one shared time budget, serving repeats
+    from the URL cache.
+
+    Returns the successful fetches in the order the URLs were given; any
+    still running when the budget runs out are cancelled and left out.
+    """
+    if not urls:
+        return []
+    tasks = [asyncio.create_task(fetch_url_cached(u)) for u in urls]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=budget)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    if pending:
+        print(f"URL fetch budget of {budget}s ran out with {len(pending)} URL(s) pending")
+    return [t.result() for t in tasks if t in done and t.result() is not None]
@@ -0,0 +1,237 @@
+"""
+Write-behind usage logging for RomaLume.
+
+Billing writes used to run inline at the end of every chat stream: a
+usage_logs add, a user_monthly_usage increment and a users all-time
+increment. UsageWriter instead queues each usage event in memory and a
+background task flushes them with batched commits, either when
+USAGE_FLUSH_MAX_EVENTS events are waiting or every USAGE_FLUSH_INTERVAL
+seconds. Increments for the same user/month (and user) are merged
+within a flush, so a burst of messages costs one write per aggregate
+document rather than one per message.
+
+Each flush also maintains the analytics rollups (usage_daily_rollups per
+day and usage_model_rollups per model) that the admin dashboards read.
+
+A flush is capped so that all of its documents fit in one atomic
+WriteBatch: a failed commit wrote nothing, so retrying it can't add log
+documents twice or apply an increment twice. Log documents also get their
+ID when the event is recorded, so a retry rewrites the same document.
+
+The queue is drained on shutdown; a failed flush is retried with backoff
+before the events are given up (and printed, so they can be recovered
+from the logs).
+"""
+
+import asyncio
+import os
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import datastore
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "2.0"))
+USAGE_FLUSH_MAX_EVENTS = int(os.getenv("USAGE_FLUSH_MAX_EVENTS", "200"))
+USAGE_FLUSH_RETRIES = 3
+
+# Documents one event can add to a flush: its log plus, at most, a new
+# monthly, user, daily-rollup and model-rollup document
+DOCUMENTS_PER_EVENT = 5
+
+
+class UsageEvent:
+    """One response's usage: the log document plus the numbers to aggregate."""
+
+    __slots__ = ("log", "log_id", "user_id", "month_key", "cost_cents", "input_tokens", "output_tokens")
+
+    def __init__(self, log: dict, user_id: str, month_key: str, cost_cents: int, input_tokens: int, output_tokens: int):
+        self.log = log
+        self.log_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.month_key = month_key
+        self.cost_cents = cost_cents
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+
+def _totals() -> Dict[str, int]:
+    return {"requests": 0, "input_tokens": 0, "output_tokens": 0, "cost_cents": 0}
+
+
+def _rollup_totals() -> dict:
+    """Totals plus per-user request counts ('users'), for the analytics rollups."""
+    return {**_totals(), "users": defaultdict(int)}
+
+
+def _add(totals: Dict[str, int], event: UsageEvent):
+    totals["requests"] += 1
+    totals["input_tokens"] += event.input_tokens
+    totals["output_tokens"] += event.output_tokens
+    totals["cost_cents"] += event.cost_cents
+
+
+class UsageDeltas:
+    """
+    A flush collapsed into the documents it touches.
+
+    - logs: log_id -> usage_logs document to write
+    - monthly: (user_id, month_key) -> totals for user_monthly_usage
+    - all_time: user_id -> totals for the user's all-time fields
+    - daily: date_key -> totals plus 'by_model' and per-user request counts ('users')
+    - models: model -> all-time totals with per-user request counts ('users')
+
+    The per-model entries in 'by_model' carry 'users' too, so unique users
+    can be counted per day and per model.
+    """
+
+    def __init__(self):
+        self.logs: Dict[str, dict] = {}
+        self.monthly: Dict[Tuple[str, str], Dict[str, int]] = defaultdict(_totals)
+        self.all_time: Dict[str, Dict[str, int]] = defaultdict(_totals)
+        self.daily: Dict[str, dict] = {}
+        self.models: Dict[str, dict] = defaultdict(_rollup_totals)
+
+    def add(self, event: UsageEvent):
+        self.logs[event.log_id] = event.log
+        _add(self.monthly[(event.user_id, event.month_key)], event)
+        _add(self.all_time[event.user_id], event)
+
+        date_key = event.log.get("date_key", "")
+        model = event.log.get("model") or "unknown"
+        day = self.daily.get(date_key)
+        if day is None:
+            day = self.daily[date_key] = {**_rollup_totals(), "by_model": defaultdict(_rollup_totals)}
+        for totals in (day, day["by_model"][model], self.models[model]):
+            _add(totals, event)
+            totals["users"][event.user_id] += 1
+
+    def document_count(self) -> int:
+        return len(self.logs) + len(self.monthly) + len(self.all_time) + len(self.daily) + len(self.models)
+
+    def has_room(self) -> bool:
+        """Whether one more event of any kind still fits in a single batch."""
+        return self.document_count() + DOCUMENTS_PER_EVENT <= datastore.MAX_BATCH_WRITES
+
+
+def merge_events(events: List[UsageEvent]) -> UsageDeltas:
+    """Collapse a flush into log documents plus merged aggregate and rollup increments."""
+    deltas = UsageDeltas()
+    for event in events:
+        deltas.add(event)
+    return deltas
+
+
+def split_flushes(events: List[UsageEvent], max_events: int = USAGE_FLUSH_MAX_EVENTS) -> List[List[UsageEvent]]:
+    """Split events into flushes that each fit in one batch commit."""
+    flushes = []
+    deltas = None
+    for event in events:
+        if deltas is None or len(flushes[-1]) >= max_events or not deltas.has_room():
+            flushes.append([])
+            deltas = UsageDeltas()
+        flushes[-1].append(event)
+        deltas.add(event)
+    return flushes
+
+
+class UsageWriter:
+    """In-process queue that batches usage events into Firestore commits."""
+
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL, max_events: int = USAGE_FLUSH_MAX_EVENTS):
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.events_written = 0
+        self.documents_written = 0
+        self.events_dropped = 0
+
+    def start(self):
+        """Start the background flusher on the running loop (idempotent)."""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def record(self, event: UsageEvent):
+        """Queue a usage event. Never blocks and never raises into the caller."""
+        self.start()
+        self._queue.put_nowait(event)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return
+            events = [event]
+            deltas = merge_events(events)
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(events) < self.max_events and deltas.has_room():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                events.append(event)
+                deltas.add(event)
+            await self._flush(events)
+            if stopping:
+                return
+
+    async def _flush(self, events: List[UsageEvent]):
+        deltas = merge_events(events)
+        writes = deltas.document_count()
+        for attempt in range(USAGE_FLUSH_RETRIES):
+            try:
+                await datastore.commit_usage_batch(deltas)
+                self.flushes += 1
+                self.events_written += len(events)
+                self.documents_written += writes
+                print(f"Usage flush: {len(events)} events -> {writes} writes")
+                return
+            except Exception as e:
+                print(f"Usage flush failed (attempt {attempt + 1}/{USAGE_FLUSH_RETRIES}): {e}")
+                if attempt + 1 < USAGE_FLUSH_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        self.events_dropped += len(events)
+        print(f"Usage flush gave up on {len(events)} events: {list(deltas.logs.values())}")
+
+    async def stop(self):
+        """Flush everything still queued and stop the flusher."""
+        if self._task is None:
+            return
+        # The sentinel lets an in-progress flush finish instead of being cancelled
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+        # Anything recorded after the sentinel
+        pending = []
+        while not self._queue.empty():
+            event = self._queue.get_nowait()
+            if event is not None:
+                pending.append(event)
+        for events in split_flushes(pending, self.max_events):
+            await self._flush(events)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "flushes": self.flushes,
+            "events_written": self.events_written,
+            "documents_written": self.documents_written,
+            "events_dropped": self.events_dropped,
+            "writes_per_event": round(self.documents_written / self.events_written, 3) if self.events_written else None,
+        }
+
+
+usage_writer = UsageWriter()